@@ -3,16 +3,22 @@ import codecs
 import logging
 import re
 import os
+import bisect
+import hashlib
+import sqlite3
+import threading
 from collections import defaultdict
+from concurrent import futures
 
 import json
-import nltk
 import numpy as np
-from pycorenlp import StanfordCoreNLP
 from typing import Set
 
+from questionanswering import lightweight_tagger, entity_index, resources
 from questionanswering.base_objects import all_zeroes, unknown_el
 
+nltk = resources.lazy_import("nltk")
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.ERROR)
 
@@ -21,11 +27,19 @@ special_tokens = {"&ndash;": "–",
                   "@card@": "0"
                   }
 
-corenlp = StanfordCoreNLP('http://semanticparsing:9000')
+# Either "corenlp" or "lightweight" for the rule-based tagger that runs in-process
+TAGGER_BACKEND = "corenlp"
+CORENLP_URL = 'http://semanticparsing:9000'
+ANNOTATION_CACHE_FORMAT = 1
+_corenlp = None
 corenlp_properties = {
     'annotators': 'tokenize, pos, ner',
     'outputFormat': 'json'
 }
+lemmatizer_properties = {
+    'annotators': 'tokenize, lemma',
+    'outputFormat': 'json'
+}
 corenlp_caseless = {
     'pos.model': 'edu/stanford/nlp/models/pos-tagger/english-caseless-left3words-distsim.tagger',
     'ner.model': #'edu/stanford/nlp/models/ner/english.all.3class.caseless.distsim.crf.ser.gz,' +
@@ -40,6 +54,66 @@ RESOURCES_FOLDER = os.path.join(module_location, "..", "resources/")
 
 split_pattern = re.compile(r"[\s'-:,]")
 
+TAGGED_TOKEN_FIELDS = {"index", "originalText", "pos", "ner", "lemma", "characterOffsetBegin", "characterOffsetEnd"}
+
+
+class AnnotationCache:
+
+    def __init__(self, path_to_cache, annotator_version=""):
+        """
+        A persistent cache of CoreNLP annotations keyed by the preprocessed input text and the annotator properties.
+        The annotator version is part of the key, change it when the models on the CoreNLP server are updated.
+
+        :param path_to_cache: location of the SQLite file, ":memory:" for an in-memory cache
+        :param annotator_version: a string that identifies the annotator models
+        >>> cache = AnnotationCache(":memory:", annotator_version="3.8.0")
+        >>> cache.put("who is ?", corenlp_properties, [{'originalText': 'who'}])
+        >>> cache.get("who is ?", corenlp_properties)
+        [{'originalText': 'who'}]
+        >>> AnnotationCache(":memory:", annotator_version="3.9.0").get("who is ?", corenlp_properties) is None
+        True
+        """
+        self.annotator_version = annotator_version
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path_to_cache, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("CREATE TABLE IF NOT EXISTS annotations (key TEXT PRIMARY KEY, value TEXT)")
+
+    def _key(self, input_text, properties):
+        key = json.dumps([ANNOTATION_CACHE_FORMAT, self.annotator_version, input_text, properties], sort_keys=True)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def get(self, input_text, properties):
+        """
+        :return: the cached annotation or None
+        """
+        with self._lock:
+            row = self._connection.execute("SELECT value FROM annotations WHERE key = ?",
+                                           (self._key(input_text, properties),)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, input_text, properties, annotation):
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO annotations VALUES (?, ?)",
+                                     (self._key(input_text, properties), json.dumps(annotation)))
+
+
+# Set to an AnnotationCache to reuse the annotations across runs
+annotation_cache = None
+
+
+def get_corenlp():
+    """
+    Get the CoreNLP client, the client is created when it is first used.
+
+    :return: an instance of StanfordCoreNLP
+    """
+    global _corenlp
+    if _corenlp is None:
+        from pycorenlp import StanfordCoreNLP
+        _corenlp = StanfordCoreNLP(CORENLP_URL)
+    return _corenlp
+
 
 def get_tagged_from_server(input_text, caseless=False):
     """
@@ -53,18 +127,98 @@ def get_tagged_from_server(input_text, caseless=False):
     """
     if len(input_text.strip()) == 0:
         return []
+    input_text = _prepare_tagger_input(input_text, caseless)
+    if TAGGER_BACKEND == "lightweight":
+        return lightweight_tagger.tag(input_text, caseless)
+    properties = _tagger_properties(caseless)
+    if annotation_cache is not None:
+        tagged = annotation_cache.get(input_text, properties)
+        if tagged is not None:
+            return tagged
+    corenlp_output = get_corenlp().annotate(input_text, properties=properties).get("sentences", [])
+    tagged = [{k: t[k] for k in TAGGED_TOKEN_FIELDS}
+              for sent in corenlp_output for t in sent['tokens']]
+    if annotation_cache is not None:
+        annotation_cache.put(input_text, properties, tagged)
+    return tagged
+
+
+def get_tagged_from_server_batch(input_texts, caseless=False, batch_size=50, workers=1):
+    """
+    Get pos tagged and ner from the CoreNLP Server for a list of texts. The texts are sent to the server in batches,
+    each batch is one document where the texts are separated by empty lines, so that sentences never cross the text
+    boundaries. The tokens are mapped back to the texts using the character offsets.
+
+    :param input_texts: a list of input texts
+    :param caseless: a boolean or a list of booleans, one per input text, to use the caseless models
+    :param batch_size: number of texts to send in one request
+    :param workers: number of requests to send concurrently
+    :return: a list of tokenized texts with pos and ne tags, same as get_tagged_from_server for each of the texts
+    """
+    if isinstance(caseless, bool):
+        caseless = [caseless] * len(input_texts)
+    if TAGGER_BACKEND == "lightweight":
+        return [get_tagged_from_server(t, caseless[i]) for i, t in enumerate(input_texts)]
+    tagged = [[] for _ in input_texts]
+    prepared_texts = [_prepare_tagger_input(t, caseless[i]) if len(t.strip()) > 0 else None
+                      for i, t in enumerate(input_texts)]
+    batches = []
+    for caseless_batch in {True, False}:
+        text_ids = []
+        for i, t in enumerate(prepared_texts):
+            if t is not None and caseless[i] == caseless_batch:
+                cached = annotation_cache.get(t, _tagger_properties(caseless_batch)) \
+                    if annotation_cache is not None else None
+                if cached is not None:
+                    tagged[i] = cached
+                else:
+                    text_ids.append(i)
+        batches += [(text_ids[i:i + batch_size], caseless_batch) for i in range(0, len(text_ids), batch_size)]
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for (text_ids, caseless_batch), batch_tagged in zip(batches, executor.map(
+                lambda b: _tag_batch([prepared_texts[i] for i in b[0]], b[1]), batches)):
+            for i, t in zip(text_ids, batch_tagged):
+                tagged[i] = t
+                if annotation_cache is not None:
+                    annotation_cache.put(prepared_texts[i], _tagger_properties(caseless_batch), t)
+    return tagged
+
+
+def _tag_batch(prepared_texts, caseless):
+    prepared_texts = [t.replace("\n", " ") for t in prepared_texts]
+    # CoreNLP counts offsets in UTF-16 code units
+    text_starts, position = [], 0
+    for t in prepared_texts:
+        text_starts.append(position)
+        position += len(t.encode('utf-16-le')) // 2 + 2
+    properties = dict(_tagger_properties(caseless))
+    properties['ssplit.newlineIsSentenceBreak'] = 'two'
+    corenlp_output = get_corenlp().annotate("\n\n".join(prepared_texts), properties=properties).get("sentences", [])
+    tagged = [[] for _ in prepared_texts]
+    for sent in corenlp_output:
+        if not sent['tokens']:
+            continue
+        text_id = bisect.bisect_right(text_starts, sent['tokens'][0]['characterOffsetBegin']) - 1
+        for t in sent['tokens']:
+            t = {k: t[k] for k in TAGGED_TOKEN_FIELDS}
+            t['characterOffsetBegin'] -= text_starts[text_id]
+            t['characterOffsetEnd'] -= text_starts[text_id]
+            tagged[text_id].append(t)
+    return tagged
+
+
+def _tagger_properties(caseless):
+    return {**corenlp_properties, **corenlp_caseless} if caseless else corenlp_properties
+
+
+def _prepare_tagger_input(input_text, caseless=False):
     if "@" in input_text or "#" in input_text:
         input_text = _preprocess_twitter_handles(input_text)
     input_text = remove_links(input_text)
     input_text = _preprocess_corenlp_input(input_text)
     if caseless:
         input_text = input_text.lower()
-    corenlp_output = corenlp.annotate(input_text,
-                                      properties={**corenlp_properties, **corenlp_caseless} if caseless else corenlp_properties
-                                      ).get("sentences", [])
-    tagged = [{k: t[k] for k in {"index", "originalText", "pos", "ner", "lemma", "characterOffsetBegin", "characterOffsetEnd"}}
-              for sent in corenlp_output for t in sent['tokens']]
-    return tagged
+    return input_text
 
 
 def _preprocess_corenlp_input(input_text):
@@ -153,16 +307,23 @@ def _lemmatize_tokens(entity_tokens):
     >>> _lemmatize_tokens("who is the member of the house of representatives?".split())
     ['who', 'be', 'the', 'member', 'of', 'the', 'house', 'of', 'representative', '?']
     """
-    try:
-        lemmas = corenlp.annotate(" ".join([t.lower() for t in entity_tokens]), properties={
-            'annotators': 'tokenize, lemma',
-            'outputFormat': 'json'
-        }).get("sentences", [])[0]['tokens']
-    except:
-        lemmas = []
-    lemmas = [t['lemma'] for t in lemmas]
-    lemmas = [l.title() if i < len(entity_tokens) and entity_tokens[i].istitle() else l for i, l in enumerate(lemmas)]
-    return lemmas
+    if TAGGER_BACKEND == "lightweight":
+        return [lightweight_tagger.lemmatize(t) for t in entity_tokens]
+    input_text = " ".join([t.lower() for t in entity_tokens])
+    lemmas = annotation_cache.get(input_text, lemmatizer_properties) if annotation_cache is not None else None
+    if lemmas is None:
+        try:
+            lemmas = get_corenlp().annotate(input_text, properties=lemmatizer_properties).get("sentences", [])[0]['tokens']
+            lemmas = [t['lemma'] for t in lemmas]
+            if annotation_cache is not None:
+                annotation_cache.put(input_text, lemmatizer_properties, lemmas)
+        except:
+            lemmas = []
+    return _restore_case(lemmas, entity_tokens)
+
+
+def _restore_case(lemmas, tokens):
+    return [l.title() if i < len(tokens) and tokens[i].istitle() else l for i, l in enumerate(lemmas)]
 
 
 def load_resource_file_backoff(f):
@@ -181,33 +342,137 @@ def load_resource_file_backoff(f):
 
 def load_word_embeddings(path):
     """
-    Loads pre-trained embeddings from the specified path.
+    Loads pre-trained embeddings from the specified path. A text file in the GloVe format is converted
+    to the binary format on the first load (see convert_word_embeddings), the following loads memory-map the binary
+    matrix, so that the processes that use the same embeddings share the pages.
 
     @return (embeddings as an numpy array, word to index dictionary)
     """
-    word2idx = defaultdict(lambda: 1)  # Maps a word to the index in the embeddings matrix
+    binary_path = os.path.splitext(path)[0]
+    if path.endswith(".npy") or not os.path.exists(path):
+        path = binary_path
+    elif not _binary_embeddings_exist(binary_path) or os.path.getmtime(binary_path + ".npy") < os.path.getmtime(path):
+        try:
+            convert_word_embeddings(path, binary_path)
+        except OSError as ex:
+            logger.warning("Can't save the binary embeddings to {}, loading the text file. {}".format(binary_path, ex))
+            return _load_word_embeddings_from_text(path)
+    embeddings = np.load(binary_path + ".npy", mmap_mode='r')
+    with codecs.open(binary_path + ".vocab", 'r', encoding='utf-8') as fIn:
+        words = fIn.read().split("\n")[:-1]
+    word2idx = _build_word2idx(words)
+    logger.debug("Loaded: {}".format(embeddings.shape))
+
+    return embeddings, word2idx
+
+
+def convert_word_embeddings(path, save_to=None):
+    """
+    Converts pre-trained embeddings in the GloVe text format into a binary matrix (save_to.npy) that includes
+    the rows for the padding and the unknown elements, and a vocabulary file (save_to.vocab) with one word per line.
+
+    :param path: path to the embeddings text file
+    :param save_to: path to the binary files without the extension, by default the path of the text file is used
+    """
+    if save_to is None:
+        save_to = os.path.splitext(path)[0]
+    words, embeddings = _read_word_embeddings_text(path)
+    save_word_embeddings(embeddings, words, save_to)
+    logger.debug("Converted the embeddings to {}".format(save_to))
+
+
+def save_word_embeddings(embeddings, words, save_to):
+    """
+    Save the embeddings in the binary format that is read by load_word_embeddings.
+
+    :param embeddings: embeddings matrix, the first two rows are the padding and the unknown element
+    :param words: a list of words for the rest of the rows
+    :param save_to: path to the binary files without the extension
+    """
+    # Write to temporary files that are unique to this process and thread first, so that a concurrent process never
+    # sees a partial file. The matrix is moved into place last, its modification time marks a complete conversion.
+    tmp = save_to + ".tmp{}.{}".format(os.getpid(), threading.get_ident())
+    try:
+        np.save(tmp + ".npy", np.asarray(embeddings, dtype='float32'))
+        with codecs.open(tmp + ".vocab", 'w', encoding='utf-8') as out:
+            out.write("".join(w + "\n" for w in words))
+        os.replace(tmp + ".vocab", save_to + ".vocab")
+        os.replace(tmp + ".npy", save_to + ".npy")
+    finally:
+        for path in (tmp + ".npy", tmp + ".vocab"):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def prune_word_embeddings(embeddings, word2idx, tokens):
+    """
+    Reduce the embeddings to the rows that the given tokens are mapped to, either directly after lowercasing or
+    through the normalization in get_idx. The kept rows stay in the original order, so the pruning is stable and
+    all the given tokens get the same vectors as with the full embeddings.
+
+    :param embeddings: embeddings matrix as returned by load_word_embeddings
+    :param word2idx: word to index mapping as returned by load_word_embeddings
+    :param tokens: an iterable of tokens that should be kept
+    :return: (pruned embeddings, pruned word to index dictionary)
+    >>> e, w = prune_word_embeddings(np.arange(12).reshape(6, 2), defaultdict(lambda: 1, {all_zeroes: 0, unknown_el: 1, "the": 2, "0": 3, "queen": 4, "king": 5}), ["Queen", "1999", "abracadabra"])
+    >>> e.tolist()
+    [[0, 1], [2, 3], [6, 7], [8, 9]]
+    >>> get_idx("1999", w), get_idx("(queen)", w), w["king"]
+    (2, 3, 1)
+    """
+    kept_ids = set()
+    for t in set(tokens):
+        for form in {t, t.lower()}:
+            idx = get_idx(form, word2idx)
+            if idx > word2idx[unknown_el]:
+                kept_ids.add(idx)
+    kept_ids = sorted(kept_ids)
+    idx2word = {idx: w for w, idx in word2idx.items()}
+    pruned_embeddings = embeddings[[word2idx[all_zeroes], word2idx[unknown_el]] + kept_ids]
+    logger.debug("Pruned the embeddings: {} -> {}".format(embeddings.shape, pruned_embeddings.shape))
+    return pruned_embeddings, _build_word2idx([idx2word[idx] for idx in kept_ids])
+
+
+def _binary_embeddings_exist(binary_path):
+    return os.path.exists(binary_path + ".npy") and os.path.exists(binary_path + ".vocab")
+
+
+def _load_word_embeddings_from_text(path):
+    words, embeddings = _read_word_embeddings_text(path)
+    return embeddings, _build_word2idx(words)
+
+
+def _build_word2idx(words):
+    word2idx = defaultdict(lambda: 1, zip(words, range(2, len(words) + 2)))  # Maps a word to the index in the embeddings matrix
     word2idx[all_zeroes] = 0
     word2idx[unknown_el] = 1
+    return word2idx
+
+
+def _read_word_embeddings_text(path):
+    words = []
     embeddings = []
 
     with codecs.open(path, 'r', encoding='utf-8') as fIn:
-        idx = 2
         for line in fIn:
             split = line.strip().split(' ')
-            embeddings.append([float(num) for num in split[1:]])
-            word2idx[split[0]] = idx
-            idx += 1
+            embeddings.append(np.asarray(split[1:], dtype='float32'))
+            words.append(split[0])
 
     embedding_size = len(embeddings[0])
     embeddings = np.asarray(embeddings, dtype='float32')
 
     unknown_emb = np.average(embeddings[:10000], axis=0)
-    embeddings = np.concatenate((np.zeros((1, embedding_size)),
+    embeddings = np.concatenate((np.zeros((1, embedding_size), dtype='float32'),
                                  np.expand_dims(unknown_emb, 0),
                                  embeddings), axis=0)
     logger.debug("Loaded: {}".format(embeddings.shape))
 
-    return embeddings, word2idx
+    return words, embeddings
+
+
+trim_pattern = re.compile(r"(^\W|\W$)")
+digits_pattern = re.compile(r"([0-9][0-9.,]*)")
 
 
 def get_idx(word, word2idx):
@@ -226,17 +491,113 @@ def get_idx(word, word2idx):
         return word2idx[word.lower()]
     elif word in special_tokens:
         return word2idx.get(special_tokens[word], unknown_idx)
-    trimmed = re.sub("(^\W|\W$)", "", word)
+    trimmed = trim_pattern.sub("", word)
     if trimmed in word2idx:
         return word2idx[trimmed]
     elif trimmed.lower() in word2idx:
         return word2idx[trimmed.lower()]
-    no_digits = re.sub("([0-9][0-9.,]*)", '0', word)
+    no_digits = digits_pattern.sub('0', word)
     if no_digits in word2idx:
         return word2idx[no_digits]
     return unknown_idx
 
 
+class Vocabulary:
+
+    def __init__(self, word2idx):
+        """
+        A word to index mapping that memoizes the resolved words and maps lists of tokens to index arrays.
+        Unlike the indexing of a defaultdict, the lookups never add the unknown words to word2idx.
+        The memo is reset when word2idx changes size, e.g. after adding the special tokens.
+
+        :param word2idx: dictionary constructed from an embeddings file
+        >>> vocab = Vocabulary({all_zeroes: 0, unknown_el: 1, "the": 2, "0": 3, "queen": 4})
+        >>> vocab.to_ids(["The", "Queen", "1999"])
+        array([2, 4, 1], dtype=int32)
+        >>> vocab.to_ids(["The", "Queen", "1999", "(queen)"], normalize=True)
+        array([2, 4, 3, 4], dtype=int32)
+        >>> vocab.to_ids(["The", "Queen", "1999"], max_len=2)
+        array([2, 4], dtype=int32)
+        """
+        self.word2idx = word2idx
+        self.unknown_idx = word2idx[unknown_el]
+        # Changes every time word2idx changes, the values precomputed with the vocabulary should be recomputed
+        self.version = 0
+        self._size = len(word2idx)
+        self._lowercased = {}
+        self._normalized = {}
+
+    def __len__(self):
+        return len(self.word2idx)
+
+    def __contains__(self, word):
+        return word in self.word2idx
+
+    def __getitem__(self, word):
+        """
+        :return: the index of the lowercased word or the index of the unknown element
+        """
+        self._check_size()
+        idx = self._lowercased.get(word)
+        if idx is None:
+            idx = self._lowercased[word] = self.word2idx.get(word.lower(), self.unknown_idx)
+        return idx
+
+    def get_idx(self, word):
+        """
+        :return: the index of the word normalized the same way as in get_idx
+        """
+        self._check_size()
+        idx = self._normalized.get(word)
+        if idx is None:
+            idx = self._normalized[word] = get_idx(word, self.word2idx)
+        return idx
+
+    def check_version(self):
+        """
+        :return: the current version of the vocabulary
+        """
+        self._check_size()
+        return self.version
+
+    def to_ids(self, tokens, max_len=None, normalize=False):
+        """
+        Map a list of tokens to an array of indices.
+
+        :param tokens: a list of tokens
+        :param max_len: optionally cut the list of tokens to the given length
+        :param normalize: use the normalization of get_idx instead of just lowercasing
+        :return: a numpy array of indices
+        """
+        lookup = self.get_idx if normalize else self.__getitem__
+        return np.fromiter((lookup(w) for w in tokens[:max_len]), dtype=np.int32)
+
+    def to_ids_batch(self, token_lists, max_len, normalize=False):
+        """
+        Map a batch of token lists to a zero-padded matrix of indices.
+
+        :param token_lists: a list of lists of tokens
+        :param max_len: the length of the rows, longer lists are cut
+        :param normalize: use the normalization of get_idx instead of just lowercasing
+        :return: a numpy array of shape (len(token_lists), max_len)
+        >>> Vocabulary({all_zeroes: 0, unknown_el: 1, "the": 2, "queen": 3}).to_ids_batch([["The", "Queen"], ["queen"]], 3)
+        array([[2, 3, 0],
+               [3, 0, 0]], dtype=int32)
+        """
+        out = np.zeros((len(token_lists), max_len), dtype=np.int32)
+        for i, tokens in enumerate(token_lists):
+            word_ids = self.to_ids(tokens, max_len, normalize)
+            out[i, :len(word_ids)] = word_ids
+        return out
+
+    def _check_size(self):
+        if len(self.word2idx) != self._size:
+            self._size = len(self.word2idx)
+            self.version += 1
+            self._lowercased.clear()
+            self._normalized.clear()
+
+
 def get_trigram_index(sentences):
     """
     Create a trigram index from the list of tokenized sentences.
@@ -265,6 +626,88 @@ def tokens_to_trigrams(tokens):
     return [trigram for t in tokens for trigram in nltk.ngrams("#{}#".format(t), 3)]
 
 
+class TrigramEncoder:
+
+    def __init__(self, trigram2idx=None, hash_size=2**18):
+        """
+        Vectorized encoder of the character trigrams of "#token#" strings into integer ids. The trigrams are
+        the same as in tokens_to_trigrams. The ids come either from a trigram index (see get_trigram_index), or,
+        if no index is given, from hashing the trigrams into a fixed space. Id 0 is reserved for padding.
+
+        :param trigram2idx: a trigram to index mapping
+        :param hash_size: size of the id space if no index is given
+        >>> encoder = TrigramEncoder(get_trigram_index([['who', 'played']]))
+        >>> ids = encoder.encode_batch([['who', 'played', 'bond'], ['who']], max_len=10)
+        >>> ids.shape, int(ids[1, 3]), int(ids[0, 9]) == encoder.trigram2idx[unknown_el]
+        ((2, 10), 0, True)
+        >>> [encoder.trigram2idx[t] for t in tokens_to_trigrams(['who'])] == ids[1, :3].tolist()
+        True
+        >>> TrigramEncoder(hash_size=100).encode(['who', 'bond']).tolist()
+        [37, 84, 80, 81, 6, 30, 72]
+        """
+        self.trigram2idx = trigram2idx
+        self.hash_size = hash_size
+        if trigram2idx is not None:
+            trigrams = [t for t in trigram2idx if t not in {all_zeroes, unknown_el}]
+            keys = np.asarray([self._pack(*[ord(c) for c in t]) for t in trigrams], dtype=np.int64)
+            order = np.argsort(keys)
+            self._keys = keys[order]
+            self._ids = np.asarray([trigram2idx[t] for t in trigrams], dtype=np.int32)[order]
+            self._unknown_idx = trigram2idx[unknown_el]
+
+    @staticmethod
+    def _pack(c1, c2, c3):
+        # Unicode code points fit into 21 bits
+        return (c1 << 42) | (c2 << 21) | c3
+
+    def encode(self, tokens):
+        """
+        :param tokens: a list of tokens
+        :return: a numpy array of trigram ids
+        """
+        return self.encode_batch([tokens])[0]
+
+    def encode_batch(self, token_lists, max_len=None):
+        """
+        Encode a batch of token lists into a zero-padded matrix of trigram ids.
+
+        :param token_lists: a list of lists of tokens
+        :param max_len: the length of the rows, by default the maximum number of trigrams in the batch
+        :return: a numpy array of shape (len(token_lists), max_len)
+        """
+        strings = ["#{}#".format(t) for tokens in token_lists for t in tokens]
+        lengths = np.asarray([len(s) for s in strings], dtype=np.int64)
+        chars = np.frombuffer("".join(strings).encode('utf-32-le'), dtype=np.uint32).astype(np.int64)
+        # Trigrams start at every position of a string except the last two
+        trigrams_per_string = np.maximum(lengths - 2, 0)
+        string_starts = np.cumsum(lengths) - lengths
+        starts = np.repeat(string_starts, trigrams_per_string) + \
+            np.arange(trigrams_per_string.sum()) - np.repeat(np.cumsum(trigrams_per_string) - trigrams_per_string,
+                                                             trigrams_per_string)
+        keys = self._pack(chars[starts], chars[starts + 1], chars[starts + 2])
+        ids = self._lookup(keys)
+
+        list_ids = np.repeat(np.arange(len(token_lists)), [len(tokens) for tokens in token_lists])
+        trigrams_per_list = np.bincount(list_ids, weights=trigrams_per_string,
+                                        minlength=len(token_lists)).astype(np.int64)
+        if max_len is None:
+            max_len = int(trigrams_per_list.max()) if len(trigrams_per_list) > 0 else 0
+        rows = np.repeat(np.arange(len(token_lists)), trigrams_per_list)
+        columns = np.arange(len(ids)) - np.repeat(np.cumsum(trigrams_per_list) - trigrams_per_list, trigrams_per_list)
+        out = np.zeros((len(token_lists), max_len), dtype=np.int32)
+        mask = columns < max_len
+        out[rows[mask], columns[mask]] = ids[mask]
+        return out
+
+    def _lookup(self, keys):
+        if self.trigram2idx is None:
+            hashed = (keys.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(32)
+            return (hashed % np.uint64(self.hash_size - 1)).astype(np.int32) + 1
+        positions = np.minimum(np.searchsorted(self._keys, keys), max(len(self._keys) - 1, 0))
+        found = self._keys[positions] == keys if len(self._keys) > 0 else np.zeros(len(keys), dtype=bool)
+        return np.where(found, self._ids[positions] if len(self._ids) > 0 else 0, self._unknown_idx).astype(np.int32)
+
+
 def get_elements_index(element_set: Set):
     """
     Create an element to index mapping, that includes a zero and an unknown element.
@@ -313,13 +756,15 @@ def load_property_labels(path_to_property_labels):
 @load_resource_file_backoff
 def load_entity_freq_map(path_to_map):
     """
-    Load the map of entity frequencies from a file.
+    Load the map of entity frequencies from a file or from an entity index directory (see entity_index.EntityIndex).
 
-    :param path_to_map: location of the map file
-    :return: entity map as a dictionary
+    :param path_to_map: location of the map file or of the index
+    :return: entity map as a dictionary, or a memory-mapped read-only view for an index
     >>> load_entity_freq_map("../resources/wikidata_entity_freqs.map")['Q76']
     7070
     """
+    if os.path.isdir(path_to_map):
+        return entity_index.EntityFreqMap(entity_index.EntityIndex(path_to_map))
     with open(path_to_map) as f:
         return_map = [tuple(l.strip().split("\t")) for l in f.readlines()]
         return_map = [(k, int(v)) for k, v in return_map]
@@ -329,11 +774,14 @@ def load_entity_freq_map(path_to_map):
 @load_resource_file_backoff
 def load_entity_map(path_to_map):
     """
-    Load the map of entity labels from a file.
+    Load the map of entity labels from a file or from an entity index directory (see entity_index.EntityIndex).
+    The index is memory-mapped and supports the same lookups as well as prefix queries.
 
-    :param path_to_map: location of the map file
-    :return: entity map as an nltk.Index
+    :param path_to_map: location of the map file or of the index
+    :return: entity map as an nltk.Index or an EntityIndex
     """
+    if os.path.isdir(path_to_map):
+        return entity_index.EntityIndex(path_to_map)
     with open(path_to_map) as f:
         return_map = [l.strip().split("\t") for l in f.readlines()]
     return nltk.Index([(t[1], (t[0], t[2])) for t in return_map])
@@ -355,7 +803,9 @@ def load_blacklist(path_to_list):
         return set()
 
 
-corenlp_pos_tagset = load_blacklist(RESOURCES_FOLDER + "/PENN.pos.tagset")
+resources.register("corenlp_pos_tagset", lambda: load_blacklist(RESOURCES_FOLDER + "/PENN.pos.tagset"))
+
+__getattr__ = resources.module_getattr(__name__, {"corenlp_pos_tagset": "corenlp_pos_tagset"})
 
 
 def map_pos(pos):
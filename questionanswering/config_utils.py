@@ -6,7 +6,10 @@ import random
 import numpy as np
 import torch
 
-from questionanswering.grounding import staged_generation
+from questionanswering import _utils
+from questionanswering.grounding import staged_generation, graph_queries
+from questionanswering.grounding.concurrency import AIMDLimiter
+from questionanswering.grounding.hedging import Hedger
 from wikidata import endpoint_access
 
 
@@ -35,6 +38,26 @@ def load_config(config_file_path, seed=-1, gpuid=-1):
 
     if "wikidata" in config:
         endpoint_access.set_backend(config['wikidata']['backend'])
+        if "concurrency" in config['wikidata']:
+            concurrency_config = config['wikidata']['concurrency']
+            graph_queries.KB_LIMITER = AIMDLimiter(initial_limit=concurrency_config.get('initial', 4),
+                                                   min_limit=concurrency_config.get('min', 1),
+                                                   max_limit=concurrency_config.get('max', 32),
+                                                   backoff_ratio=concurrency_config.get('backoff', 0.7),
+                                                   latency_tolerance=concurrency_config.get('latency.tolerance', 2.0))
+        if "hedging" in config['wikidata']:
+            hedging_config = config['wikidata']['hedging']
+            graph_queries.KB_HEDGER = Hedger(percentile=hedging_config.get('percentile', 95),
+                                             max_hedge_ratio=hedging_config.get('max.ratio', 0.1))
+        graph_queries.VERIFY_TIMEOUT = config['wikidata'].get('verify.timeout', graph_queries.VERIFY_TIMEOUT)
+
+    if "tagging" in config:
+        tagging_config = config['tagging']
+        _utils.TAGGER_BACKEND = tagging_config.get('backend', _utils.TAGGER_BACKEND)
+        _utils.CORENLP_URL = tagging_config.get('corenlp', _utils.CORENLP_URL)
+        if 'cache' in tagging_config:
+            _utils.annotation_cache = _utils.AnnotationCache(tagging_config['cache'],
+                                                             annotator_version=str(tagging_config.get('annotator.version', "")))
 
     if torch.cuda.is_available():
         logger.info("Using your CUDA device")
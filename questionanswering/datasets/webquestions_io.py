@@ -7,12 +7,12 @@ from typing import List, Dict
 import numpy as np
 import itertools
 
-from wikidata import scheme
-
-from questionanswering import base_objects
+from questionanswering import base_objects, resources
 from questionanswering.construction import graph
 from questionanswering.datasets.dataset import Dataset
 
+scheme = resources.lazy_import("wikidata.scheme")
+
 
 class DatasetWithoutNegatives(Dataset, metaclass=abc.ABCMeta):
 
@@ -0,0 +1,248 @@
+# Memory-mapped index of entity labels and entity frequencies
+import bisect
+import logging
+import os
+
+import click
+import numpy as np
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.ERROR)
+
+# 0xff never occurs in UTF-8, every label that starts with a prefix sorts before prefix + PREFIX_END
+PREFIX_END = b"\xff"
+# The frequency of the entities that are in the entity map but not in the entity frequency map
+NO_FREQ = -1
+
+
+class StringArray:
+
+    def __init__(self, blob, offsets):
+        """
+        An immutable array of strings stored as one byte blob and an array of offsets. If the strings are sorted,
+        the array can be searched with the bisect module. Items are returned as bytes.
+
+        :param blob: a numpy array of uint8 with the concatenated UTF-8 encoded strings
+        :param offsets: a numpy array of length + 1 offsets into the blob
+        >>> a = StringArray.from_strings(["berlin", "bern", "ber"])
+        >>> len(a), a[1], a.get_str(2)
+        (3, b'bern', 'ber')
+        """
+        self.blob = blob
+        self.offsets = offsets
+
+    @staticmethod
+    def from_strings(strings):
+        encoded = [s.encode('utf-8') for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(s) for s in encoded])
+        return StringArray(np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets)
+
+    @staticmethod
+    def load(path_prefix, mmap_mode='r'):
+        return StringArray(np.load(path_prefix + ".blob.npy", mmap_mode=mmap_mode),
+                           np.load(path_prefix + ".offsets.npy", mmap_mode=mmap_mode))
+
+    def save(self, path_prefix):
+        np.save(path_prefix + ".blob.npy", self.blob)
+        np.save(path_prefix + ".offsets.npy", self.offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].tobytes()
+
+    def get_str(self, i):
+        return self[i].decode('utf-8')
+
+    def find(self, s):
+        """
+        Find the position of the string in a sorted array.
+
+        :param s: a string
+        :return: the position or -1 if the string is not in the array
+        """
+        s = s.encode('utf-8')
+        i = bisect.bisect_left(self, s)
+        return i if i < len(self) and self[i] == s else -1
+
+    def prefix_range(self, prefix):
+        """
+        :param prefix: a string
+        :return: (start, end) positions of the strings with the given prefix in a sorted array
+        """
+        prefix = prefix.encode('utf-8')
+        return bisect.bisect_left(self, prefix), bisect.bisect_left(self, prefix + PREFIX_END)
+
+
+class EntityIndex:
+
+    def __init__(self, path_to_index):
+        """
+        An on-disk index of entity labels and entity frequencies. All arrays are memory-mapped, so opening the index
+        is instant and the processes that use the same index share the pages.
+        Use EntityIndex.build to create the index from the map files.
+
+        :param path_to_index: the directory of the index
+        """
+        self.path_to_index = path_to_index
+        path = os.path.join(path_to_index, "")
+        self._labels = StringArray.load(path + "labels")
+        self._label2entries = np.load(path + "label2entries.npy", mmap_mode='r')
+        self._entry_entities = np.load(path + "entry_entities.npy", mmap_mode='r')
+        self._entry_info = StringArray.load(path + "entry_info")
+        self._entities = StringArray.load(path + "entities")
+        self._entity_freqs = np.load(path + "entity_freqs.npy", mmap_mode='r')
+        logger.debug("Opened the entity index with {} labels and {} entities".format(len(self._labels),
+                                                                                     len(self._entities)))
+
+    @staticmethod
+    def build(path_to_map, path_to_index, path_to_freq_map=None):
+        """
+        Build the index from the entity map (one "entity id, label, info" triple per line, tab separated) and
+        the optional entity frequency map (one "entity id, frequency" pair per line, tab separated).
+
+        :param path_to_map: location of the entity map file
+        :param path_to_index: the directory to save the index to
+        :param path_to_freq_map: location of the entity frequency map file
+        :return: the opened index
+        """
+        entity2freq = {}
+        if path_to_freq_map:
+            with open(path_to_freq_map) as f:
+                for l in f:
+                    columns = l.strip().split("\t")
+                    if len(columns) == 2:
+                        entity2freq[columns[0]] = int(columns[1])
+        entries = []
+        with open(path_to_map) as f:
+            for l in f:
+                columns = l.strip().split("\t")
+                if len(columns) >= 3:
+                    entries.append((columns[1], columns[0], columns[2]))
+        # The sort is stable, the entities of each label keep the order of the file
+        entries.sort(key=lambda e: e[0].encode('utf-8'))
+        entities = sorted(set(entity2freq) | {e for _, e, _ in entries}, key=lambda e: e.encode('utf-8'))
+        entity2id = {e: i for i, e in enumerate(entities)}
+
+        labels = []
+        label2entries = []
+        for i, (label, _, _) in enumerate(entries):
+            if not labels or labels[-1] != label:
+                labels.append(label)
+                label2entries.append(i)
+        label2entries.append(len(entries))
+
+        os.makedirs(path_to_index, exist_ok=True)
+        path = os.path.join(path_to_index, "")
+        StringArray.from_strings(labels).save(path + "labels")
+        np.save(path + "label2entries.npy", np.asarray(label2entries, dtype=np.int64))
+        np.save(path + "entry_entities.npy", np.asarray([entity2id[e] for _, e, _ in entries], dtype=np.int64))
+        StringArray.from_strings([info for _, _, info in entries]).save(path + "entry_info")
+        StringArray.from_strings(entities).save(path + "entities")
+        np.save(path + "entity_freqs.npy", np.asarray([entity2freq.get(e, NO_FREQ) for e in entities], dtype=np.int64))
+        logger.debug("Saved the entity index with {} labels to {}".format(len(labels), path_to_index))
+        return EntityIndex(path_to_index)
+
+    def __len__(self):
+        return len(self._labels)
+
+    def __contains__(self, label):
+        return self._labels.find(label) >= 0
+
+    def __getitem__(self, label):
+        """
+        Same as indexing the nltk.Index returned by _utils.load_entity_map.
+
+        :param label: an entity label
+        :return: a list of (entity id, info) tuples, empty if the label is not in the index
+        """
+        return [(e, info) for e, info, _ in self._entries(self._labels.find(label))]
+
+    def get(self, label, default=None):
+        entries = self[label]
+        return entries if entries else default
+
+    def get_with_freqs(self, label):
+        """
+        :param label: an entity label
+        :return: a list of (entity id, info, frequency) tuples, the frequency is 0 if the entity has none
+        """
+        return list(self._entries(self._labels.find(label)))
+
+    def prefix(self, prefix, limit=None):
+        """
+        Find all labels that start with the given prefix.
+
+        :param prefix: a string
+        :param limit: the maximum number of labels to return
+        :return: a list of (label, list of (entity id, info, frequency) tuples) sorted by the label
+        """
+        start, end = self._labels.prefix_range(prefix)
+        if limit is not None:
+            end = min(end, start + limit)
+        return [(self._labels.get_str(i), list(self._entries(i))) for i in range(start, end)]
+
+    def entity_freq(self, entity_id, default=0):
+        """
+        :param entity_id: an entity id
+        :return: the frequency of the entity, same as in _utils.load_entity_freq_map, or the default if the entity
+                 is not in the entity frequency map
+        """
+        i = self._entities.find(entity_id)
+        freq = int(self._entity_freqs[i]) if i >= 0 else NO_FREQ
+        return freq if freq != NO_FREQ else default
+
+    def _entries(self, label_id):
+        if label_id < 0:
+            return
+        for j in range(self._label2entries[label_id], self._label2entries[label_id + 1]):
+            entity_id = self._entry_entities[j]
+            yield self._entities.get_str(entity_id), self._entry_info.get_str(j), max(int(self._entity_freqs[entity_id]), 0)
+
+
+class EntityFreqMap:
+
+    def __init__(self, entity_index):
+        """
+        A read-only dictionary view of the entity frequencies in the index. Only the entities of the entity frequency
+        map are in the view, same as in the dictionary loaded from the map file.
+
+        :param entity_index: an EntityIndex
+        """
+        self._index = entity_index
+        self._size = None
+
+    def __getitem__(self, entity_id):
+        freq = self._index.entity_freq(entity_id, NO_FREQ)
+        if freq == NO_FREQ:
+            raise KeyError(entity_id)
+        return freq
+
+    def __contains__(self, entity_id):
+        return self._index.entity_freq(entity_id, NO_FREQ) != NO_FREQ
+
+    def __len__(self):
+        if self._size is None:
+            self._size = int(np.count_nonzero(self._index._entity_freqs != NO_FREQ))
+        return self._size
+
+    def get(self, entity_id, default=None):
+        return self._index.entity_freq(entity_id, default)
+
+
+@click.command()
+@click.argument('path_to_map')
+@click.argument('path_to_index')
+@click.argument('path_to_freq_map', default="")
+def build(path_to_map, path_to_index, path_to_freq_map):
+    """
+    Build the entity index from the entity map and the entity frequency map.
+    """
+    index = EntityIndex.build(path_to_map, path_to_index, path_to_freq_map)
+    print(f"Saved the index with {len(index)} labels to {path_to_index}")
+
+
+if __name__ == "__main__":
+    build()
@@ -41,6 +41,7 @@ def generate(path_to_model, config_file_path, seed, gpuid, experiment_tag):
     # Load the entity linker if specified, otherwise the entity annotations in the data set will be used
     entitylinker = None
     if 'entity.linking' in config:
+        # The questionanswering package adds its own PATH_EL to sys.path as well
         PATH_EL = "../../entity-linking/"
         sys.path.insert(0, PATH_EL)
         from entitylinking import core
@@ -51,7 +52,8 @@ def generate(path_to_model, config_file_path, seed, gpuid, experiment_tag):
 
     # Load the GloVe word embeddings and embeddings for special tokens
     _, word2idx = V.extend_embeddings_with_special_tokens(
-        *_utils.load_word_embeddings(_utils.RESOURCES_FOLDER + "../../resources/embeddings/glove/glove.6B.100d.txt")
+        *_utils.load_word_embeddings(config.get('global', {}).get(
+            "word.embeddings", _utils.RESOURCES_FOLDER + "../../resources/embeddings/glove/glove.6B.100d.txt"))
     )
     # Set the global mapping for words to indices
     V.WORD_2_IDX = word2idx
@@ -91,6 +93,14 @@ def generate(path_to_model, config_file_path, seed, gpuid, experiment_tag):
     graph_queries.FREQ_THRESHOLD = config['evaluation'].get("min.relation.freq", 500)
     global_answers = []
     avg_metrics = np.zeros(4)
+    cut_short = 0
+
+    # Tag all questions at once if the entity annotations from the data set are used
+    tagged_questions = None
+    if not entitylinker:
+        questions = [q_obj.get('utterance', q_obj.get('question')) for q_obj in webquestions_questions]
+        tagged_questions = _utils.get_tagged_from_server_batch(questions, caseless=[q.islower() for q in questions],
+                                                               workers=config['evaluation'].get("tagging.workers", 1))
 
     # Iterate over the questions in the dataset
     data_iterator = tqdm.tqdm(webquestions_questions, ncols=100, ascii=True)
@@ -104,12 +114,22 @@ def generate(path_to_model, config_file_path, seed, gpuid, experiment_tag):
                 sent.entities = sent.entities[:config['evaluation']["max.num.entities"]]
             sent = sentence.Sentence(input_text=sent.input_text, tagged=sent.tagged, entities=sent.entities)
         else:
-            tagged = _utils.get_tagged_from_server(q, caseless=q.islower())
-            sent = sentence.Sentence(input_text=q, tagged=tagged, entities=q_obj['entities'])
-
-        chosen_graphs = staged_generation.generate_with_model(sent,
-                                                              container,
-                                                              beam_size=config['evaluation'].get("beam.size", 10))
+            sent = sentence.Sentence(input_text=q, tagged=tagged_questions[i], entities=q_obj['entities'])
+
+        budget = None
+        if "time.budget" in config['evaluation'] or "kb.calls.budget" in config['evaluation']:
+            budget = staged_generation.SearchBudget(time_limit=config['evaluation'].get("time.budget"),
+                                                    kb_calls_limit=config['evaluation'].get("kb.calls.budget"))
+        with graph_queries.KB_LIMITER.scope(q_index):
+            chosen_graphs = staged_generation.generate_with_model(sent,
+                                                                  container,
+                                                                  beam_size=config['evaluation'].get("beam.size", 10),
+                                                                  budget=budget,
+                                                                  beam_margin=config['evaluation'].get("beam.margin"),
+                                                                  stop_margin=config['evaluation'].get("beam.stop.margin"))
+        search_cut_short = budget is not None and budget.cut_short
+        if search_cut_short:
+            cut_short += 1
         model_answers = []
         g = ({},)
         j = -1
@@ -129,13 +149,14 @@ def generate(path_to_model, config_file_path, seed, gpuid, experiment_tag):
 
         gold_answers = webquestions_io.get_answers_from_question(q_obj)
         metrics = evaluation.retrieval_prec_rec_f1(gold_answers, model_answers)
+        # The last element marks the answers of the searches that were cut short by the budget
         global_answers.append((q_index, list(metrics), model_answers,
-                               [(c_g.graph, float(c_g.scores[2])) for c_g in chosen_graphs[:10]]))
+                               [(c_g.graph, float(c_g.scores[2])) for c_g in chosen_graphs[:10]], search_cut_short))
         avg_metrics += metrics + (j,)
         precision, recall, f1, g_j = tuple(avg_metrics/(i+1))
         data_iterator.set_postfix(prec=precision,
                                   rec=recall,
-                                  f1=f1, g_j=g_j)
+                                  f1=f1, g_j=g_j, cut=cut_short)
 
         # Save intermediate results
         if i > 0 and i % 100 == 0:
@@ -144,6 +165,8 @@ def generate(path_to_model, config_file_path, seed, gpuid, experiment_tag):
 
     avg_metrics = avg_metrics / (len(webquestions_questions))
     print("Average metrics: {}".format(avg_metrics))
+    if cut_short:
+        print(f"Search cut short by the budget: {cut_short}/{len(webquestions_questions)}")
 
     # Fine-grained results, if there is a mapping of questions to the number of relation to find the correct answer
     results_by_hops = {}
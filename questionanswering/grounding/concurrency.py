@@ -0,0 +1,137 @@
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.ERROR)
+
+
+class AIMDLimiter:
+
+    def __init__(self,
+                 initial_limit=4,
+                 min_limit=1,
+                 max_limit=32,
+                 backoff_ratio=0.7,
+                 latency_tolerance=2.0,
+                 baseline_decay=0.01):
+        """
+        A client-side concurrency controller for the knowledge base endpoint.
+
+        The number of in-flight requests follows an AIMD rule: every request that comes back faster than
+        latency_tolerance times the baseline latency grows the limit by 1/limit (about +1 per round trip), a timeout or a
+        slow request shrinks it by backoff_ratio (at most once per round trip). Waiting requests are queued per question
+        and served round-robin, so that a question with many queries can not starve the rest.
+
+        :param initial_limit: number of requests allowed in-flight at the start
+        :param min_limit: lower bound for the limit
+        :param max_limit: upper bound for the limit
+        :param backoff_ratio: multiplicative decrease factor
+        :param latency_tolerance: a request is considered slow if it takes longer than the baseline times this value
+        :param baseline_decay: how fast the baseline latency forgets the old minimum
+        >>> limiter = AIMDLimiter(initial_limit=2)
+        >>> with limiter.slot("q1"): limiter.in_flight
+        1
+        >>> limiter.in_flight
+        0
+        """
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff_ratio = backoff_ratio
+        self.latency_tolerance = latency_tolerance
+        self.baseline_decay = baseline_decay
+
+        self.in_flight = 0
+        self.baseline_latency = None
+        self._last_backoff = 0.0
+
+        self._lock = threading.Lock()
+        self._queues = OrderedDict()  # question key -> deque of waiting events
+        self._local = threading.local()
+
+    @contextmanager
+    def scope(self, key):
+        """
+        Assign all requests made from the current thread inside the block to the given question.
+
+        :param key: a question identifier
+        """
+        previous = getattr(self._local, 'key', None)
+        self._local.key = key
+        try:
+            yield
+        finally:
+            self._local.key = previous
+
+    def current_key(self):
+        key = getattr(self._local, 'key', None)
+        return key if key is not None else threading.get_ident()
+
+    def acquire(self, key=None):
+        """
+        Block until a request slot is available for the given question.
+
+        :param key: a question identifier, if None the key of the current scope is used
+        """
+        if key is None:
+            key = self.current_key()
+        granted = threading.Event()
+        with self._lock:
+            self._queues.setdefault(key, deque()).append(granted)
+            self._dispatch()
+        granted.wait()
+
+    def release(self, latency, failed=False):
+        """
+        Free a request slot and adjust the limit given the outcome of the request.
+
+        :param latency: time in seconds that the request took
+        :param failed: True if the request timed out or failed
+        """
+        with self._lock:
+            self.in_flight -= 1
+            if not failed:
+                if self.baseline_latency is None or latency < self.baseline_latency:
+                    self.baseline_latency = latency
+                else:
+                    self.baseline_latency += self.baseline_decay * (latency - self.baseline_latency)
+            if failed or latency > self.baseline_latency * self.latency_tolerance:
+                now = time.monotonic()
+                # Back off at most once per round trip, otherwise a burst of slow requests collapses the limit
+                if now - self._last_backoff > (self.baseline_latency or latency):
+                    self.limit = max(self.min_limit, self.limit * self.backoff_ratio)
+                    self._last_backoff = now
+                    logger.debug("Concurrency limit decreased to {:.2f}".format(self.limit))
+            else:
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            self._dispatch()
+
+    @contextmanager
+    def slot(self, key=None):
+        """
+        Hold a request slot for the duration of the block. Exceptions raised inside the block count as failures.
+
+        :param key: a question identifier
+        :return: a dictionary, set its 'failed' value to mark a failed request without raising
+        """
+        self.acquire(key)
+        outcome = {'failed': False}
+        start = time.monotonic()
+        try:
+            yield outcome
+        except Exception:
+            outcome['failed'] = True
+            raise
+        finally:
+            self.release(time.monotonic() - start, failed=outcome['failed'])
+
+    def _dispatch(self):
+        while self._queues and self.in_flight < int(self.limit):
+            key, waiting = self._queues.popitem(last=False)
+            waiting.popleft().set()
+            self.in_flight += 1
+            if waiting:
+                self._queues[key] = waiting
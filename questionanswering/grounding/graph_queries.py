@@ -1,13 +1,17 @@
 import logging
 import re
 import itertools
+import threading
 
 
-from wikidata import scheme, endpoint_access, queries
+from wikidata import endpoint_access, queries
 
 from questionanswering.construction import graph, sentence
 from questionanswering.construction.graph import SemanticGraph, Edge
+from questionanswering import resources
 from questionanswering._utils import RESOURCES_FOLDER, load_blacklist
+from questionanswering.grounding.concurrency import AIMDLimiter
+from questionanswering.grounding.hedging import Hedger
 
 QUESTION_VAR = "?qvar"
 
@@ -57,11 +61,15 @@ sparql_filter_main_entity = """
         FILTER(STRSTARTS(?e1s, "http://www.wikidata.org/entity/Q") && !CONTAINS(?e1s, "-"))
         """
 
-HOP_UP_RELATIONS = load_blacklist(RESOURCES_FOLDER + "property_hopup.txt")
-HOP_DOWN_RELATIONS = load_blacklist(RESOURCES_FOLDER + "property_hopdown.txt")
+scheme = resources.lazy_import("wikidata.scheme")
+
+# The relation lists and the scheme tables are loaded on the first access, see resources
+resources.register("hop_up_relations", lambda: load_blacklist(RESOURCES_FOLDER + "property_hopup.txt"))
+resources.register("hop_down_relations", lambda: load_blacklist(RESOURCES_FOLDER + "property_hopdown.txt"))
 TRANSITIVE_RELATIONS = {"P131", "P361"}
 
-LONG_LEG_RELATIONS = HOP_UP_RELATIONS | HOP_DOWN_RELATIONS | TRANSITIVE_RELATIONS
+resources.register("long_leg_relations", lambda: resources.get("hop_up_relations")
+                   | resources.get("hop_down_relations") | TRANSITIVE_RELATIONS)
 
 TEMPORAL_RELATIONS_Q = {"P585q", "P580q", "P582q", "P577q", "P571q"}
 # TEMPORAL_RELATIONS_V = {"P580v", "P582v", "P577v", "P571v", "P569v", "P570v"}
@@ -69,10 +77,57 @@ QUALIFIER_RELATIONS = {"P1365q", "P812q", "P453q", "P175q"}
 EXCEPTION_RELATIONS = QUALIFIER_RELATIONS | {"P281v"}
 
 BLACK_LIST = {"P138", "P2348", "P530", "P279", "P180", "P669", "P197"}
-CONTENT_PROPERTIES = scheme.content_properties - BLACK_LIST
+resources.register("content_properties", lambda: scheme.content_properties - BLACK_LIST)
+
+__getattr__ = resources.module_getattr(__name__, {"HOP_UP_RELATIONS": "hop_up_relations",
+                                                  "HOP_DOWN_RELATIONS": "hop_down_relations",
+                                                  "LONG_LEG_RELATIONS": "long_leg_relations",
+                                                  "CONTENT_PROPERTIES": "content_properties"})
 
 FREQ_THRESHOLD = 500
 
+# All queries to the knowledge base go through this limiter, use KB_LIMITER.scope(question_id) to queue fairly
+KB_LIMITER = AIMDLimiter()
+# Slow grounding queries are duplicated after an adaptive delay
+KB_HEDGER = Hedger()
+VERIFY_TIMEOUT = 1
+
+_kb_calls = threading.local()
+
+
+def kb_calls_count():
+    """
+    :return: number of queries sent to the knowledge base from the current thread
+    """
+    return getattr(_kb_calls, 'count', 0)
+
+
+def query_wikidata(query, hedged=False, timeout=None, **kwargs):
+    """
+    Send the query to the knowledge base respecting the concurrency limit. A None result (the endpoint reports
+    exceptions and timeouts this way) reduces the number of allowed in-flight requests.
+
+    :param query: a SPARQL query as a string
+    :param hedged: send a duplicate request if the query is slower than usual and take the first answer
+    :param timeout: optional timeout of the query in seconds, the default timeout of the endpoint access if not given
+    :param kwargs: passed on to the endpoint access
+    :return: the query results or None if there was an exception
+    """
+    _kb_calls.count = kb_calls_count() + 1
+    if timeout is not None:
+        kwargs['timeout'] = timeout
+    if hedged:
+        key = KB_LIMITER.current_key()
+        return KB_HEDGER.run(lambda: _query_wikidata_with_limit(query, key, **kwargs), timeout=timeout)
+    return _query_wikidata_with_limit(query, **kwargs)
+
+
+def _query_wikidata_with_limit(query, key=None, **kwargs):
+    with KB_LIMITER.slot(key) as outcome:
+        results = endpoint_access.query_wikidata(query, **kwargs)
+        outcome['failed'] = results is None
+    return results
+
 
 def filter_relations(results, b='p', freq_threshold=0):
     """
@@ -86,7 +141,7 @@ def filter_relations(results, b='p', freq_threshold=0):
     """
     results = [r for r in results if b not in r or
                (r[b] in EXCEPTION_RELATIONS or
-                (r[b][:-1] in CONTENT_PROPERTIES and r[b][-1] not in endpoint_access.FILTER_RELATION_CLASSES))
+                (r[b][:-1] in resources.get("content_properties") and r[b][-1] not in endpoint_access.FILTER_RELATION_CLASSES))
                ]
     results = [r for r in results if b not in r or scheme.property2label[r[b][:-1]]['freq'] > freq_threshold]
     return results
@@ -113,13 +168,14 @@ def get_all_groundings(g: SemanticGraph):
     return groundings
 
 
-def get_graph_groundings(g: SemanticGraph, pass_exception=False, use_wikidata=True):
+def get_graph_groundings(g: SemanticGraph, pass_exception=False, use_wikidata=True, timeout=None):
     """
     Convert the given graph to a WikiData query and retrieve the results. The results contain possible bindings
     for all free variables in the graph. If there are no free variables a single empty grounding is returned.
 
     :param g: graph as a dictionary
     :param pass_exception:
+    :param timeout: optional timeout of the knowledge base queries in seconds
     :return: graph groundings encoded as a list of dictionaries
     >>> get_graph_groundings(SemanticGraph([Edge(leftentityid=QUESTION_VAR, rightentityid='Q571', qualifierentityid='MAX')]))
     [{'r0v': 'P31v'}, {'r0v': 'P800v'}]
@@ -135,7 +191,7 @@ def get_graph_groundings(g: SemanticGraph, pass_exception=False, use_wikidata=Tr
                       for e in g.edges if e.leftentityid != QUESTION_VAR]):
                 return [{'r1v': 'P31c', 'topic': "Q577"}]
         if use_wikidata:
-            groundings = endpoint_access.query_wikidata(graph_to_query(g, limit=500))
+            groundings = query_wikidata(graph_to_query(g, limit=500), hedged=True, timeout=timeout)
         else:
             groundings = get_all_groundings(g)
         if groundings is None:  # If there was an exception
@@ -152,17 +208,18 @@ def get_graph_groundings(g: SemanticGraph, pass_exception=False, use_wikidata=Tr
                                                for e in ungrouded_edges if f"r{e.edgeid:d}v" in r]), reverse=True)
         return groundings
     else:
-        if verify_grounding(g) or not use_wikidata:
+        if verify_grounding(g, timeout=timeout) or not use_wikidata:
             return [{}]
         else:
             return []
 
 
-def verify_grounding(g: SemanticGraph):
+def verify_grounding(g: SemanticGraph, timeout=None):
     """
     Verify the given graph with (partial) grounding exists in Wikidata.
 
     :param g: graph as a dictionary
+    :param timeout: optional timeout of the query in seconds, at most VERIFY_TIMEOUT
     :return: true if the graph exists, false otherwise
     >>> verify_grounding(SemanticGraph([Edge(leftentityid=QUESTION_VAR, rightentityid="Q76")]))
     True
@@ -173,7 +230,10 @@ def verify_grounding(g: SemanticGraph):
             any([scheme.property2label.get(edge.relationid, {}).get("type") == "time"
                  for edge in g.edges if edge.leftentityid != QUESTION_VAR]):
         return False
-    verified = endpoint_access.query_wikidata(graph_to_ask(g), timeout=1)
+    verified = query_wikidata(graph_to_ask(g), hedged=True,
+                              timeout=VERIFY_TIMEOUT if timeout is None else min(VERIFY_TIMEOUT, timeout))
+    if verified is None:
+        logger.warning("Verification failed for all attempts, treating as not grounded: {}".format(g))
     if verified == []:
         return False
     return verified
@@ -193,7 +253,7 @@ def get_graph_denotations(g: SemanticGraph):
     """
     qvar_name = QUESTION_VAR[1:]
     if "zip" in g.tokens and any(e.relationid == "P281" for e in g.edges):
-        denotations = endpoint_access.query_wikidata(graph_to_query(g, limit=100))
+        denotations = query_wikidata(graph_to_query(g, limit=100))
         denotations = [r for r in denotations if any('x' not in r[b] for b in r)]  # Post process zip codes
         post_processed = []
         for r in denotations:
@@ -205,7 +265,7 @@ def get_graph_denotations(g: SemanticGraph):
                     post_processed.append(p)
         return post_processed
     edges = [e for e in g.edges if e.rightentityid != "Q5"]  # filter out edges with human as argument since they often fail
-    denotations = endpoint_access.query_wikidata(graph_to_query(SemanticGraph(edges=edges), limit=100))
+    denotations = query_wikidata(graph_to_query(SemanticGraph(edges=edges), limit=100))
     if denotations and all('step' in d for d in denotations):
         min_transitive_steps = min([d['step'] for d in denotations])
         denotations = [d for d in denotations if d['step'] == min_transitive_steps]
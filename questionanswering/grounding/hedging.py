@@ -0,0 +1,107 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent import futures
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.ERROR)
+
+
+class Hedger:
+
+    def __init__(self,
+                 percentile=95,
+                 initial_delay=0.2,
+                 min_delay=0.01,
+                 max_hedge_ratio=0.1,
+                 window_size=1000,
+                 min_observations=20,
+                 max_workers=16):
+        """
+        Hedged execution of knowledge base requests. If a request hasn't returned after the given latency percentile of
+        the recently observed requests, a duplicate is sent over a new connection and the first answer is taken.
+        The share of duplicated requests is capped with a token bucket that collects max_hedge_ratio tokens per request.
+
+        :param percentile: latency percentile after which a duplicate request is sent
+        :param initial_delay: hedging delay in seconds to use until enough latencies are observed
+        :param min_delay: lower bound for the hedging delay in seconds
+        :param max_hedge_ratio: maximum share of requests that can be duplicated
+        :param window_size: number of recent latencies to use
+        :param min_observations: number of latencies that have to be observed before the percentile is used
+        :param max_workers: number of threads to run the requests
+        >>> hedger = Hedger()
+        >>> hedger.run(lambda: [{}])
+        [{}]
+        >>> hedger.hedge_delay()
+        0.2
+        """
+        self.percentile = percentile
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.max_hedge_ratio = max_hedge_ratio
+        self.min_observations = min_observations
+
+        self.requests = 0
+        self.hedges = 0
+        self.failures = 0
+
+        self._latencies = deque(maxlen=window_size)
+        self._tokens = 1.0
+        self._lock = threading.Lock()
+        self._executor = futures.ThreadPoolExecutor(max_workers=max_workers)
+
+    def hedge_delay(self):
+        """
+        :return: time in seconds to wait for a request before sending a duplicate
+        """
+        with self._lock:
+            if len(self._latencies) < self.min_observations:
+                return self.initial_delay
+            return max(self.min_delay, float(np.percentile(self._latencies, self.percentile)))
+
+    def run(self, request, timeout=None):
+        """
+        Execute the request with hedging. The latency of failed requests is observed as well, they are the slow tail.
+
+        :param request: a function without arguments that sends the request, it should return None on failure
+        :param timeout: the timeout of the request in seconds if known, the observed latencies are capped at it
+        :return: the first successful result or None if all attempts failed
+        """
+        with self._lock:
+            self.requests += 1
+            self._tokens = min(1.0, self._tokens + self.max_hedge_ratio)
+        start = time.monotonic()
+        attempts = [self._executor.submit(request)]
+        done, _ = futures.wait(attempts, timeout=self.hedge_delay())
+        if not done and self._take_token():
+            logger.debug("Sending a hedged request")
+            attempts.append(self._executor.submit(request))
+        pending = set(attempts)
+        result = None
+        while pending and result is None:
+            done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+            for attempt in done:
+                try:
+                    result = attempt.result()
+                except Exception as ex:
+                    logger.error("Request failed. {}".format(ex))
+                if result is not None:
+                    break
+        # Losing attempts are left to finish in the background
+        elapsed = time.monotonic() - start
+        with self._lock:
+            if result is None:
+                self.failures += 1
+            self._latencies.append(min(elapsed, timeout) if timeout is not None else elapsed)
+        return result
+
+    def _take_token(self):
+        with self._lock:
+            if self._tokens >= 1.0:
+                self._tokens -= 1.0
+                self.hedges += 1
+                return True
+        return False
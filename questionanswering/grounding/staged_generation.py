@@ -1,13 +1,15 @@
 import logging
+import time
+from collections import namedtuple
 from copy import copy
 from typing import List
 
 from questionanswering.construction.graph import WithScore
 from questionanswering.construction import graph
 from questionanswering.construction.graph import SemanticGraph, Edge
-from questionanswering.construction import sentence
 from questionanswering.datasets import evaluation
 from questionanswering.grounding import graph_queries, stages
+from questionanswering import models
 from questionanswering.models import vectorization as V
 
 MIN_F_SCORE_TO_STOP = 0.9
@@ -17,6 +19,58 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.ERROR)
 
 
+class SearchBudget:
+
+    def __init__(self, time_limit=None, kb_calls_limit=None):
+        """
+        A per-question budget for the graph search. The budget is started at creation time and only counts the
+        knowledge base queries sent from the current thread. The remaining time is the timeout of each query, so that
+        a single slow query can't run past the time limit.
+
+        :param time_limit: wall-clock limit in seconds
+        :param kb_calls_limit: maximum number of queries to the knowledge base
+        >>> SearchBudget().exhausted()
+        False
+        >>> b = SearchBudget(kb_calls_limit=0)
+        >>> b.exhausted(), b.cut_short
+        (True, True)
+        """
+        self.time_limit = time_limit
+        self.kb_calls_limit = kb_calls_limit
+        self.cut_short = False
+        self._start_time = time.monotonic()
+        self._start_kb_calls = graph_queries.kb_calls_count()
+
+    def elapsed(self):
+        return time.monotonic() - self._start_time
+
+    def kb_calls(self):
+        return graph_queries.kb_calls_count() - self._start_kb_calls
+
+    def remaining(self):
+        """
+        :return: the time left in seconds or None if there is no time limit
+        >>> SearchBudget().remaining() is None
+        True
+        >>> SearchBudget(time_limit=0).remaining()
+        0.0
+        """
+        if self.time_limit is None:
+            return None
+        return max(0.0, self.time_limit - self.elapsed())
+
+    def exhausted(self):
+        """
+        Check the budget, once it is exhausted the result of the search is marked as cut short.
+
+        :return: True if there is no time or knowledge base queries left
+        """
+        if (self.time_limit is not None and self.elapsed() >= self.time_limit) or \
+                (self.kb_calls_limit is not None and self.kb_calls() >= self.kb_calls_limit):
+            self.cut_short = True
+        return self.cut_short
+
+
 def generate_with_gold(graph_with_scores, gold_answers):
     """
     Generate all possible groundings that produce positive f-score starting with the given ungrounded graph and
@@ -125,48 +179,108 @@ def apply_grounding(g: SemanticGraph, grounding) -> SemanticGraph:
     return grounded
 
 
-def ground_with_model(input_graphs, s, qa_model, min_score, beam_size=10, verify_with_wikidata=True):
+def ground_with_model(input_graphs, s, qa_model, min_score, beam_size=10, verify_with_wikidata=True, budget=None,
+                      beam_margin=None, context=None):
     """
 
     :param input_graphs: a list of equivalent graph extensions to choose from.
     :param s: sentence
-    :param qa_model: a model to evaluate graphs
+    :param qa_model: a model to evaluate graphs or a models.GraphScorer that caches the question vectors
     :param min_score: filter out graphs that receive a score lower than that from the model.
     :param beam_size: size of the beam
+    :param budget: optional SearchBudget, no new graphs are grounded once it is exhausted
+    :param beam_margin: if set, the beam size is adapted to the scores, see adaptive_beam_size
+    :param context: optional vectorization.EncodingContext, the graphs are scored in chunks of its maximum number
+                    of graphs, the scorer keeps its own context if qa_model is a models.GraphScorer
     :return: a list of selected graphs with size = beam_size
     """
 
     logger.debug("Input graphs: {}".format(len(input_graphs)))
     logger.debug("First input one: {}".format(input_graphs[:1]))
 
-    grounded_graphs = [apply_grounding(s_g, p) for s_g in input_graphs for p in graph_queries.get_graph_groundings(s_g, use_wikidata=verify_with_wikidata)]
+    grounded_graphs = []
+    for s_g in input_graphs:
+        if budget is not None and budget.exhausted():
+            break
+        timeout = budget.remaining() if budget is not None else None
+        grounded_graphs += [apply_grounding(s_g, p) for p in graph_queries.get_graph_groundings(s_g, use_wikidata=verify_with_wikidata, timeout=timeout)]
     grounded_graphs = filter_second_hops(grounded_graphs)
     logger.debug("Number of possible groundings: {}".format(len(grounded_graphs)))
     if len(grounded_graphs) == 0:
         return []
 
-    sentences = []
-    for i in range(0, len(grounded_graphs), V.MAX_NEGATIVE_GRAPHS):
-        dummy_sentence = sentence.Sentence()
-        dummy_sentence.__dict__.update(s.__dict__)
-        dummy_sentence.graphs = [WithScore(s_g, (0.0, 0.0, min_score)) for s_g in grounded_graphs[i:i+V.MAX_NEGATIVE_GRAPHS]]
-        sentences.append(dummy_sentence)
-    if len(sentences) == 0:
-        return []
-    samples = V.encode_for_model(sentences, qa_model._model.__class__.__name__)
-    model_scores = qa_model.predict_batchwise(*samples).view(-1).data
+    if not isinstance(qa_model, models.GraphScorer):
+        qa_model = models.GraphScorer(qa_model, context=context)
+    model_scores = qa_model.score(s, grounded_graphs)
 
     logger.debug("model_scores: {}".format(model_scores))
-    all_chosen_graphs = [WithScore(grounded_graphs[i], (0.0, 0.0, model_scores[i]))
+    all_chosen_graphs = [WithScore(grounded_graphs[i], (0.0, 0.0, float(model_scores[i])))
                          for i in range(len(grounded_graphs)) if model_scores[i] > min_score]
 
     all_chosen_graphs = sorted(all_chosen_graphs, key=lambda x: x[1], reverse=True)
+    if beam_margin is not None:
+        beam_size = adaptive_beam_size([g.scores[2] for g in all_chosen_graphs], beam_size, beam_margin)
     if len(all_chosen_graphs) > beam_size:
         all_chosen_graphs = all_chosen_graphs[:beam_size]
     logger.debug("Number of chosen groundings: {}".format(len(all_chosen_graphs)))
     return all_chosen_graphs
 
 
+def adaptive_beam_size(scores, beam_size, margin, min_size=1, max_size=None):
+    """
+    Compute the beam size from the model scores: the beam keeps all graphs that are within the margin of the best
+    graph. Thus, the beam shrinks when the best graph is far ahead and widens up to max_size when the scores are close.
+
+    :param scores: model scores sorted in the descending order
+    :param beam_size: the default beam size
+    :param margin: the maximum score difference to the best graph
+    :param min_size: the minimum beam size
+    :param max_size: the maximum beam size, twice the default beam size if not set
+    :return: the beam size
+    >>> adaptive_beam_size([0.9, 0.3, 0.2, 0.1], 3, margin=0.2)
+    1
+    >>> adaptive_beam_size([0.9, 0.85, 0.8, 0.8, 0.8, 0.8, 0.8, 0.1], 3, margin=0.2)
+    6
+    >>> adaptive_beam_size([], 3, margin=0.2)
+    1
+    """
+    if max_size is None:
+        max_size = 2 * beam_size
+    if len(scores) == 0:
+        return min_size
+    within_margin = sum(1 for score in scores if scores[0] - score <= margin)
+    return max(min_size, min(within_margin, max_size))
+
+
+EdgeIndex = namedtuple("EdgeIndex", ['first_order_relations', 'unanchored_relations', 'anchored_without_qvar'])
+
+
+def index_edges(g: SemanticGraph) -> EdgeIndex:
+    """
+    Classify the edges of the graph once: an edge is anchored if it is attached to an entity and it is a first order
+    edge if it is anchored and touches the question variable.
+
+    :param g: a semantic graph
+    :return: relations of the first order edges, relations of the edges without an entity and the number of
+             anchored edges that don't touch the question variable
+    >>> index_edges(SemanticGraph([Edge(leftentityid=graph_queries.QUESTION_VAR, relationid='P26', rightentityid='?m0Q76'), Edge(leftentityid='?m0Q76', relationid='P31', rightentityid='Q76')]))
+    EdgeIndex(first_order_relations=frozenset(), unanchored_relations=frozenset({'P26'}), anchored_without_qvar=1)
+    """
+    first_order_relations, unanchored_relations = set(), set()
+    anchored_without_qvar = 0
+    for e in g.edges:
+        nodes = e.nodes()
+        relations = {r for r in (e.relationid, e.qualifierrelationid) if r}
+        if any(n and n[0] == "Q" for n in nodes):
+            if graph_queries.QUESTION_VAR in nodes:
+                first_order_relations |= relations
+            else:
+                anchored_without_qvar += 1
+        else:
+            unanchored_relations |= relations
+    return EdgeIndex(frozenset(first_order_relations), frozenset(unanchored_relations), anchored_without_qvar)
+
+
 def filter_second_hops(grounded_graphs: List[SemanticGraph]):
     """
     This methods filters out second hop relations that are already present as first hop relations. Relation direction is
@@ -176,17 +290,37 @@ def filter_second_hops(grounded_graphs: List[SemanticGraph]):
     :return: filtered list of grounded graphs
     >>> g = graph.SemanticGraph(free_entities=[{"type":"NNP", "token_ids":[4], "linkings": [("Q158707", None)]}])
     >>> filter_second_hops([apply_grounding(s_g, p) for s_g in stages.add_entity_and_relation(g, leg_length=1) + stages.add_entity_and_relation(g, leg_length=2, fixed_relations=['P26']) for p in graph_queries.get_graph_groundings(s_g)])
+    >>> filter_second_hops([SemanticGraph([Edge(leftentityid=graph_queries.QUESTION_VAR, relationid='P26', rightentityid='Q76')]), \
+    SemanticGraph([Edge(leftentityid=graph_queries.QUESTION_VAR, relationid='P26', rightentityid='?m0Q76'), Edge(leftentityid='?m0Q76', relationid='P31', rightentityid='Q76')]), \
+    SemanticGraph([Edge(leftentityid=graph_queries.QUESTION_VAR, relationid='P31', rightentityid='?m0Q76'), Edge(leftentityid='?m0Q76', relationid='P26', rightentityid='Q76')])])
+    [SemanticGraph([Edge(0, ?qvar-P26->Q76)], 0), SemanticGraph([Edge(0, ?qvar-P31->?m0Q76), Edge(1, ?m0Q76-P26->Q76)], 0)]
     """
-
-    first_order_relations = {r for g in grounded_graphs for e in g.edges for r in {e.relationid, e.qualifierrelationid}
-                             if any(n.startswith("Q") for n in e.nodes() if n) and graph_queries.QUESTION_VAR in e.nodes() and r}
-    grounded_graphs = [g for g in grounded_graphs
-                       if all((e.relationid not in first_order_relations and e.qualifierrelationid not in first_order_relations)
-                              or any(n.startswith("Q") for n in e.nodes() if n) for e in g.edges)]
+    indices = [index_edges(g) for g in grounded_graphs]
+    first_order_relations = frozenset().union(*[index.first_order_relations for index in indices])
+    grounded_graphs = [g for g, index in zip(grounded_graphs, indices)
+                       if index.unanchored_relations.isdisjoint(first_order_relations)]
     return grounded_graphs
 
 
-def generate_with_model(s, qa_model, beam_size=10):
+def generate_with_model(s, qa_model, beam_size=10, budget=None, beam_margin=None, stop_margin=None, context=None):
+    """
+    Beam search over the graph extensions guided by the model scores.
+
+    :param s: sentence
+    :param qa_model: a model to evaluate graphs or a models.GraphScorer, the question is encoded by the model once
+                     per search
+    :param beam_size: size of the beam
+    :param budget: optional SearchBudget. If given, the search runs in the anytime mode: the pool is expanded in the
+                   order of the expected gain per unit cost and the best graphs found so far are returned once the
+                   budget is exhausted, budget.cut_short records if that happened.
+    :param beam_margin: if set, the beam size is adapted to the score margin, see adaptive_beam_size
+    :param stop_margin: if set, the search stops as soon as the best generated graph is expanded and is ahead of all
+                        graphs in the pool by this margin
+    :param context: optional vectorization.EncodingContext with the shape limits of the model input
+    :return: a list of generated graphs sorted by the model score
+    """
+    if not isinstance(qa_model, models.GraphScorer):
+        qa_model = models.GraphScorer(qa_model, context=context)
     pool = [WithScore(s.graphs[0].graph, (0.0, 0.0, 0.0))]  # pool of possible parses
     generated_graphs = []
     iterations = 0
@@ -195,13 +329,15 @@ def generate_with_model(s, qa_model, beam_size=10):
         lambda x: stages.add_entity_and_relation(x, leg_length=1) +
                   stages.add_entity_and_relation(x,
                                                  leg_length=2,
-                                                 fixed_relations=stages.LONG_LEG_RELATIONS),
+                                                 fixed_relations=graph_queries.LONG_LEG_RELATIONS),
         stages.last_edge_numeric_constraint,
         stages.add_relation
     ]
 
-    while pool and iterations < 100:
+    while pool and iterations < 100 and not (budget is not None and budget.exhausted()):
         iterations += 1
+        if budget is not None:
+            pool = _sort_by_gain_per_cost(pool)
         g = pool.pop(0)
         logger.debug("Pool length: {}, Graph: {}".format(len(pool), g))
         master_score = g.scores[2]
@@ -209,12 +345,18 @@ def generate_with_model(s, qa_model, beam_size=10):
         chosen_graphs = []
         while a_i < len(actions) and not chosen_graphs:
             suggested_graphs = actions[a_i](g[0])
-            suggested_graphs = [s_g for s_g in suggested_graphs if sum(1 for e in s_g.edges
-                                if any(n.startswith("Q") for n in e.nodes() if n) and graph_queries.QUESTION_VAR not in e.nodes()) < 2]
-            suggested_graphs = [s_g for s_g in suggested_graphs if graph_queries.verify_grounding(s_g)]
+            suggested_graphs = [s_g for s_g in suggested_graphs if index_edges(s_g).anchored_without_qvar < 2]
+            verified_graphs = []
+            for s_g in suggested_graphs:
+                if budget is not None and budget.exhausted():
+                    break
+                if graph_queries.verify_grounding(s_g, timeout=budget.remaining() if budget is not None else None):
+                    verified_graphs.append(s_g)
+            suggested_graphs = verified_graphs
             logger.debug("Suggested graphs:{}, {}".format(len(suggested_graphs), suggested_graphs))
             chosen_graphs += ground_with_model(suggested_graphs, s, qa_model, min_score=master_score,
-                                               beam_size=beam_size, verify_with_wikidata=True)
+                                               beam_size=beam_size, verify_with_wikidata=True, budget=budget,
+                                               beam_margin=beam_margin, context=context)
             a_i += 1
 
         logger.debug("Chosen graphs length: {}".format(len(chosen_graphs)))
@@ -223,12 +365,45 @@ def generate_with_model(s, qa_model, beam_size=10):
             pool.extend(chosen_graphs)
             logger.debug("Extending the generated graph set: {}".format(len(chosen_graphs)))
             generated_graphs.extend(chosen_graphs)
+        if stop_margin is not None and pool and generated_graphs and \
+                max(x.scores[2] for x in generated_graphs) - max(x.scores[2] for x in pool) >= stop_margin:
+            logger.debug("Confident early stop.")
+            break
     logger.debug("Iterations {}".format(iterations))
     logger.debug("Generated graphs {}".format(len(generated_graphs)))
+    if budget is not None and budget.cut_short:
+        logger.debug("Search cut short after {:.2f}s and {} KB calls".format(budget.elapsed(), budget.kb_calls()))
     generated_graphs = sorted(generated_graphs, key=lambda x: x[1], reverse=True)
     return generated_graphs
 
 
+def _expansion_cost(g: SemanticGraph):
+    """
+    Estimate the number of knowledge base queries needed to expand the graph: each linking of a free entity produces
+    a set of graphs that have to be verified and grounded.
+
+    :param g: a semantic graph
+    :return: estimated cost as a positive number
+    >>> _expansion_cost(SemanticGraph(free_entities=[{'linkings':[("Q37876", "Natalie Portman"), ("Q872356", "Portman")]}]))
+    3
+    """
+    return 1 + sum(len(e.get('linkings', [])) for e in g.free_entities)
+
+
+def _sort_by_gain_per_cost(pool):
+    """
+    Sort the pool of graphs by the expected gain per unit cost. The model score relative to the worst graph in the
+    pool is used as the expected gain.
+
+    :param pool: a list of graphs with scores
+    :return: sorted list of graphs
+    >>> _sort_by_gain_per_cost([WithScore(SemanticGraph(), (0.0, 0.0, 0.2)), WithScore(SemanticGraph(), (0.0, 0.0, 0.5))])
+    [WithScore(graph=SemanticGraph([], 0), scores=(0.0, 0.0, 0.5)), WithScore(graph=SemanticGraph([], 0), scores=(0.0, 0.0, 0.2))]
+    """
+    lowest_score = min(g.scores[2] for g in pool)
+    return sorted(pool, key=lambda x: (x.scores[2] - lowest_score + 1e-3) / _expansion_cost(x.graph), reverse=True)
+
+
 if __name__ == "__main__":
     import doctest
 
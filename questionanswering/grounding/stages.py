@@ -2,7 +2,8 @@ from copy import copy
 
 from questionanswering.construction.sentence import Sentence
 from questionanswering.construction.graph import SemanticGraph, Edge
-from questionanswering.grounding.graph_queries import QUESTION_VAR, LONG_LEG_RELATIONS
+from questionanswering import resources
+from questionanswering.grounding.graph_queries import QUESTION_VAR
 
 DENOTATION_CLASS_EDGE = Edge(leftentityid=QUESTION_VAR, relationid='iclass')
 
@@ -203,13 +204,16 @@ def add_relation(g: SemanticGraph):
     return new_graphs
 
 
+__getattr__ = resources.module_getattr(__name__, {"LONG_LEG_RELATIONS": "long_leg_relations"})
+
+
 # This division of actions is relevant for grounding with gold answers:
 # - Restrict action     limit the set of answers and should be applied
 #   to a graph that has groundings
 ACTIONS = [last_edge_numeric_constraint,
            lambda x: add_entity_and_relation(x, leg_length=1),
            add_relation,
-           lambda x: add_entity_and_relation(x, leg_length=2, fixed_relations=LONG_LEG_RELATIONS),
+           lambda x: add_entity_and_relation(x, leg_length=2, fixed_relations=resources.get("long_leg_relations")),
            lambda x: add_entity_and_relation(x, leg_length=2)]
 
 
@@ -0,0 +1,212 @@
+# A rule-based in-process tagger that produces the same token dicts as the CoreNLP server
+import re
+
+token_pattern = re.compile(r"""
+    (?:[A-Za-z]\.){2,}              # abbreviations: u.s.
+    | \d+(?:[.,:/]\d+)*(?:s\b)?     # numbers, times, dates, decades: 1990s
+    | \w+(?=n't\b)                  # does|n't
+    | n't\b
+    | '(?:s|re|ve|ll|d|m)\b         # clitics
+    | \w+(?:-\w+)*(?:'(?!(?:s|re|ve|ll|d|m)\b)\w+)*  # words
+    | [?!.]+                        # sentence final punctuation
+    | \S                            # any other symbol
+""", re.VERBOSE | re.IGNORECASE)
+
+year_pattern = re.compile(r"^(1[0-9]{3}|20[0-9]{2})s?$")
+number_pattern = re.compile(r"^\d+(?:[.,:/]\d+)*$")
+
+number_words = {"one", "two", "three", "four", "five", "six", "seven", "eight", "nine", "ten", "eleven", "twelve",
+                "twenty", "thirty", "hundred", "thousand", "million", "billion"}
+ordinal_words = {"first", "second", "third", "fourth", "fifth", "sixth", "seventh", "eighth", "ninth", "tenth", "last"}
+not_gerunds = {"morning", "evening", "wedding", "building", "ceiling", "spring", "string", "during", "sibling",
+               "pudding", "viking"}
+# The nouns that end in -ly and would be taken for adverbs
+ly_nouns = {"family", "assembly", "rally", "supply", "monopoly", "anomaly", "jelly", "belly", "lily", "butterfly",
+            "dragonfly", "firefly", "bully"}
+ly_proper_nouns = {"italy", "sicily", "july", "emily", "kelly", "molly", "beverly", "reilly"}
+months = {"january", "february", "march", "april", "may", "june", "july", "august", "september", "october",
+          "november", "december"}
+
+closed_class_pos = {
+    **{w: 'WP' for w in ["who", "whom", "what"]},
+    **{w: 'WDT' for w in ["which", "whichever"]},
+    **{w: 'WRB' for w in ["when", "where", "why", "how"]},
+    "whose": 'WP$',
+    **{w: 'DT' for w in ["the", "a", "an", "this", "that", "these", "those", "every", "each", "all", "some", "any",
+                         "no", "another"]},
+    **{w: 'IN' for w in ["in", "of", "on", "at", "by", "for", "from", "with", "about", "as", "into", "during",
+                         "before", "after", "since", "until", "than", "like", "through", "over", "under", "between",
+                         "against", "without", "within", "among", "if", "because", "while", "whether", "upon"]},
+    "to": 'TO',
+    **{w: 'CC' for w in ["and", "or", "but", "nor"]},
+    **{w: 'PRP' for w in ["i", "you", "he", "she", "it", "we", "they", "me", "him", "us", "them"]},
+    **{w: 'PRP$' for w in ["my", "your", "his", "her", "its", "our", "their"]},
+    **{w: 'MD' for w in ["can", "could", "will", "would", "shall", "should", "may", "might", "must"]},
+    **{w: 'VBZ' for w in ["is", "has", "does", "'s"]},
+    **{w: 'VBP' for w in ["are", "am", "have", "do", "'re", "'m", "'ve"]},
+    **{w: 'VBD' for w in ["was", "were", "had", "did"]},
+    "be": 'VB', "been": 'VBN', "being": 'VBG',
+    **{w: 'RB' for w in ["not", "n't", "also", "still", "ever", "never", "currently", "now", "then", "there",
+                         "very", "most", "more"]},
+    "there's": 'EX',
+    **{w: 'JJ' for w in ["first", "last", "second", "third", "former", "current", "next", "main", "largest", "biggest",
+                         "oldest", "youngest"]},
+}
+
+irregular_verbs = {
+    "is": "be", "are": "be", "was": "be", "were": "be", "am": "be", "been": "be", "being": "be", "'s": "be",
+    "'re": "be", "'m": "be", "has": "have", "had": "have", "'ve": "have", "does": "do", "did": "do", "done": "do",
+    "n't": "not", "went": "go", "gone": "go", "won": "win", "wrote": "write", "written": "write", "made": "make",
+    "born": "bear", "died": "die", "began": "begin", "begun": "begin", "sang": "sing", "sung": "sing", "led": "lead", "took": "take",
+    "taken": "take", "played": "play", "starred": "star", "spoke": "speak", "spoken": "speak", "knew": "know",
+    "known": "know", "found": "find", "founded": "found", "became": "become", "came": "come", "ran": "run",
+    "grew": "grow", "grown": "grow", "held": "hold", "built": "build", "fought": "fight", "taught": "teach",
+    "thought": "think", "bought": "buy", "sold": "sell", "told": "tell", "got": "get", "gave": "give",
+    "given": "give", "lived": "live", "invented": "invent"
+}
+
+irregular_nouns = {
+    "children": "child", "people": "person", "men": "man", "women": "woman", "movies": "movie", "series": "series",
+    "species": "species"
+}
+
+irregular_lemmas = {**irregular_verbs, **irregular_nouns}
+
+
+def tag(input_text, caseless=False):
+    """
+    Tokenize the input text and assign POS tags, named entity tags and lemmas with a set of simple rules.
+    The output has the same format as _utils.get_tagged_from_server, but only the YEAR dates, numbers and ordinals
+    are recognized as named entities.
+
+    :param input_text: input text as a string, preprocessed the same way as for CoreNLP
+    :param caseless: if True, capitalization is not used to recognize proper nouns
+    :return: a list of token dicts
+    >>> [(t['originalText'], t['ner'], t['pos']) for t in tag("who was the president of the united states in 2012?", caseless=True)]
+    [('who', 'O', 'WP'), ('was', 'O', 'VBD'), ('the', 'O', 'DT'), ('president', 'O', 'NN'), ('of', 'O', 'IN'), ('the', 'O', 'DT'), ('united', 'O', 'JJ'), ('states', 'O', 'NNS'), ('in', 'O', 'IN'), ('2012', 'DATE', 'CD'), ('?', 'O', '.')]
+    >>> [(t['originalText'], t['pos'], t['lemma']) for t in tag("What actors star in the Big Bang Theory?")]
+    [('What', 'WP', 'what'), ('actors', 'NNS', 'actor'), ('star', 'NN', 'star'), ('in', 'IN', 'in'), ('the', 'DT', 'the'), ('Big', 'NNP', 'Big'), ('Bang', 'NNP', 'Bang'), ('Theory', 'NNP', 'Theory'), ('?', '.', '?')]
+    >>> tag("Who doesn't like Pep Guardiola's head?")[2:5] == [
+    ... {'index': 3, 'originalText': "n't", 'pos': 'RB', 'ner': 'O', 'lemma': 'not', 'characterOffsetBegin': 8, 'characterOffsetEnd': 11},
+    ... {'index': 4, 'originalText': 'like', 'pos': 'IN', 'ner': 'O', 'lemma': 'like', 'characterOffsetBegin': 12, 'characterOffsetEnd': 16},
+    ... {'index': 5, 'originalText': 'Pep', 'pos': 'NNP', 'ner': 'O', 'lemma': 'Pep', 'characterOffsetBegin': 17, 'characterOffsetEnd': 20}]
+    True
+    """
+    tagged = []
+    offset, position = 0, 0
+    for m in token_pattern.finditer(input_text):
+        # CoreNLP counts offsets in UTF-16 code units
+        offset += len(input_text[position:m.start()].encode('utf-16-le')) // 2
+        token_end = offset + len(m.group(0).encode('utf-16-le')) // 2
+        tagged.append({'index': len(tagged) + 1,
+                       'originalText': m.group(0),
+                       'characterOffsetBegin': offset,
+                       'characterOffsetEnd': token_end})
+        offset, position = token_end, m.end()
+    for i, t in enumerate(tagged):
+        t['pos'] = _pos_tag(t['originalText'], i, tagged, caseless)
+    for i, t in enumerate(tagged):
+        t['ner'] = _ner_tag(t['originalText'], t['pos'], i, tagged)
+        t['lemma'] = lemmatize(t['originalText'], t['pos'])
+    return tagged
+
+
+def lemmatize(token, pos=None):
+    """
+    Rule-based lemmatization that covers the regular English inflection and the most frequent irregular forms.
+
+    :param token: a token
+    :param pos: POS tag of the token, if known
+    :return: the lemma
+    >>> [lemmatize(t) for t in ['representatives', 'Canadians', 'does', 'countries', 'movies', 'wars', 'glass']]
+    ['representative', 'Canadian', 'do', 'country', 'movie', 'war', 'glass']
+    """
+    lower = token.lower()
+    if pos == 'NNP':
+        return token
+    if pos == 'POS':
+        return lower
+    if lower in irregular_lemmas:
+        return irregular_lemmas[lower]
+    if pos is not None and pos not in {'NNS', 'NNPS', 'VBZ', 'VBD', 'VBN', 'VBG'}:
+        return lower
+    lemma = token
+    if lower.endswith("ies") and len(lower) > 4:
+        lemma = token[:-3] + "y"
+    elif lower.endswith(("sses", "shes", "ches", "xes")):
+        lemma = token[:-2]
+    elif lower.endswith("s") and not lower.endswith(("ss", "us", "is")) and len(lower) > 3:
+        lemma = token[:-1]
+    elif pos in {'VBD', 'VBN'} and lower.endswith("ed") and len(lower) > 4:
+        lemma = token[:-2]
+        if lemma[-1] == lemma[-2] and lemma[-1] not in "ls":
+            lemma = lemma[:-1]
+        elif lemma.lower().endswith(("at", "iz", "us", "iv", "ur", "ag")):
+            lemma += "e"
+    elif pos == 'VBG' and lower.endswith("ing"):
+        lemma = token[:-3]
+    # Proper nouns keep their case
+    return lemma if pos in {None, 'NNPS'} else lemma.lower()
+
+
+def _pos_tag(token, i, tagged, caseless):
+    lower = token.lower()
+    if lower in closed_class_pos:
+        if lower == "'s" and i + 1 < len(tagged) and tagged[i + 1]['originalText'].lower() not in closed_class_pos:
+            return 'POS'
+        if lower == "that" and i > 0 and tagged[i - 1]['originalText'].lower() not in closed_class_pos:
+            return 'WDT'
+        return closed_class_pos[lower]
+    if re.match(r"^[?!.]+$", token):
+        return '.'
+    if token in {",", ";", ":"}:
+        return token
+    if token in {"\"", "``", "''"}:
+        return "''"
+    if number_pattern.match(token) or year_pattern.match(token) or lower in number_words:
+        return 'CD'
+    if not token[0].isalnum():
+        return 'SYM'
+    if not caseless and token[0].isupper() and i > 0:
+        return 'NNPS' if lower.endswith(("ians", "ans", "ers")) else 'NNP'
+    if lower in months - {"may", "march"} or lower in ly_proper_nouns:
+        return 'NNP'
+    if lower in irregular_nouns:
+        return 'NN' if irregular_nouns[lower] == lower else 'NNS'
+    previous = tagged[i - 1]['originalText'].lower() if i > 0 else None
+    if lower.endswith("ing") and len(lower) > 5 and not lower.endswith("thing") and lower not in not_gerunds:
+        return 'VBG'
+    if lower.endswith("ed") and i > 0 and tagged[i - 1]['pos'] in {'DT', 'JJ', 'PRP$'}:
+        return 'JJ'
+    if lower in irregular_verbs or lower.endswith("ed") and len(lower) > 4:
+        if previous in {"was", "were", "been", "is", "are", "be", "has", "have", "had", "'s"}:
+            return 'VBN'
+        return 'VBD'
+    if lower.endswith(("est",)) and len(lower) > 5:
+        return 'JJS'
+    if lower.endswith(("ous", "ful", "ive", "able", "ible", "al", "ic", "ed", "ish", "less", "ited")) and len(lower) > 4:
+        return 'JJ'
+    if lower.endswith("ly") and len(lower) > 4 and lower not in ly_nouns:
+        return 'RB'
+    if lower.endswith("s") and not lower.endswith(("ss", "us", "is")) and len(lower) > 3:
+        if previous in {"who", "which", "that"}:
+            return 'VBZ'
+        return 'NNS'
+    if previous in {"to", "did", "does", "do", "can", "could", "will", "would", "should", "might", "must"}:
+        return 'VB'
+    return 'NN'
+
+
+def _ner_tag(token, pos, i, tagged):
+    lower = token.lower()
+    if pos == 'CD':
+        previous = tagged[i - 1]['originalText'].lower() if i > 0 else None
+        if year_pattern.match(token) or previous in months:
+            return 'DATE'
+        return 'NUMBER'
+    if lower in months and (i + 1 < len(tagged) and tagged[i + 1]['pos'] == 'CD'
+                            or i > 0 and tagged[i - 1]['pos'] == 'CD'):
+        return 'DATE'
+    if lower in ordinal_words - {"last"}:
+        return 'ORDINAL'
+    return 'O'
@@ -1,3 +1,15 @@
-from .lexical_baselines import *
-from .gnn import *
-from .modules import *
\ No newline at end of file
+# The models are imported on the first access, so that the modules that only encode the data don't load torch
+import importlib
+
+_model_modules = ["lexical_baselines", "gnn", "modules", "batching", "scoring"]
+
+
+def __getattr__(name):
+    if not name.startswith("_"):
+        for module_name in _model_modules:
+            module = importlib.import_module("." + module_name, __name__)
+            if name == module_name:
+                return module
+            if hasattr(module, name):
+                return getattr(module, name)
+    raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
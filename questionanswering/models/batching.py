@@ -0,0 +1,456 @@
+import multiprocessing
+import random
+from collections import deque
+from copy import copy
+
+import numpy as np
+import torch
+from torch import nn as nn
+from torch.autograd import Variable
+
+from questionanswering.models import vectorization as V
+from questionanswering.models import losses
+
+GRAPHS, EDGES, TOKENS = "graphs", "edges", "tokens"
+
+# The axes of the model inputs that are trimmed to the largest extent of each mini-batch that is not padding:
+# the candidate graphs (the same extent for all inputs and the targets), the edges of a graph and the tokens of
+# a label. The rows of the GNN matrices are not trimmed, the adjacency matrices refer to them by position.
+# The packed GNN graphs (vectorization.PackedGraphs) have no padding and only take the candidate graph extent.
+# The models mask the padding of the labels and the edges, so the trimmed inputs give the same predictions.
+TRIMMED_AXES = {
+    "OneEdgeModel": ({1: TOKENS}, {1: GRAPHS, 2: TOKENS}),
+    "STAGGModel": ({2: TOKENS}, {1: GRAPHS, 3: TOKENS}, {1: GRAPHS}),
+    "PooledEdgesModel": ({1: TOKENS}, {1: GRAPHS, 2: EDGES, 3: TOKENS}),
+    "GNNModel": ({1: TOKENS}, {1: GRAPHS, 3: TOKENS}, {1: GRAPHS, 3: TOKENS}, {1: GRAPHS}, {1: GRAPHS})
+}
+
+
+class PaddedInputs:
+
+    def __init__(self, model, trim=True):
+        """
+        Feed a model with inputs that are padded per mini-batch. The training container gets an array of sample ids
+        instead of the input arrays and slices it into mini-batches as usual. The forward method of the model
+        is replaced to pad the inputs of the sample ids just before the forward pass, the original forward method is
+        restored on close. The model itself, its parameters and its state dict are not changed.
+
+        With trim, the inputs are padded only to the real maximum of each mini-batch along TRIMMED_AXES.
+        The candidate graphs are trimmed only in the training mode, since the predictions of the mini-batches
+        in the evaluation mode are concatenated, use batch_targets or wrap_criterion to trim the targets.
+
+        :param model: a model, an instance of torch.nn.Module
+        :param trim: trim the padding of each mini-batch
+        """
+        self._model = model
+        self._datasets = []
+        self._batch_targets = None
+        self._batch_graphs = None
+        self._axes = TRIMMED_AXES.get(type(model).__name__) if trim else None
+        self._model.forward = self._forward
+
+    def add(self, inputs):
+        """
+        Add a data set.
+
+        :param inputs: a list of the model inputs, each is either a numpy array or has a pad(indices) method,
+                       such as vectorization.RaggedGraphs, or is a vectorization.PackedGraphs
+        :return: a tuple with the array of sample ids to pass to the container instead of the inputs
+        """
+        dataset_id = len(self._datasets)
+        self._datasets.append(inputs)
+        size = len(inputs[0])
+        return np.stack([np.full(size, dataset_id, dtype=np.int64), np.arange(size, dtype=np.int64)], axis=1),
+
+    def add_stream(self, stream):
+        """
+        Add a data set that is encoded per mini-batch. The stream decides which questions go into a mini-batch and
+        the targets of the mini-batch come from the stream as well: pass the sample ids to the container as
+        the targets too and use wrap_criterion and batch_targets to get the targets of the sample ids.
+
+        :param stream: an EncodingStream
+        :return: a tuple with the array of sample ids to pass to the container instead of the inputs
+        """
+        dataset_id = len(self._datasets)
+        self._datasets.append(stream)
+        return np.stack([np.full(len(stream), dataset_id, dtype=np.int64), np.arange(len(stream), dtype=np.int64)],
+                        axis=1),
+
+    def add_buckets(self, inputs, targets, batch_size, seed=1):
+        """
+        Add a data set that is split into mini-batches of questions with a similar number of candidate graphs and
+        similar label lengths, see BucketSampler. Like for a stream, the targets of the mini-batch come from
+        the data set and the sample ids are the targets of the container.
+
+        :param inputs: a list of the model inputs, each is either a numpy array or has a pad(indices) method
+        :param targets: a numpy array of targets
+        :param batch_size: the mini-batch size of the training container
+        :param seed: random seed for the order of the mini-batches
+        :return: a tuple with the array of sample ids to pass to the container instead of the inputs
+        """
+        sampler = BucketSampler(self.sample_sizes(inputs), batch_size, seed=seed)
+        return self.add_stream(BucketedData(inputs, targets, sampler))
+
+    def sample_sizes(self, inputs):
+        """
+        :param inputs: a list of the model inputs
+        :return: a numpy array with the number of candidate graphs and the longest label of each sample
+        """
+        sizes = np.zeros((len(inputs[0]), 2), dtype=np.int64)
+        for m, axes in zip(inputs, self._axes or [{}] * len(inputs)):
+            if isinstance(m, V.RaggedGraphs):
+                np.maximum(sizes, m.sizes()[:, [0, 2]], out=sizes)
+                continue
+            if isinstance(m, V.PackedGraphs):
+                np.maximum(sizes[:, 0], m.graph_counts(), out=sizes[:, 0])
+                continue
+            # The labels of the candidate graphs, the length of the question is not taken into account
+            for axis, kind in axes.items():
+                if kind == GRAPHS or kind == TOKENS and GRAPHS in axes.values():
+                    column = 0 if kind == GRAPHS else 1
+                    sizes[:, column] = np.maximum(sizes[:, column], _sample_extents(m, axis))
+        return sizes
+
+    def wrap_criterion(self, criterion):
+        """
+        :param criterion: the criterion, an instance of torch.nn.Module
+        :return: a criterion that gets the targets of the sample ids of a stream, see batch_targets
+        """
+        return BatchTargetsCriterion(criterion, self)
+
+    def batch_targets(self, targets):
+        """
+        :param targets: the targets that the container has for the mini-batch, the sample ids for a stream
+        :return: the targets of the sample ids if the mini-batch came from a stream, otherwise the given targets,
+                 trimmed to the candidate graphs of the mini-batch
+        """
+        if self._batch_targets is not None:
+            sample_ids, batch_targets = self._batch_targets
+            assert np.array_equal(targets.data.cpu().numpy().astype(np.int64), sample_ids), \
+                "The targets of a stream are the sample ids of the mini-batch"
+            batch_targets = Variable(torch.from_numpy(batch_targets)).float()
+            targets = batch_targets.cuda() if targets.is_cuda else batch_targets
+        if self._batch_graphs is not None and targets.dim() > 1 and targets.size(1) > self._batch_graphs:
+            targets = targets[:, :self._batch_graphs]
+        return targets
+
+    def close(self):
+        if 'forward' in self._model.__dict__:
+            del self._model.forward
+        for inputs in self._datasets:
+            if hasattr(inputs, "close"):
+                inputs.close()
+        self._datasets = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def pad(self, sample_ids):
+        """
+        :param sample_ids: a numpy array of (data set id, sample index) pairs of one data set
+        :return: a list of numpy arrays, the inputs of the samples padded to the dense shape or trimmed
+        """
+        inputs = self._datasets[sample_ids[0, 0]]
+        if hasattr(inputs, "next_batch"):
+            samples, targets = inputs.next_batch(len(sample_ids))
+            self._batch_targets = sample_ids, targets
+            inputs = samples
+        else:
+            self._batch_targets = None
+            indices = sample_ids[:, 1]
+            samples = [m.pad(indices, trim=self._axes is not None) if hasattr(m, "pad") else m[indices]
+                       for m in inputs]
+        self._batch_graphs = None
+        if self._axes is None:
+            return samples
+        if self._model.training:
+            samples, self._batch_graphs = trim_batch(samples, self._axes)
+        else:
+            # The evaluation keeps the number of candidate graphs of the data set
+            samples, _ = trim_batch(samples, self._axes, graphs=max(
+                m.shape[1] for m, axes in zip(inputs, self._axes) if GRAPHS in axes.values()))
+        return samples
+
+    def _forward(self, sample_ids):
+        samples = self.pad(sample_ids.data.cpu().numpy().astype(np.int64))
+        forward = type(self._model).forward
+        if any(isinstance(m, V.PackedGraphs) for m in samples):
+            # The packed graphs are passed as their arrays, see GNNModel.forward_packed
+            forward = type(self._model).forward_packed
+            samples = [a for m in samples for a in (m.arrays() if isinstance(m, V.PackedGraphs) else (m,))]
+        batch = [Variable(torch.from_numpy(m)) for m in samples]
+        if sample_ids.is_cuda:
+            batch = [m.cuda() for m in batch]
+        return forward(self._model, *batch)
+
+
+class BatchTargetsCriterion(nn.Module):
+
+    def __init__(self, criterion, padded_inputs):
+        """
+        See PaddedInputs.wrap_criterion.
+        """
+        super(BatchTargetsCriterion, self).__init__()
+        self._criterion = criterion
+        self._padded_inputs = [padded_inputs]  # Not a module, kept out of the module attributes
+
+    def forward(self, predictions, target):
+        return self._criterion(predictions, self._padded_inputs[0].batch_targets(target))
+
+
+class BucketSampler:
+
+    def __init__(self, sizes, batch_size, pool_size=100, seed=1):
+        """
+        Order the samples of every epoch so that the mini-batches hold samples of a similar size. The samples are
+        shuffled, every pool of pool_size mini-batches is sorted by the sizes and cut into mini-batches and then
+        the mini-batches are shuffled. Only the last mini-batch of an epoch can be smaller than batch_size.
+
+        :param sizes: a numpy array of sizes, one row per sample, sorted by the first column, then by the second,
+                      without columns to only shuffle the samples
+        :param batch_size: the number of samples per mini-batch
+        :param pool_size: the number of mini-batches that are sorted together
+        :param seed: random seed, the order of each epoch depends only on the seed and the epoch
+        >>> sampler = BucketSampler(np.array([[3], [1], [2], [1], [3], [2]]), batch_size=2)
+        >>> order = sampler.epoch_order(0)
+        >>> sorted(order.tolist()), sorted(sampler.sizes[order[i:i + 2], 0].tolist() for i in range(0, 6, 2))
+        ([0, 1, 2, 3, 4, 5], [[1, 1], [2, 2], [3, 3]])
+        """
+        self.sizes = sizes
+        self.batch_size = batch_size
+        self.pool_size = pool_size
+        self.seed = seed
+
+    def epoch_order(self, epoch):
+        """
+        :param epoch: the epoch number
+        :return: a numpy array of sample indices, consecutive batch_size indices form a mini-batch
+        """
+        rng = np.random.RandomState(self.seed + epoch)
+        order = rng.permutation(len(self.sizes))
+        if self.sizes.shape[1] == 0:
+            return order
+        pool = self.batch_size * self.pool_size
+        for i in range(0, len(order), pool):
+            # lexsort is stable, the samples of the same size stay shuffled
+            order[i:i + pool] = order[i:i + pool][np.lexsort(self.sizes[order[i:i + pool]].T[::-1])]
+        batches = [order[i:i + self.batch_size] for i in range(0, len(order), self.batch_size)]
+        full_batches = len(order) // self.batch_size
+        batches[:full_batches] = [batches[i] for i in rng.permutation(full_batches)]
+        return np.concatenate(batches) if batches else order
+
+
+class BucketedData:
+
+    def __init__(self, inputs, targets, sampler):
+        """
+        Encoded data that is served in mini-batches in the order of a BucketSampler, see PaddedInputs.add_buckets.
+
+        :param inputs: a list of the model inputs, each is either a numpy array or has a pad(indices) method
+        :param targets: a numpy array of targets
+        :param sampler: a BucketSampler
+        """
+        self.inputs = inputs
+        self.targets = targets
+        self.sampler = sampler
+        self.epoch = 0
+        self._order = np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.targets)
+
+    def next_batch(self, size):
+        """
+        :param size: the number of samples
+        :return: a tuple of a list of model inputs and a numpy array of targets for the next samples
+        """
+        indices = []
+        while size > 0:
+            if len(self._order) == 0:
+                self._order = self.sampler.epoch_order(self.epoch)
+                self.epoch += 1
+            indices.append(self._order[:size])
+            self._order = self._order[size:]
+            size -= len(indices[-1])
+        indices = np.concatenate(indices)
+        return [m.pad(indices, trim=True) if hasattr(m, "pad") else m[indices] for m in self.inputs], \
+            self.targets[indices]
+
+
+class EncodingStream:
+
+    def __init__(self, questions, word2idx, model_type,
+                 batch_size=64,
+                 context=None,
+                 workers=0,
+                 prefetch=4,
+                 seed=1,
+                 bucketing=False):
+        """
+        Training questions that are encoded per mini-batch in background worker processes, instead of encoding the
+        whole data set before the training. Every epoch visits the questions in a new random order and samples
+        the graphs of each question again: the graphs with a score above losses.MIN_TARGET_VALUE are always kept
+        and the rest is a new random sample of negatives if the question has more graphs than the limit of
+        the encoding context.
+
+        :param questions: a list of sentence objects with the graphs and their scores
+        :param word2idx: word to index mapping
+        :param model_type: the class name of the model
+        :param batch_size: the number of questions per encoded mini-batch
+        :param context: a vectorization.EncodingContext with the shape limits and the maximum number of graphs
+                        per question
+        :param workers: the number of worker processes, 0 to encode in the calling process
+        :param prefetch: the number of mini-batches to encode ahead
+        :param seed: random seed for the order of the questions and the graph samples
+        :param bucketing: put questions with a similar number of candidate graphs into the same mini-batch
+        """
+        self.questions = questions
+        self.batch_size = batch_size
+        self.context = V.get_encoding_context(context)
+        self.prefetch = max(prefetch, 1)
+        self.seed = seed
+        self.epoch = 0
+        self._sampler = BucketSampler(np.asarray([[min(len(q.graphs), self.context.max_negative_graphs)]
+                                                  for q in questions]
+                                                 if bucketing else np.zeros((len(questions), 0), dtype=np.int64)),
+                                      batch_size, seed=seed)
+        self.model_type = model_type
+        self._state = (questions, word2idx, model_type, self.context, seed)
+        self._tasks = self._generate_tasks()
+        self._pending = deque()
+        self._ready = deque()
+        self._pool = None
+        if workers > 0:
+            # Forked workers share the questions and the vocabulary with the main process
+            context = multiprocessing.get_context("fork") \
+                if "fork" in multiprocessing.get_all_start_methods() else multiprocessing.get_context()
+            self._pool = context.Pool(workers, initializer=_init_stream_worker, initargs=(self._state,))
+
+    def __len__(self):
+        return len(self.questions)
+
+    def next_batch(self, size):
+        """
+        :param size: the number of questions
+        :return: a tuple of a list of model inputs and a numpy array of targets for the next questions of the stream
+        """
+        parts = []
+        while size > 0:
+            if not self._ready:
+                self._ready.append(self._next_encoded())
+            samples, targets = self._ready.popleft()
+            if len(targets) > size:
+                self._ready.appendleft(([m[size:] for m in samples], targets[size:]))
+                samples, targets = [m[:size] for m in samples], targets[:size]
+            parts.append((samples, targets))
+            size -= len(targets)
+        if len(parts) == 1:
+            return parts[0]
+        return V.concatenate_inputs([p[0] for p in parts], self.model_type), \
+            V._concatenate_padded([p[1] for p in parts])
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+    def _next_encoded(self):
+        if self._pool is None:
+            return _encode_stream_batch(*next(self._tasks), state=self._state)
+        while len(self._pending) < self.prefetch:
+            self._pending.append(self._pool.apply_async(_encode_stream_batch, next(self._tasks)))
+        return self._pending.popleft().get()
+
+    def _generate_tasks(self):
+        while True:
+            order = self._sampler.epoch_order(self.epoch)
+            for i in range(0, len(order), self.batch_size):
+                yield self.epoch, order[i:i + self.batch_size]
+            self.epoch += 1
+
+
+_stream_state = None
+
+
+def _init_stream_worker(state):
+    global _stream_state
+    _stream_state = state
+
+
+def _encode_stream_batch(epoch, question_indices, state=None):
+    questions, word2idx, model_type, context, seed = state if state is not None else _stream_state
+    batch = []
+    for qi in question_indices:
+        q = copy(questions[qi])
+        rng = random.Random(f"{seed}-{epoch}-{qi}")
+        negatives = [g for g in q.graphs if g.scores[2] <= losses.MIN_TARGET_VALUE]
+        rng.shuffle(negatives)
+        q.graphs = ([g for g in q.graphs if g.scores[2] > losses.MIN_TARGET_VALUE] +
+                    negatives)[:context.max_negative_graphs]
+        rng.shuffle(q.graphs)
+        batch.append(q)
+    samples = V.encode_for_model(batch, model_type, word2idx, context=context)
+    targets = np.zeros((len(batch), max(len(q.graphs) for q in batch)))
+    for qi, q in enumerate(batch):
+        targets[qi, :len(q.graphs)] = [g.scores[2] for g in q.graphs]
+    return [np.ascontiguousarray(m) for m in samples], targets
+
+
+def trim_batch(batch, axes, graphs=None):
+    """
+    Trim the padding of a mini-batch along the given axes.
+
+    :param batch: a list of numpy arrays, the model inputs
+    :param axes: the trimmed axes of each input, see TRIMMED_AXES
+    :param graphs: the number of candidate graphs to keep, by default the largest number of graphs in the mini-batch
+    :return: a tuple of the list of trimmed inputs and the number of candidate graphs
+    >>> batch, graphs = trim_batch([np.array([[1, 2, 0, 0]]), np.array([[[3, 0, 0], [4, 5, 0], [0, 0, 0]]])],
+    ...                            ({1: TOKENS}, {1: GRAPHS, 2: TOKENS}))
+    >>> [m.tolist() for m in batch], graphs
+    ([[[1, 2]], [[[3, 0], [4, 5]]]], 2)
+    """
+    if graphs is None:
+        graphs = max([_extent(m, axis) for m, m_axes in zip(batch, axes) for axis, kind in m_axes.items()
+                      if kind == GRAPHS] + [1])
+    trimmed = []
+    for m, m_axes in zip(batch, axes):
+        if isinstance(m, V.PackedGraphs):
+            trimmed.append(m.with_graphs(graphs))
+            continue
+        index = [slice(None)] * m.ndim
+        for axis, kind in m_axes.items():
+            index[axis] = slice(0, graphs if kind == GRAPHS else max(_extent(m, axis), 1))
+        m = m[tuple(index)]
+        for axis, kind in m_axes.items():
+            if kind == GRAPHS and m.shape[axis] < graphs:
+                m = np.pad(m, [(0, graphs - m.shape[axis]) if i == axis else (0, 0) for i in range(m.ndim)],
+                           'constant')
+        trimmed.append(m)
+    return trimmed, graphs
+
+
+def _extent(m, axis):
+    """
+    :return: the length of m along the axis without the trailing zero padding
+    """
+    if isinstance(m, V.PackedGraphs):
+        return int(m.graph_counts().max(initial=0))
+    nonzero = np.flatnonzero(np.any(m != 0, axis=tuple(i for i in range(m.ndim) if i != axis)))
+    return int(nonzero[-1]) + 1 if len(nonzero) > 0 else 0
+
+
+def _sample_extents(m, axis, chunk_size=1024):
+    """
+    :return: the length of each sample of m along the axis without the trailing zero padding
+    >>> _sample_extents(np.array([[[1, 0], [0, 0], [0, 0]], [[0, 0], [0, 1], [0, 0]]]), 1).tolist()
+    [1, 2]
+    """
+    extents = np.zeros(len(m), dtype=np.int64)
+    for i in range(0, len(m), chunk_size):
+        nonzero = np.any(m[i:i + chunk_size] != 0, axis=tuple(j for j in range(1, m.ndim) if j != axis))
+        extents[i:i + chunk_size] = np.where(nonzero.any(axis=1),
+                                             nonzero.shape[1] - np.argmax(nonzero[:, ::-1], axis=1), 0)
+    return extents
@@ -0,0 +1,115 @@
+# On-disk cache of the encoded data sets
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+
+from questionanswering.models import vectorization as V
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.ERROR)
+
+# Change to invalidate the cached data sets after changes in the encoders
+ENCODING_CACHE_FORMAT = 1
+
+
+def fingerprint(paths, word2idx, context=None, property2label=None, **parameters):
+    """
+    Compute the key of an encoded data set: the data set files (path, size and modification time), the vocabulary,
+    the property labels, the shape limits of the encoding context and any additional parameters, such as
+    the model type.
+
+    :param paths: a list of data set files
+    :param word2idx: word to index mapping
+    :param context: a vectorization.EncodingContext, the module constants are the limits if not given
+    :param property2label: the property metadata that the edge labels are encoded from,
+                           wikidata.scheme.property2label if not given
+    :param parameters: additional parameters of the encoding
+    :return: a hex string
+    >>> fingerprint([], {"the": 2}, model_type="GNNModel") == fingerprint([], {"the": 2}, model_type="GNNModel")
+    True
+    >>> fingerprint([], {"the": 2}, model_type="GNNModel") == fingerprint([], {"the": 3}, model_type="GNNModel")
+    False
+    >>> fingerprint([], {"the": 2}) == fingerprint([], {"the": 2}, V.EncodingContext(dynamic_shapes=True))
+    False
+    >>> fingerprint([], {}, property2label={"P31": {"label": "is a"}}) == fingerprint([], {}, property2label={})
+    False
+    """
+    context = V.get_encoding_context(context)
+    key = hashlib.sha1()
+    key.update(json.dumps([ENCODING_CACHE_FORMAT, sorted(context.limits().items()), context.dynamic_shapes,
+                           sorted(parameters.items())]).encode('utf-8'))
+    for path in paths:
+        stat = os.stat(path)
+        key.update(json.dumps([os.path.abspath(path), stat.st_size, stat.st_mtime_ns]).encode('utf-8'))
+    key.update("\n".join(f"{w} {word2idx[w]}" for w in sorted(word2idx, key=word2idx.get)).encode('utf-8'))
+    if property2label is None:
+        property2label = V.scheme.property2label
+    key.update(json.dumps(property2label, sort_keys=True, default=str).encode('utf-8'))
+    return key.hexdigest()
+
+
+def save(path_to_cache, key, samples, targets, graph_orders, **metadata):
+    """
+    Save the encoded data set as .npy files in a sub-directory of the cache named after the key.
+
+    :param path_to_cache: the cache directory
+    :param key: the fingerprint of the data set
+    :param samples: a list of the model inputs, numpy arrays, vectorization.RaggedGraphs or
+                    vectorization.PackedGraphs
+    :param targets: a numpy array of targets
+    :param graph_orders: a list with the order of the graphs of each question relative to the data set file
+    :param metadata: additional values to save, should be JSON serializable
+    """
+    path = os.path.join(path_to_cache, key)
+    if os.path.exists(path):
+        return
+    path_tmp = path + f".tmp{os.getpid()}"
+    os.makedirs(path_tmp, exist_ok=True)
+    inputs = []
+    for i, m in enumerate(samples):
+        if isinstance(m, (V.RaggedGraphs, V.PackedGraphs)):
+            m.save(os.path.join(path_tmp, f"input{i}"))
+            inputs.append("ragged" if isinstance(m, V.RaggedGraphs) else "packed")
+        else:
+            np.save(os.path.join(path_tmp, f"input{i}.npy"), m)
+            inputs.append("dense")
+    np.save(os.path.join(path_tmp, "targets.npy"), targets)
+    np.save(os.path.join(path_tmp, "graph_order_offsets.npy"), V._to_offsets([len(o) for o in graph_orders]))
+    np.save(os.path.join(path_tmp, "graph_orders.npy"),
+            np.asarray([i for o in graph_orders for i in o], dtype=np.int32))
+    with open(os.path.join(path_tmp, "metadata.json"), "w") as out:
+        json.dump({"inputs": inputs, **metadata}, out)
+    try:
+        # The directory appears at once, concurrent runs either see the complete data set or nothing
+        os.rename(path_tmp, path)
+    except OSError:
+        shutil.rmtree(path_tmp, ignore_errors=True)
+    logger.debug(f"Saved the encoded data set to {path}")
+
+
+def load(path_to_cache, key):
+    """
+    Load an encoded data set from the cache, the arrays are memory-mapped.
+
+    :param path_to_cache: the cache directory
+    :param key: the fingerprint of the data set
+    :return: a tuple of (samples, targets, graph orders, metadata) or None if the data set is not in the cache
+    """
+    path = os.path.join(path_to_cache, key)
+    if not os.path.exists(os.path.join(path, "metadata.json")):
+        return None
+    with open(os.path.join(path, "metadata.json")) as f:
+        metadata = json.load(f)
+    loaders = {"ragged": V.RaggedGraphs.load, "packed": V.PackedGraphs.load,
+               "dense": lambda path_prefix: np.load(path_prefix + ".npy", mmap_mode='r')}
+    samples = [loaders[kind](os.path.join(path, f"input{i}")) for i, kind in enumerate(metadata.pop("inputs"))]
+    targets = np.load(os.path.join(path, "targets.npy"))
+    offsets = np.load(os.path.join(path, "graph_order_offsets.npy"))
+    orders = np.load(os.path.join(path, "graph_orders.npy"))
+    graph_orders = [orders[offsets[i]:offsets[i + 1]].tolist() for i in range(len(offsets) - 1)]
+    logger.debug(f"Loaded the encoded data set from {path}")
+    return samples, targets, graph_orders, metadata
@@ -1,5 +1,6 @@
 import torch
 from torch import nn as nn
+from torch.autograd import Variable
 import numpy as np
 
 from questionanswering.models import modules
@@ -34,8 +35,13 @@ class PropagationModel(nn.Module):
         edges_mask = (A_edges != 0).float()
 
         new_state = (nodes*nodes_mask + edges*edges_mask).sum(2)
-        new_state = self._update_layer(torch.cat((new_state, current_state), dim=-1))
-        return new_state
+        return self._update(new_state, current_state)
+
+    def forward_packed(self, current_state, edges_m, messages):
+        return self._update(sum_messages(current_state, edges_m, messages), current_state)
+
+    def _update(self, activation, current_state):
+        return self._update_layer(torch.cat((activation, current_state), dim=-1))
 
 
 class GatedPropagationModel(nn.Module):
@@ -79,6 +85,12 @@ class GatedPropagationModel(nn.Module):
         edges_mask = (A_edges != 0).float()
 
         activation = (nodes*nodes_mask + edges*edges_mask).sum(2)
+        return self._update(activation, current_state)
+
+    def forward_packed(self, current_state, edges_m, messages):
+        return self._update(sum_messages(current_state, edges_m, messages), current_state)
+
+    def _update(self, activation, current_state):
         activation_current_state = torch.cat((activation, current_state), dim=-1)
         update_gate = self._update_layer(activation_current_state)
         reset_gate = self._reset_layer(activation_current_state)
@@ -88,6 +100,23 @@ class GatedPropagationModel(nn.Module):
         return new_state
 
 
+def sum_messages(current_state, edges_m, messages):
+    """
+    Sum the states of the neighbours and the incoming messages of the edges for every node of a packed batch of
+    graphs, see vectorization.PackedGraphs.
+
+    :param current_state: a 2D tensor of node states
+    :param edges_m: a 2D tensor of the outgoing edges followed by the incoming edges
+    :param messages: a 2D LongTensor of (node, neighbour, edge) rows
+    :return: a 2D tensor of the same size as current_state
+    """
+    activation = Variable(current_state.data.new(current_state.size()).zero_())
+    if messages.size(0) == 0:
+        return activation
+    values = current_state.index_select(0, messages[:, 1]) + edges_m.index_select(0, messages[:, 2])
+    return activation.index_add(0, messages[:, 0], values)
+
+
 class GNN(nn.Module):
 
     def __init__(self,
@@ -149,6 +178,26 @@ class GNN(nn.Module):
         return graph_vector
         # return current_state.sum(dim=1)[0]
 
+    def forward_packed(self, nodes_m, edges_m, messages, node_mask, edge_mask, roots):
+        """
+        Same as forward for a packed batch of graphs, see vectorization.PackedGraphs.arrays.
+
+        :return: a 2D tensor with the vector of each graph, the state of its question variable node
+        """
+        current_state = self._node_layer(nodes_m) * node_mask.float().unsqueeze(-1)
+        current_state = current_state.index_fill(0, roots, 1.0)
+        edges_m = self._edge_layer(edges_m) * edge_mask.float().unsqueeze(-1)
+        edges_m = torch.cat((self.out_edge(edges_m), self.in_edge(edges_m)), dim=0)
+        current_state = self._dropout(current_state)
+        edges_m = self._dropout(edges_m)
+
+        for i in range(self._steps):
+            current_state = self._prop_model.forward_packed(current_state, edges_m, messages)
+
+        graph_vector = current_state.index_select(0, roots)
+        graph_vector = self._dropout(graph_vector)
+        return graph_vector
+
 
 class GNNModel(nn.Module):
 
@@ -178,27 +227,25 @@ class GNNModel(nn.Module):
                                              )
 
     def forward(self, questions_m, nodes_m, edges_m, A_nodes, A_edges):
+        return self.score_graphs(self.encode_questions(questions_m), nodes_m, edges_m, A_nodes, A_edges)
 
-        questions_m = self._tokens_encoder(questions_m)
+    def encode_questions(self, questions_m):
+        """
+        :return: the question vectors that score_graphs and score_packed_graphs compare the graphs with
+        """
+        return self._question_layer(self._tokens_encoder(questions_m))
 
+    def score_graphs(self, questions_m, nodes_m, edges_m, A_nodes, A_edges):
         graphs_per_sample = edges_m.size(1)
         edges_per_graph = edges_m.size(2)
         predictions_mask = (nodes_m.sum(-1).sum(-1) != 0).float()
 
-        nodes_m = nodes_m.view(-1, nodes_m.size(-1)).long()
-        nodes_word_mask = (nodes_m != 0).float().unsqueeze(-1).expand(-1, -1, self._tokens_encoder._word_embedding.embedding_dim)
-        nodes_m = self._tokens_encoder._word_embedding(nodes_m)
-        nodes_m = nodes_m * nodes_word_mask
-        nodes_m = nodes_m.sum(dim=-2)
+        nodes_m = self._embed_labels(nodes_m.view(-1, nodes_m.size(-1)))
         # nodes_m = self._pool(nodes_m.transpose(-2, -1)).squeeze(dim=-1)
         # nodes_m = self._tokens_encoder(nodes_m)
         nodes_m = nodes_m.view(-1, edges_per_graph, nodes_m.size(-1))
 
-        edges_m = edges_m.view(-1, edges_m.size(-1)).long()
-        edges_word_mask = (edges_m != 0).float().unsqueeze(-1).expand(-1, -1, self._tokens_encoder._word_embedding.embedding_dim)
-        edges_m = self._tokens_encoder._word_embedding(edges_m)
-        edges_m = edges_m * edges_word_mask
-        edges_m = edges_m.sum(dim=-2)
+        edges_m = self._embed_labels(edges_m.view(-1, edges_m.size(-1)))
         # edges_m = self._pool(edges_m.transpose(-2, -1)).squeeze(dim=-1)
         # edges_m = self._tokens_encoder(edges_m)
         edges_m = edges_m.view(-1, edges_per_graph, edges_m.size(-1))
@@ -209,8 +256,38 @@ class GNNModel(nn.Module):
         graph_vectors1 = self._gnn(nodes_m, edges_m, A_nodes, A_edges)
         graph_vectors1 = graph_vectors1.view(-1, graphs_per_sample, graph_vectors1.size(-1))
 
-        questions_m = self._question_layer(questions_m)
         graph_vectors1 = self._graph_layer(graph_vectors1)
         predictions = batchmv_cosine_similarity(graph_vectors1, questions_m) * predictions_mask
 
         return predictions
+
+    def forward_packed(self, questions_m, nodes_m, edges_m, messages, node_mask, edge_mask, roots, graph_ids):
+        """
+        Same as forward for the candidate graphs packed into one disjoint union, see vectorization.PackedGraphs.
+        The cost depends on the number of nodes and edges of the graphs instead of the padded size.
+
+        :param questions_m: the encoded questions
+        :param graph_ids: a 2D LongTensor with the graph of each prediction, -1 for padding,
+                          the other arguments are the rest of the output of PackedGraphs.arrays
+        :return: the predictions, same as the output of forward
+        """
+        return self.score_packed_graphs(self.encode_questions(questions_m), nodes_m, edges_m, messages, node_mask,
+                                        edge_mask, roots, graph_ids)
+
+    def score_packed_graphs(self, questions_m, nodes_m, edges_m, messages, node_mask, edge_mask, roots, graph_ids):
+        graph_vectors = self._gnn.forward_packed(self._embed_labels(nodes_m), self._embed_labels(edges_m),
+                                                 messages, node_mask, edge_mask, roots)
+
+        graph_vectors = self._graph_layer(graph_vectors)
+        graph_vectors = graph_vectors.index_select(0, graph_ids.clamp(min=0).view(-1))
+        graph_vectors = graph_vectors.view(graph_ids.size(0), graph_ids.size(1), -1)
+        predictions = batchmv_cosine_similarity(graph_vectors, questions_m) * (graph_ids >= 0).float()
+
+        return predictions
+
+    def _embed_labels(self, labels_m):
+        labels_m = labels_m.long()
+        word_mask = (labels_m != 0).float().unsqueeze(-1).expand(-1, -1, self._tokens_encoder._word_embedding.embedding_dim)
+        labels_m = self._tokens_encoder._word_embedding(labels_m)
+        labels_m = labels_m * word_mask
+        return labels_m.sum(dim=-2)
@@ -17,8 +17,12 @@ class OneEdgeModel(nn.Module):
         self._tokens_encoder: nn.Module = tokens_encoder
 
     def forward(self, questions_m, graphs_m):
+        return self.score_graphs(self.encode_questions(questions_m), graphs_m)
 
-        question_vector1 = self._tokens_encoder(questions_m)
+    def encode_questions(self, questions_m):
+        return self._tokens_encoder(questions_m)
+
+    def score_graphs(self, question_vector1, graphs_m):
 
         edge_vectors1 = self._tokens_encoder(graphs_m.view(-1, graphs_m.size(-1)))
         edge_vectors1 = edge_vectors1.view(-1, graphs_m.size(1), edge_vectors1.size(-1))
@@ -45,10 +49,15 @@ class STAGGModel(nn.Module):
                                             )
 
     def forward(self, questions_m, graphs_m, graphs_features_m):
+        return self.score_graphs(self.encode_questions(questions_m), graphs_m, graphs_features_m)
+
+    def encode_questions(self, questions_m):
+        return self._tokens_encoder(questions_m[..., 0, :]), self._tokens_encoder(questions_m[..., 1, :])
+
+    def score_graphs(self, question_vectors, graphs_m, graphs_features_m):
         graphs_features_m = graphs_features_m.float()
 
-        question_vector1 = self._tokens_encoder(questions_m[..., 0, :])
-        question_vector2 = self._tokens_encoder(questions_m[..., 1, :])
+        question_vector1, question_vector2 = question_vectors
 
         edge_vectors1 = self._tokens_encoder(graphs_m[..., 0, :]
                                              .contiguous()
@@ -82,10 +91,18 @@ class PooledEdgesModel(nn.Module):
         self._pool = self._tokens_encoder._pool
 
     def forward(self, questions_m, graphs_m, *args):
-        question_vector = self._tokens_encoder(questions_m)
+        return self.score_graphs(self.encode_questions(questions_m), graphs_m)
+
+    def encode_questions(self, questions_m):
+        return self._tokens_encoder(questions_m)
+
+    def score_graphs(self, question_vector, graphs_m, *args):
         edge_vectors = graphs_m.view(-1, graphs_m.size(-1))
+        # The padding edges are left out of the pooling, the encoded edges are not negative
+        edges_mask = (edge_vectors != 0).sum(-1, keepdim=True).clamp(max=1).float()
 
         edge_vectors = self._tokens_encoder(edge_vectors)
+        edge_vectors = edge_vectors * edges_mask.expand_as(edge_vectors)
         edge_vectors = edge_vectors.view(-1, graphs_m.size(-2), edge_vectors.size(-1))\
             .transpose(-1, -2).contiguous()
         edge_vectors = self._pool(edge_vectors).squeeze(-1)
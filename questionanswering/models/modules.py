@@ -83,7 +83,8 @@ class ConvWordsEncoder(nn.Module):
                                                  )
 
     def load_word_embeddings_from_numpy(self, word_embeddings: np.ndarray):
-        word_embeddings = torch.from_numpy(word_embeddings).float()
+        # Copy, the embeddings can be a read-only memory-mapped array
+        word_embeddings = torch.from_numpy(np.array(word_embeddings, dtype='float32'))
         self._word_embedding.weight = nn.Parameter(word_embeddings)
         self._word_embedding.weight.requires_grad = False
 
@@ -93,15 +94,16 @@ class ConvWordsEncoder(nn.Module):
         words_m = self._word_embedding(words_m)
         words_m = words_m.transpose(-2, -1).contiguous()
 
-        words_m = self._block_conv_in(words_m)
+        # The padding is masked after every convolution, so that the bias does not leak into the real tokens
+        # and the output does not depend on the length of the padding
+        words_m = self._block_conv_in(words_m) * words_mask
         words_m = self._dropout(words_m)
 
         for _ in range(self.hp_repeat_cnn):
             for convlayer in self._dilated_convs:
-                words_m = convlayer(words_m)
-            words_m = self._block_conv_out(words_m)
+                words_m = convlayer(words_m) * words_mask
+            words_m = self._block_conv_out(words_m) * words_mask
 
-        words_m = words_m * words_mask
         words_v = self._pool(words_m).squeeze(dim=-1)
         words_v = self._dropout(words_v)
         if self.hp_add_top_dense_layer:
@@ -117,7 +119,7 @@ def batchmv_cosine_similarity(m, v):
     :param v: a 2D tensor that contains a batch of vectors
     :return: a 2D tensor with similarity values per vector * matrix row
     """
-    predictions = torch.bmm(m, v.unsqueeze(2)).squeeze()
+    predictions = torch.bmm(m, v.unsqueeze(2)).squeeze(2)
     w1 = torch.norm(m, 2, dim=-1)
     w2 = torch.norm(v, 2, dim=-1, keepdim=True)
     predictions = (predictions / (w1 * w2.expand_as(w1)).clamp(min=10e-8))
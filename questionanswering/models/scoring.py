@@ -0,0 +1,93 @@
+import numpy as np
+import torch
+from torch.autograd import Variable
+
+from questionanswering.models import vectorization as V
+
+# Maximum number of question vectors to keep in the cache of a scorer
+QUESTION_VECTOR_CACHE_SIZE = 1000
+# Number of chunks of candidate graphs to score in one forward pass
+SCORING_BATCH_SIZE = 10
+
+
+class GraphScorer:
+
+    def __init__(self, qa_model, word2idx=None, context=None, packed=False, cache_size=QUESTION_VECTOR_CACHE_SIZE,
+                 batch_size=SCORING_BATCH_SIZE):
+        """
+        Score a flat list of candidate graphs of one question. The question is encoded by the model once and its vector
+        is cached, the graphs are scored against the cached vector in chunks of the maximum number of graphs.
+        The model has to implement encode_questions and score_graphs (score_packed_graphs for the packed graphs).
+        The cached vectors are not updated with the model parameters, call clear after training the model further.
+
+        :param qa_model: a model, an instance of torch.nn.Module, or a fackel container of the model
+        :param word2idx: word to index mapping, vectorization.WORD_2_IDX is used if not given
+        :param context: a vectorization.EncodingContext with the shape limits
+        :param packed: encode the graphs of GNNModel as vectorization.PackedGraphs
+        :param cache_size: maximum number of question vectors to keep
+        :param batch_size: the number of chunks of graphs in one forward pass
+        """
+        self._model = getattr(qa_model, "_model", qa_model)
+        self._model_type = type(self._model).__name__
+        self._word2idx = word2idx
+        self._context = V.get_encoding_context(context)
+        self._packed = packed and self._model_type == "GNNModel"
+        self._batch_size = batch_size
+        self.question_vectors = V.GraphEncodingCache(cache_size)
+
+    def score(self, s, graphs):
+        """
+        :param s: a sentence object
+        :param graphs: a list of semantic graphs
+        :return: a numpy array with the model score of each graph
+        """
+        if len(graphs) == 0:
+            return np.zeros(0, dtype=np.float32)
+        training = self._model.training
+        self._model.eval()
+        try:
+            question_vectors = self._encode_question(s)
+            inputs = V.encode_candidate_graphs(s, graphs, self._model_type, self._word2idx, self._context,
+                                               packed=self._packed)
+            scores = []
+            for i in range(0, len(inputs[0]), self._batch_size):
+                batch = [m[i:i + self._batch_size] if not isinstance(m, V.PackedGraphs)
+                         else m[list(range(i, min(i + self._batch_size, len(m))))] for m in inputs]
+                scores.append(self._score_batch(question_vectors, batch).view(-1).data.cpu().numpy())
+        finally:
+            self._model.train(training)
+        return np.concatenate(scores)[:len(graphs)]
+
+    def clear(self):
+        self.question_vectors.clear()
+
+    def _encode_question(self, s):
+        questions_m = V.encode_for_model([s], self._model_type, self._word2idx, context=self._context,
+                                         inputs=["questions"])[0]
+        key = questions_m.shape, questions_m.tobytes()
+        question_vectors = self.question_vectors.get(key)
+        if question_vectors is None:
+            question_vectors = self._model.encode_questions(self._to_variable(questions_m))
+            if isinstance(question_vectors, tuple):
+                question_vectors = tuple(v.detach() for v in question_vectors)
+            else:
+                question_vectors = question_vectors.detach()
+            self.question_vectors.put(key, question_vectors)
+        return question_vectors
+
+    def _score_batch(self, question_vectors, batch):
+        rows = len(batch[0])
+        if isinstance(question_vectors, tuple):
+            question_vectors = tuple(v.expand(rows, v.size(-1)) for v in question_vectors)
+        else:
+            question_vectors = question_vectors.expand(rows, question_vectors.size(-1))
+        if self._packed:
+            arrays = [a for m in batch for a in (m.arrays() if isinstance(m, V.PackedGraphs) else (m,))]
+            return self._model.score_packed_graphs(question_vectors, *[self._to_variable(m) for m in arrays])
+        return self._model.score_graphs(question_vectors, *[self._to_variable(m) for m in batch])
+
+    def _to_variable(self, m):
+        m = Variable(torch.from_numpy(np.ascontiguousarray(m)))
+        if next(self._model.parameters()).is_cuda:
+            m = m.cuda()
+        return m
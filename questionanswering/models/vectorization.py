@@ -1,14 +1,22 @@
+import copy
+import functools
+import inspect
+import multiprocessing
+import threading
+from multiprocessing import sharedctypes
+
 import numpy as np
 
 from typing import List
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
-from questionanswering import _utils
-from questionanswering.construction.graph import SemanticGraph, Edge
+from questionanswering import _utils, resources
+from questionanswering.construction.graph import SemanticGraph, Edge, WithScore
 from questionanswering.construction.sentence import Sentence
 from questionanswering.grounding import graph_queries, stages
-from wikidata import scheme
+
+scheme = resources.lazy_import("wikidata.scheme")
 
 ENTITY_TOKEN = "<e>"
 SPECIAL_TOKENS = {
@@ -24,24 +32,508 @@ MAX_EDGES_PER_ENTITY = 4
 MAX_NEGATIVE_GRAPHS = 100
 
 WORD_2_IDX = None
+_vocabulary = None
+_property_table = None
+
+
+class EncodingContext:
+
+    def __init__(self,
+                 max_label_token_len=None,
+                 max_edges=None,
+                 max_edges_per_entity=None,
+                 max_negative_graphs=None,
+                 dynamic_shapes=False):
+        """
+        The shape limits of the encoded data. The context is passed to the encoders instead of changing the module
+        constants, the limits that are not given are the module constants. Labels, graphs and lists of candidate
+        graphs that exceed the limits are cut. Without dynamic_shapes the arrays always have the size of the limits,
+        with dynamic_shapes they are as large as the longest label and the largest graph of the batch.
+
+        :param max_label_token_len: the maximum number of tokens of a question or an edge label
+        :param max_edges: the maximum number of edges of a graph, the maximum number of nodes for GNNModel
+        :param max_edges_per_entity: the maximum number of neighbours of a node for GNNModel
+        :param max_negative_graphs: the maximum number of candidate graphs per question
+        :param dynamic_shapes: compute the shape of each batch from the encoded data, up to the limits
+        >>> EncodingContext(max_negative_graphs=50).limits()
+        {'max_label_token_len': 20, 'max_edges': 7, 'max_edges_per_entity': 4, 'max_negative_graphs': 50}
+        """
+        self.max_label_token_len = MAX_LABEL_TOKEN_LEN if max_label_token_len is None else max_label_token_len
+        self.max_edges = MAX_EDGES if max_edges is None else max_edges
+        self.max_edges_per_entity = MAX_EDGES_PER_ENTITY if max_edges_per_entity is None else max_edges_per_entity
+        self.max_negative_graphs = MAX_NEGATIVE_GRAPHS if max_negative_graphs is None else max_negative_graphs
+        self.dynamic_shapes = dynamic_shapes
+        # The adjacency matrices of the graph structure are uint8 and refer to the incoming edges as max_edges + id
+        assert 2 * self.max_edges < 256
+
+    def limits(self):
+        return {'max_label_token_len': self.max_label_token_len, 'max_edges': self.max_edges,
+                'max_edges_per_entity': self.max_edges_per_entity, 'max_negative_graphs': self.max_negative_graphs}
+
+
+def get_encoding_context(context=None):
+    """
+    :param context: an EncodingContext or None
+    :return: the given context or a context with the limits of the module constants
+    """
+    return context if context is not None else EncodingContext()
+
+
+# The inputs of each model in the order of the forward arguments: the encoder and the edge and the variant of
+# the labels that the model consumes (variant 0 replaces the entities with ENTITY_TOKEN, variant 1 keeps them).
+# Only the selected edges and variants are encoded.
+MODEL_INPUTS = {
+    "OneEdgeModel": (("questions", {'variant': 0}), ("graphs", {'edge': 0, 'variant': 0})),
+    "STAGGModel": (("questions", {}), ("graphs", {'edge': 0}), ("structural_features", {})),
+    "PooledEdgesModel": (("questions", {'variant': 1}), ("graphs", {'variant': 1})),
+    "GNNModel": (("questions", {'variant': 1}), ("graph_structure", {}))
+}
+
+# Maximum number of graphs to keep in the graph encoding cache
+GRAPH_CACHE_SIZE = 50000
+# Maximum number of questions to keep in the question encoding cache
+QUESTION_CACHE_SIZE = 5000
 
 
-def encode_for_model(selected_questions, model_type, word2idx=None):
+def encode_for_model(selected_questions, model_type, word2idx=None, ragged=False, workers=0, context=None,
+                     packed=False, inputs=None):
+    """
+    Encode the questions and their graphs as the input of the given model, see MODEL_INPUTS.
+
+    :param selected_questions: a list of sentence objects
+    :param model_type: the class name of the model
+    :param word2idx: word to index mapping, WORD_2_IDX is used if not given
+    :param ragged: keep the candidate graphs in the RaggedGraphs format, they are padded per mini-batch
+    :param workers: the number of worker processes, see encode_parallel
+    :param context: an EncodingContext with the shape limits
+    :param packed: encode the graph structure of GNNModel as PackedGraphs, see GNNModel.forward_packed
+    :param inputs: encode only the given kinds of inputs, such as ["graphs"], all inputs of the model if not given
+    :return: a tuple of model inputs
+    """
     assert word2idx or WORD_2_IDX
     if not word2idx:
         word2idx = WORD_2_IDX
-    samples = {
-        "OneEdgeModel": lambda: (encode_batch_questions(selected_questions, word2idx)[..., 0, :],
-                                 encode_batch_graphs(selected_questions, word2idx)[..., 0, 0, :]),
-        "STAGGModel": lambda: (encode_batch_questions(selected_questions, word2idx),
-                               encode_batch_graphs(selected_questions, word2idx)[..., 0, :, :],
-                               encode_structural_features(selected_questions)),
-        "PooledEdgesModel": lambda: (encode_batch_questions(selected_questions, word2idx)[..., 1, :],
-                                     encode_batch_graphs(selected_questions, word2idx)[..., 1, :]),
-        "GNNModel": lambda: (encode_batch_questions(selected_questions, word2idx)[..., 1, :],
-                             *encode_batch_graph_structure(selected_questions, word2idx))
-    }[model_type]()
-    return samples
+    encoders = {
+        "questions": encode_batch_questions,
+        "graphs": encode_batch_graphs_ragged if ragged else encode_batch_graphs,
+        "structural_features": encode_structural_features,
+        "graph_structure": encode_batch_graphs_packed if packed else encode_batch_graph_structure
+    }
+    encoded = encode_parallel([functools.partial(encoders[name], **selection)
+                               for name, selection in MODEL_INPUTS[model_type] if inputs is None or name in inputs],
+                              selected_questions, word2idx, workers=workers, context=context)
+    return tuple(m for output in encoded for m in (output if isinstance(output, tuple) else (output,)))
+
+
+def encode_candidate_graphs(s: Sentence, graphs: List[SemanticGraph], model_type, word2idx=None, context=None,
+                            packed=False):
+    """
+    Encode a flat list of candidate graphs of one question in chunks of the maximum number of graphs, the question
+    itself is not encoded. The chunks are the rows of the model inputs, the last chunk is padded.
+
+    :param s: a sentence object
+    :param graphs: a list of semantic graphs
+    :param model_type: the class name of the model
+    :param word2idx: word to index mapping, WORD_2_IDX is used if not given
+    :param context: an EncodingContext with the shape limits
+    :param packed: encode the graph structure of GNNModel as PackedGraphs
+    :return: a tuple of the model inputs without the questions
+    >>> s = Sentence(tagged=[{'originalText': k, 'pos': 'O', 'ner': 'O'} for k in "who played obama ?".split()], entities=[{'linkings': [['Q76', 'Barack Obama']], 'token_ids': [2], 'type': 'NNP'}])
+    >>> g = SemanticGraph([Edge(leftentityid=graph_queries.QUESTION_VAR, rightentityid="Q76", relationid="P175")])
+    >>> vocab = {_utils.all_zeroes: 0, _utils.unknown_el: 1}
+    >>> [m.shape for m in encode_candidate_graphs(s, [g] * 3, "PooledEdgesModel", vocab, EncodingContext(max_negative_graphs=2))]
+    [(2, 2, 7, 20)]
+    """
+    context = get_encoding_context(context)
+    chunk_size = context.max_negative_graphs
+    chunks = []
+    for i in range(0, len(graphs), chunk_size):
+        chunk = copy.copy(s)
+        chunk.graphs = [WithScore(g, (0.0, 0.0, 0.0)) for g in graphs[i:i + chunk_size]]
+        chunks.append(chunk)
+    return encode_for_model(chunks, model_type, word2idx, context=context, packed=packed,
+                            inputs=[name for name, _ in MODEL_INPUTS[model_type] if name != "questions"])
+
+
+def concatenate_inputs(parts, model_type):
+    """
+    Concatenate the model inputs of several batches. The arrays are padded to the largest shape, so that
+    the batches can be encoded with dynamic shapes.
+
+    :param parts: a list of tuples of model inputs as returned by encode_for_model
+    :param model_type: the class name of the model
+    :return: a list of model inputs
+    """
+    inputs, i = [], 0
+    for name, _ in MODEL_INPUTS[model_type]:
+        if isinstance(parts[0][i], PackedGraphs):
+            inputs.append(PackedGraphs.concatenate([p[i] for p in parts]))
+            i += 1
+        elif name == "graph_structure":
+            inputs.extend(_concatenate_graph_structures([tuple(p[i:i + 4]) for p in parts]))
+            i += 4
+        else:
+            inputs.append(_concatenate_padded([p[i] for p in parts]))
+            i += 1
+    return inputs
+
+
+def reorder_graphs(inputs, model_type, graph_orders):
+    """
+    Reorder the candidate graphs of each question in the encoded model inputs, the questions are not changed.
+
+    :param inputs: a tuple of model inputs as returned by encode_for_model
+    :param model_type: the class name of the model
+    :param graph_orders: a list with a permutation of the encoded graphs of each question
+    :return: a list of model inputs
+    """
+    reordered, i = [], 0
+    for name, _ in MODEL_INPUTS[model_type]:
+        if isinstance(inputs[i], (RaggedGraphs, PackedGraphs)):
+            reordered.append(inputs[i].reorder(graph_orders))
+            i += 1
+        elif name == "graph_structure":
+            reordered.extend(reorder_padded(m, graph_orders) for m in inputs[i:i + 4])
+            i += 4
+        else:
+            reordered.append(inputs[i] if name == "questions" else reorder_padded(inputs[i], graph_orders))
+            i += 1
+    return reordered
+
+
+def reorder_padded(m, graph_orders):
+    """
+    Reorder the graphs of each question in a padded array, the padding stays at the end.
+
+    :param m: a numpy array of shape (questions, graphs, ...)
+    :param graph_orders: a list with a permutation of the graphs of each question
+    :return: a numpy array of the same shape
+    >>> reorder_padded(np.array([[1, 2, 0], [3, 4, 5]]), [[1, 0], [2, 0, 1]]).tolist()
+    [[2, 1, 0], [5, 3, 4]]
+    """
+    indices = np.tile(np.arange(m.shape[1]), (len(m), 1))
+    for qi, graph_order in enumerate(graph_orders):
+        indices[qi, :len(graph_order)] = graph_order
+    return m[np.arange(len(m))[:, None], indices]
+
+
+def _reordered_graph_ids(graph_offsets, graph_orders):
+    """
+    :return: the ids of the graphs of all questions, each question in the given order
+    >>> _reordered_graph_ids(np.array([0, 2, 5]), [[1, 0], [0, 2, 1]]).tolist()
+    [1, 0, 2, 4, 3]
+    """
+    graph_counts = np.diff(graph_offsets)
+    assert [len(o) for o in graph_orders] == graph_counts.tolist()
+    return np.repeat(graph_offsets[:-1], graph_counts).astype(np.int64) + \
+        np.asarray([gi for o in graph_orders for gi in o], dtype=np.int64)
+
+
+def encode_parallel(encoders, questions: List[Sentence], vocab, workers=4, shard_size=256, context=None):
+    """
+    Run the batch encoders of this module on shards of the questions in a pool of worker processes.
+    The workers write the encoded shards directly into the output arrays that are allocated in shared memory.
+    RaggedGraphs, PackedGraphs and the shards encoded with dynamic shapes are sent back and concatenated instead.
+    The result is identical to calling the encoders on all questions at once.
+
+    :param encoders: a list of batch encoders, such as encode_batch_questions and encode_batch_graph_structure
+    :param questions: a list of sentence objects
+    :param vocab: word to index mapping
+    :param workers: the number of worker processes, the questions are encoded in the calling process if < 2
+    :param shard_size: the maximum number of questions per shard
+    :param context: an EncodingContext with the shape limits
+    :return: a list with the output of each encoder
+    """
+    context = get_encoding_context(context)
+    if workers < 2 or len(questions) < 2:
+        return [_run_encoder(encode, questions, vocab, context) for encode in encoders]
+    vocab = get_vocabulary(vocab)
+    # The number of graphs is fixed for all shards, the rest of the output shape doesn't depend on the questions
+    max_negative_graphs = _get_max_negative_graphs(questions, context=context)
+    outputs = []
+    for encode in encoders:
+        probe = None if context.dynamic_shapes else _run_encoder(encode, questions[:1], vocab, context,
+                                                                 max_negative_graphs)
+        if probe is None or isinstance(probe, (RaggedGraphs, PackedGraphs)):
+            outputs.append(None)
+            continue
+        buffers = []
+        for m in (probe if isinstance(probe, tuple) else (probe,)):
+            shape = (len(questions),) + m.shape[1:]
+            buffers.append((sharedctypes.RawArray('b', max(int(np.prod(shape)) * m.dtype.itemsize, 1)),
+                            m.dtype, shape))
+        outputs.append((isinstance(probe, tuple), buffers))
+
+    shard_size = max(min(shard_size, -(-len(questions) // (workers * 4))), 1)
+    shards = [(start, min(start + shard_size, len(questions))) for start in range(0, len(questions), shard_size)]
+    # Forked workers share the questions and the vocabulary with the calling process
+    mp_context = multiprocessing.get_context("fork") \
+        if "fork" in multiprocessing.get_all_start_methods() else multiprocessing.get_context()
+    with mp_context.Pool(min(workers, len(shards)), initializer=_init_encoding_worker,
+                         initargs=((encoders, questions, vocab, context, max_negative_graphs, outputs),)) as pool:
+        returned_shards = pool.map(_encode_shard, shards)
+
+    results = []
+    for ei, (encode, output) in enumerate(zip(encoders, outputs)):
+        if output is None:
+            results.append(_concatenate_encoded(encode, [shard[ei] for shard in returned_shards]))
+            continue
+        is_tuple, buffers = output
+        arrays = tuple(_shared_array(*buffer) for buffer in buffers)
+        results.append(arrays if is_tuple else arrays[0])
+    return results
+
+
+_encoding_state = None
+
+
+def _init_encoding_worker(state):
+    global _encoding_state
+    _encoding_state = state
+
+
+def _encode_shard(shard):
+    encoders, questions, vocab, context, max_negative_graphs, outputs = _encoding_state
+    start, end = shard
+    returned = []
+    for encode, output in zip(encoders, outputs):
+        encoded = _run_encoder(encode, questions[start:end], vocab, context, max_negative_graphs)
+        returned.append(encoded if output is None else None)
+        if output is not None:
+            is_tuple, buffers = output
+            for m, buffer in zip(encoded if is_tuple else (encoded,), buffers):
+                _shared_array(*buffer)[start:end] = m
+    return returned
+
+
+def _run_encoder(encode, questions, vocab, context, max_negative_graphs=None):
+    parameters = inspect.signature(encode).parameters
+    kwargs = {'context': context} if 'context' in parameters else {}
+    if max_negative_graphs is not None and 'max_negative_graphs' in parameters:
+        kwargs['max_negative_graphs'] = max_negative_graphs
+    return encode(questions, vocab, **kwargs) if 'vocab' in parameters else encode(questions, **kwargs)
+
+
+def _concatenate_encoded(encode, parts):
+    if isinstance(parts[0], (RaggedGraphs, PackedGraphs)):
+        return type(parts[0]).concatenate(parts)
+    if getattr(encode, 'func', encode) is encode_batch_graph_structure:
+        return _concatenate_graph_structures(parts)
+    if isinstance(parts[0], tuple):
+        return tuple(_concatenate_padded([p[i] for p in parts]) for i in range(len(parts[0])))
+    return _concatenate_padded(parts)
+
+
+def _concatenate_padded(arrays):
+    """
+    Concatenate the arrays along the first axis, the other axes are zero-padded to the largest size.
+
+    >>> _concatenate_padded([np.ones((1, 2)), np.ones((2, 3))]).tolist()
+    [[1.0, 1.0, 0.0], [1.0, 1.0, 1.0], [1.0, 1.0, 1.0]]
+    """
+    shape = np.max([m.shape for m in arrays], axis=0)
+    return np.concatenate([np.pad(m, [(0, 0)] + [(0, d - s) for s, d in zip(m.shape[1:], shape[1:])], 'constant')
+                           for m in arrays])
+
+
+def _shared_array(buffer, dtype, shape):
+    return np.frombuffer(buffer, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+
+def get_vocabulary(word2idx):
+    """
+    Wrap the word to index mapping into a Vocabulary object, the last object is reused to keep its memo.
+
+    :param word2idx: a dictionary or a Vocabulary
+    :return: a Vocabulary
+    """
+    global _vocabulary
+    if isinstance(word2idx, _utils.Vocabulary):
+        return word2idx
+    if _vocabulary is None or _vocabulary.word2idx is not word2idx:
+        _vocabulary = _utils.Vocabulary(word2idx)
+    return _vocabulary
+
+
+class PropertyTable:
+
+    def __init__(self, property2label):
+        """
+        A compact table of the knowledge base properties. The labels are tokenized once, their token ids are
+        computed once per vocabulary version and stored in one array, the frequencies and the types are arrays too.
+
+        :param property2label: a dictionary of property metadata as in wikidata.scheme.property2label
+        >>> table = PropertyTable({"P585": {"label": "point in time", "freq": 100, "type": "time"}})
+        >>> table.label_ids("P585", _utils.Vocabulary({_utils.all_zeroes: 0, _utils.unknown_el: 1, "point": 2, "time": 3})).tolist()
+        [2, 1, 3]
+        >>> table.label_ids("P31", _utils.Vocabulary({_utils.all_zeroes: 0, _utils.unknown_el: 1})) is None
+        True
+        >>> table.freq("P585"), table.type("P585")
+        (100, 'time')
+        """
+        self.property2label = property2label
+        self.property_ids = sorted(property2label)
+        self.property2row = {p: i for i, p in enumerate(self.property_ids)}
+        self.label_tokens = [_utils.split_pattern.split(property2label[p]['label']) for p in self.property_ids]
+        self.freqs = np.asarray([property2label[p].get('freq', 0) for p in self.property_ids], dtype=np.int64)
+        self.type_names = sorted({property2label[p].get('type', "") for p in self.property_ids})
+        self.types = np.asarray([self.type_names.index(property2label[p].get('type', ""))
+                                 for p in self.property_ids], dtype=np.int16)
+        self._vocab = None
+        self._vocab_version = None
+        self._label_ids = None
+        self._label_offsets = None
+
+    def freq(self, property_id):
+        return int(self.freqs[self.property2row[property_id]])
+
+    def type(self, property_id):
+        return self.type_names[self.types[self.property2row[property_id]]]
+
+    def label_ids(self, property_id, vocab):
+        """
+        :param property_id: a property id
+        :param vocab: a Vocabulary
+        :return: a numpy array of the token ids of the property label or None if the property is not in the table
+        """
+        row = self.property2row.get(property_id)
+        if row is None:
+            return None
+        if self._vocab is not vocab or self._vocab_version != vocab.check_version():
+            self._index_labels(vocab)
+        return self._label_ids[self._label_offsets[row]:self._label_offsets[row + 1]]
+
+    def _index_labels(self, vocab):
+        self._label_ids = vocab.to_ids([t for tokens in self.label_tokens for t in tokens])
+        self._label_offsets = np.zeros(len(self.label_tokens) + 1, dtype=np.int64)
+        self._label_offsets[1:] = np.cumsum([len(tokens) for tokens in self.label_tokens])
+        self._vocab = vocab
+        self._vocab_version = vocab.check_version()
+
+
+def get_property_table():
+    """
+    :return: the PropertyTable for the current wikidata.scheme.property2label
+    """
+    global _property_table
+    if _property_table is None or _property_table.property2label is not scheme.property2label:
+        _property_table = PropertyTable(scheme.property2label)
+    return _property_table
+
+
+class GraphEncodingCache:
+
+    def __init__(self, max_size=GRAPH_CACHE_SIZE):
+        """
+        An LRU cache of the encoded rows of the candidate graphs or the questions. The same graph is encoded again
+        in every epoch and every time it is scored during the search, the cached rows are copied into the batch instead.
+        The cache is cleared when it is used with a different vocabulary.
+
+        :param max_size: maximum number of entries to keep
+        >>> cache = GraphEncodingCache(max_size=1)
+        >>> cache.put(("a",), 1); cache.put(("b",), 2)
+        >>> cache.get(("a",)), cache.get(("b",))
+        (None, 2)
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._vocab = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def use_vocabulary(self, vocab):
+        """
+        Clear the cache if the vocabulary object is not the one that the cached rows were encoded with.
+
+        :param vocab: a Vocabulary
+        """
+        with self._lock:
+            if self._vocab is not vocab:
+                self._entries.clear()
+                self._vocab = vocab
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+# Set to None to disable caching of the encoded graphs
+graph_cache = GraphEncodingCache()
+# Set to None to disable caching of the encoded questions
+question_cache = GraphEncodingCache(QUESTION_CACHE_SIZE)
+
+
+def _graph_cache_key(kind, g: SemanticGraph, entity2label, entity2type, vocab, encoding_context):
+    """
+    The key of the encoded graph rows: the edges of the graph, labels and types of its entities, the vocabulary version
+    and the shape limits.
+    """
+    edges = tuple((e.leftentityid, e.relationid, e.rightentityid, e.qualifierrelationid, e.qualifierentityid)
+                  for e in g.edges)
+    nodes = {n[3:] if n.startswith("?") else n for e in g.edges for n in e.nodes() if n}
+    context = tuple(sorted((n, entity2label.get(n), entity2type.get(n)) for n in nodes))
+    return kind, edges, context, vocab.check_version(), encoding_context.max_edges, \
+        encoding_context.max_edges_per_entity, encoding_context.max_label_token_len
+
+
+def _encode_with_cache(kind, encode, g: SemanticGraph, entity2label, entity2type, vocab, context, **kwargs):
+    if graph_cache is None:
+        return encode(g, entity2label, entity2type, vocab, context, **kwargs)
+    graph_cache.use_vocabulary(vocab)
+    key = _graph_cache_key(kind, g, entity2label, entity2type, vocab, context)
+    rows = graph_cache.get(key)
+    if rows is None:
+        rows = encode(g, entity2label, entity2type, vocab, context, **kwargs)
+        graph_cache.put(key, rows)
+    return rows
+
+
+def get_vocabulary_tokens(questions: List[Sentence]):
+    """
+    Collect all tokens that the encoders look up for the given questions and their graphs.
+
+    :param questions: a list of sentence objects
+    :return: a set of tokens
+    >>> sorted(get_vocabulary_tokens([Sentence(input_text="who is obama ?", tagged=[{'originalText': k, 'pos': 'O', 'ner': 'O'} for k in "who is Obama ?".split()], entities=[{'linkings': [['Q76', 'Barack Obama']], 'token_ids': [2], 'type': 'NNP'}])]))
+    ['<e>', '<f>', '<s>', '?', 'Barack', 'Obama', 'human', 'is', 'who']
+    """
+    tokens = set()
+    for s in questions:
+        entity2label = {k: l for e in s.entities for k, l in e['linkings']}
+        entity2type = {k: e['type'] for e in s.entities for k, l in e['linkings']}
+        for replace_entities in [True, False]:
+            tokens.update(_get_sentence_tokens(s, replace_entities=replace_entities, mark_boundaries=True))
+        tokens.update(t for l in entity2label.values() if l for t in _utils.split_pattern.split(l))
+        for g in s.graphs:
+            for e in g.graph.edges:
+                for replace_entities in [True, False]:
+                    tokens.update(_get_edge_str_representation(e, entity2label, entity2type,
+                                                               replace_entities=replace_entities,
+                                                               mark_boundaries=True))
+    return tokens
 
 
 def extend_embeddings_with_special_tokens(embeddings, word2idx):
@@ -58,43 +550,342 @@ def extend_embeddings_with_special_tokens(embeddings, word2idx):
     return embeddings, word2idx
 
 
-def encode_batch_graphs(questions: List[Sentence], vocab):
-    max_negative_graphs = min(max(len(s.graphs) for s in questions), MAX_NEGATIVE_GRAPHS)
-    out = np.zeros((len(questions), max_negative_graphs, MAX_EDGES, 2, MAX_LABEL_TOKEN_LEN), dtype=np.int32)
-    for i, s in enumerate(questions):  # Iterate over lists of graphs for questions
+def encode_batch_graphs(questions: List[Sentence], vocab, max_negative_graphs=None, edge=None, variant=None,
+                        context=None):
+    """
+    Encode the labels of the edges of the candidate graphs. Each edge label has two variants: 0 replaces
+    the entities with ENTITY_TOKEN and 1 keeps the entity labels.
+
+    :param questions: a list of sentence objects
+    :param vocab: word to index mapping
+    :param max_negative_graphs: the number of graphs per question, by default the largest number of graphs
+                                up to the limit of the context
+    :param edge: encode only the given edge of each graph, the output is the same as out[:, :, edge]
+    :param variant: encode only the given variant of each edge, the output is the same as out[..., variant, :]
+    :param context: an EncodingContext with the shape limits
+    :return: a numpy array of shape (questions, graphs, max_edges, 2, max_label_token_len)
+    """
+    vocab = get_vocabulary(vocab)
+    context = get_encoding_context(context)
+    max_negative_graphs = _get_max_negative_graphs(questions, max_negative_graphs, context)
+    rows = _encode_batch_graph_rows(questions, vocab, max_negative_graphs, edge, variant, context)
+    max_edges, max_len = context.max_edges if edge is None else 1, context.max_label_token_len
+    if context.dynamic_shapes:
+        lengths = [np.count_nonzero(r, axis=-1) for q_rows in rows for r in q_rows]
+        max_edges = max([np.count_nonzero(l.sum(axis=-1)) for l in lengths] + [1]) if edge is None else 1
+        max_len = max([l.max(initial=0) for l in lengths] + [1])
+    out = np.zeros((len(questions), max_negative_graphs, max_edges, 2 if variant is None else 1, max_len),
+                   dtype=np.int32)
+    for i, q_rows in enumerate(rows):
+        for gi, r in enumerate(q_rows):
+            out[i, gi] = r[:max_edges, :, :max_len]
+    return out.reshape(tuple(d for i, d in enumerate(out.shape)
+                             if not (i == 2 and edge is not None or i == 3 and variant is not None)))
+
+
+def _encode_batch_graph_rows(questions, vocab, max_negative_graphs, edge, variant, context):
+    rows = []
+    for s in questions:  # Iterate over lists of graphs for questions
         entity2label = {k: l for e in s.entities for k, l in e['linkings']}
         entity2type = {k: e['type'] for e in s.entities for k, l in e['linkings']}
-        for gi, g in enumerate(s.graphs[:max_negative_graphs]):  # Iterate over graph alternatives for a question
-                main_edges = [e for e in g.graph.edges
-                              if graph_queries.QUESTION_VAR in e.nodes()
-                              and e.relationid not in graph_queries.sparql_class_relation] \
-                             + [e for e in g.graph.edges if e.relationid in graph_queries.sparql_class_relation]
-                for ei, e in enumerate(main_edges[:MAX_EDGES]):
-                    word_ids = [vocab[w.lower()]
-                                for w in _get_edge_str_representation(e, entity2label, entity2type,
-                                                                      replace_entities=True,
-                                                                      mark_boundaries=True)][:MAX_LABEL_TOKEN_LEN]
-                    out[i, gi, ei, 0, :len(word_ids)] = word_ids
-                    word_ids = [vocab[w.lower()]
-                                for w in _get_edge_str_representation(e, entity2label, entity2type,
-                                                                      replace_entities=False,
-                                                                      mark_boundaries=True)][:MAX_LABEL_TOKEN_LEN]
-                    out[i, gi, ei, 1, :len(word_ids)] = word_ids
-    return out
+        rows.append([_encode_with_cache(("edges", edge, variant), _encode_graph_edges, g.graph,
+                                        entity2label, entity2type, vocab, context, edge=edge, variant=variant)
+                     for g in s.graphs[:max_negative_graphs]])  # Iterate over graph alternatives for a question
+    return rows
 
 
-def encode_batch_questions(questions: List[Sentence], vocab):
-    out = np.zeros((len(questions), 2,  MAX_LABEL_TOKEN_LEN), dtype=np.int32)
-    for i, s in enumerate(questions):  # Iterate over lists of graphs for questions
-        word_ids = [vocab[w.lower()] for w in _get_sentence_tokens(s, replace_entities=True, mark_boundaries=True)][:MAX_LABEL_TOKEN_LEN]
-        out[i, 0, :len(word_ids)] = word_ids
-        word_ids = [vocab[w.lower()] for w in _get_sentence_tokens(s, replace_entities=False, mark_boundaries=True)][:MAX_LABEL_TOKEN_LEN]
-        out[i, 1, :len(word_ids)] = word_ids
+def _encode_graph_edges(g: SemanticGraph, entity2label, entity2type, vocab, context, edge=None, variant=None):
+    max_len = context.max_label_token_len
+    out = np.zeros((context.max_edges if edge is None else 1, 2 if variant is None else 1, max_len), dtype=np.int32)
+    main_edges = [e for e in g.edges
+                  if graph_queries.QUESTION_VAR in e.nodes()
+                  and e.relationid not in graph_queries.sparql_class_relation] \
+                 + [e for e in g.edges if e.relationid in graph_queries.sparql_class_relation]
+    main_edges = main_edges[:context.max_edges] if edge is None else main_edges[edge:edge + 1]
+    for ei, e in enumerate(main_edges):
+        for vi, v in enumerate([0, 1] if variant is None else [variant]):
+            word_ids = _get_edge_ids(e, entity2label, entity2type, vocab,
+                                     replace_entities=v == 0,
+                                     mark_boundaries=True)[:max_len]
+            out[ei, vi, :len(word_ids)] = word_ids
     return out
 
 
-def encode_structural_features(questions: List[Sentence]):
-    max_negative_graphs = min(max(len(s.graphs) for s in questions), MAX_NEGATIVE_GRAPHS)
+class RaggedGraphs:
+
+    def __init__(self, graph_offsets, edge_offsets, token_offsets, token_ids, shape, edge=None, variant=None):
+        """
+        Encoded candidate graphs without the padding, in the CSR format: graph_offsets[i]:graph_offsets[i + 1] are
+        the graphs of the question i, edge_offsets[g]:edge_offsets[g + 1] are the edges of the graph g and
+        token_offsets[e * variants + v]:token_offsets[e * variants + v + 1] are the token ids of the variant v of
+        the edge e. Use encode_batch_graphs_ragged to create it and pad to get the dense array of encode_batch_graphs.
+
+        :param graph_offsets: a numpy array of question offsets into the graphs
+        :param edge_offsets: a numpy array of graph offsets into the edges
+        :param token_offsets: a numpy array of edge variant offsets into token_ids
+        :param token_ids: a numpy array of token ids, uint16 if the vocabulary is small enough, otherwise uint32
+        :param shape: the dense shape (questions, graphs, MAX_EDGES, variants, MAX_LABEL_TOKEN_LEN)
+        :param edge: select only the given edge of each graph as in dense[:, :, edge]
+        :param variant: select only the given variant of each edge as in dense[..., variant, :]
+        """
+        self.graph_offsets = graph_offsets
+        self.edge_offsets = edge_offsets
+        self.token_offsets = token_offsets
+        self.token_ids = token_ids
+        self.dense_shape = shape
+        self.edge = edge
+        self.variant = variant
+        self._sizes = None
+
+    def __len__(self):
+        return len(self.graph_offsets) - 1
+
+    @property
+    def shape(self):
+        return tuple(d for i, d in enumerate(self.dense_shape)
+                     if not (i == 2 and self.edge is not None or i == 3 and self.variant is not None))
+
+    @property
+    def nbytes(self):
+        return self.graph_offsets.nbytes + self.edge_offsets.nbytes + self.token_offsets.nbytes + self.token_ids.nbytes
+
+    @staticmethod
+    def load(path_prefix, mmap_mode='r'):
+        """
+        Load the arrays saved with RaggedGraphs.save, by default they are memory-mapped.
+        """
+        shape = np.load(path_prefix + ".shape.npy")
+        edge, variant = [int(d) if d >= 0 else None for d in shape[5:]]
+        return RaggedGraphs(*[np.load(path_prefix + f".{name}.npy", mmap_mode=mmap_mode)
+                              for name in ["graph_offsets", "edge_offsets", "token_offsets", "token_ids"]],
+                            shape=tuple(int(d) for d in shape[:5]), edge=edge, variant=variant)
+
+    def save(self, path_prefix):
+        np.save(path_prefix + ".graph_offsets.npy", self.graph_offsets)
+        np.save(path_prefix + ".edge_offsets.npy", self.edge_offsets)
+        np.save(path_prefix + ".token_offsets.npy", self.token_offsets)
+        np.save(path_prefix + ".token_ids.npy", self.token_ids)
+        np.save(path_prefix + ".shape.npy", np.asarray(list(self.dense_shape) + [-1 if d is None else d for d in
+                                                                                 [self.edge, self.variant]]))
+
+    @staticmethod
+    def concatenate(parts):
+        """
+        :param parts: a list of RaggedGraphs objects with the same edge and variant selection
+        :return: a RaggedGraphs object with the questions of all parts, the dense shape is the largest shape
+        """
+        offsets = []
+        for name in ["graph_offsets", "edge_offsets", "token_offsets"]:
+            shifts = np.cumsum([0] + [getattr(p, name)[-1] for p in parts[:-1]])
+            offsets.append(np.concatenate([getattr(p, name)[:-1] + shift for p, shift in zip(parts, shifts)] +
+                                          [[getattr(parts[-1], name)[-1] + shifts[-1]]]).astype(np.int64))
+        return RaggedGraphs(*offsets, np.concatenate([p.token_ids for p in parts]),
+                            (sum(len(p) for p in parts),) + tuple(np.max([p.dense_shape[1:] for p in parts],
+                                                                         axis=0).tolist()),
+                            edge=parts[0].edge, variant=parts[0].variant)
+
+    def select(self, edge=None, variant=None):
+        """
+        :return: a RaggedGraphs object that shares the data and pads only the given edge and variant
+        """
+        return RaggedGraphs(self.graph_offsets, self.edge_offsets, self.token_offsets, self.token_ids,
+                            self.dense_shape, edge=edge, variant=variant)
+
+    def reorder(self, graph_orders):
+        """
+        :param graph_orders: a list with a permutation of the graphs of each question
+        :return: a RaggedGraphs object with the graphs of each question in the given order
+        """
+        graph_ids = _reordered_graph_ids(self.graph_offsets, graph_orders)
+        edge_ids, _, edge_counts = _expand_ranges(self.edge_offsets[graph_ids], self.edge_offsets[graph_ids + 1])
+        variants = self.dense_shape[3]
+        rows = (edge_ids[:, None] * variants + np.arange(variants)).reshape(-1)
+        token_ids, _, token_counts = _expand_ranges(self.token_offsets[rows], self.token_offsets[rows + 1])
+        return RaggedGraphs(np.asarray(self.graph_offsets), _to_offsets(edge_counts), _to_offsets(token_counts),
+                            self.token_ids[token_ids], self.dense_shape, edge=self.edge, variant=self.variant)
+
+    def sizes(self):
+        """
+        :return: a numpy array with the number of graphs, the largest number of edges and the longest selected
+                 label of each question, shape (questions, 3)
+        """
+        if self._sizes is None:
+            variants = self.dense_shape[3]
+            graph_counts = np.diff(self.graph_offsets)
+            graph_questions = np.repeat(np.arange(len(self)), graph_counts)
+            edge_counts = np.diff(self.edge_offsets)
+            edge_questions = np.repeat(graph_questions, edge_counts)
+            edge_pos = np.arange(len(edge_questions)) - np.repeat(self.edge_offsets[:-1], edge_counts)
+            token_counts = np.diff(self.token_offsets).reshape(-1, variants)
+            if self.variant is not None:
+                token_counts = token_counts[:, [self.variant]]
+            keep = edge_pos == self.edge if self.edge is not None else slice(None)
+            sizes = np.zeros((len(self), 3), dtype=np.int64)
+            sizes[:, 0] = graph_counts
+            np.maximum.at(sizes[:, 1], graph_questions, edge_counts)
+            np.maximum.at(sizes[:, 2], edge_questions[keep], token_counts.max(axis=-1, initial=0)[keep])
+            self._sizes = sizes
+        return self._sizes
+
+    def pad(self, indices=None, trim=False):
+        """
+        Pad the selected questions to the dense shape.
+
+        :param indices: a list of question indices, all questions if not given
+        :param trim: pad only to the largest number of graphs, edges and tokens among the selected questions
+        :return: a numpy array of int32, same as the corresponding part of the encode_batch_graphs output
+        """
+        if indices is None:
+            indices = np.arange(len(self))
+        indices = np.asarray(indices, dtype=np.int64)
+        _, max_graphs, max_edges, variants, max_len = self.dense_shape
+        if trim and len(indices) > 0:
+            max_graphs, max_edges, max_len = np.maximum(self.sizes()[indices].max(axis=0), 1)
+        selected_variants = np.arange(variants) if self.variant is None else np.asarray([self.variant])
+        out = np.zeros((len(indices), max_graphs, max_edges if self.edge is None else 1, len(selected_variants),
+                        max_len), dtype=np.int32)
+
+        graph_ids, graph_pos, graph_counts = _expand_ranges(self.graph_offsets[indices],
+                                                            self.graph_offsets[indices + 1])
+        question_pos = np.repeat(np.arange(len(indices)), graph_counts)
+        edge_ids, edge_pos, edge_counts = _expand_ranges(self.edge_offsets[graph_ids], self.edge_offsets[graph_ids + 1])
+        edge_graphs = np.repeat(np.arange(len(graph_ids)), edge_counts)
+        if self.edge is not None:
+            keep = edge_pos == self.edge
+            edge_ids, edge_graphs, edge_pos = edge_ids[keep], edge_graphs[keep], np.zeros(keep.sum(), dtype=np.int64)
+
+        # One row per selected variant of each edge
+        rows = (edge_ids[:, None] * variants + selected_variants).reshape(-1)
+        token_ids, token_pos, token_counts = _expand_ranges(self.token_offsets[rows], self.token_offsets[rows + 1])
+        token_rows = np.repeat(np.arange(len(rows)), token_counts)
+        token_edges = token_rows // len(selected_variants)
+        token_graphs = edge_graphs[token_edges]
+        out[question_pos[token_graphs], graph_pos[token_graphs], edge_pos[token_edges],
+            token_rows % len(selected_variants), token_pos] = self.token_ids[token_ids]
+        if self.variant is not None:
+            out = out[..., 0, :]
+        if self.edge is not None:
+            out = out[:, :, 0]
+        return out
+
+
+def _expand_ranges(starts, ends):
+    """
+    :return: the concatenated ranges, the position of each element within its range and the lengths of the ranges
+    >>> [a.tolist() for a in _expand_ranges(np.array([3, 10]), np.array([5, 13]))]
+    [[3, 4, 10, 11, 12], [0, 1, 0, 1, 2], [2, 3]]
+    """
+    counts = ends - starts
+    positions = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(starts, counts) + positions, positions, counts
+
+
+def encode_batch_graphs_ragged(questions: List[Sentence], vocab, max_negative_graphs=None, edge=None, variant=None,
+                               context=None):
+    """
+    Same as encode_batch_graphs, but the result is stored without padding.
+
+    :param questions: a list of sentence objects
+    :param vocab: word to index mapping
+    :param max_negative_graphs: the number of graphs per question, by default the largest number of graphs
+                                up to the limit of the context
+    :param edge: encode and pad only the given edge of each graph
+    :param variant: encode and pad only the given variant of each edge
+    :param context: an EncodingContext with the shape limits
+    :return: a RaggedGraphs object
+    """
+    vocab = get_vocabulary(vocab)
+    context = get_encoding_context(context)
+    max_negative_graphs = _get_max_negative_graphs(questions, max_negative_graphs, context)
+    graph_counts, edge_counts, token_counts, token_ids = [], [], [], []
+    for s in questions:
+        entity2label = {k: l for e in s.entities for k, l in e['linkings']}
+        entity2type = {k: e['type'] for e in s.entities for k, l in e['linkings']}
+        graphs = s.graphs[:max_negative_graphs]
+        graph_counts.append(len(graphs))
+        if not graphs:
+            continue
+        rows = np.stack([_encode_with_cache(("edges", edge, variant), _encode_graph_edges, g.graph,
+                                            entity2label, entity2type, vocab, context, edge=edge, variant=variant)
+                         for g in graphs])
+        # Token id 0 is only used for padding and every encoded edge has at least the boundary tokens
+        lengths = np.count_nonzero(rows, axis=-1)
+        edge_mask = lengths.sum(axis=-1) > 0
+        edge_counts.append(edge_mask.sum(axis=-1))
+        token_counts.append(lengths[edge_mask].reshape(-1))
+        token_ids.append(rows[rows != 0])
+    edge_counts = np.concatenate(edge_counts) if edge_counts else np.zeros(0, dtype=np.int64)
+    token_counts = np.concatenate(token_counts) if token_counts else np.zeros(0, dtype=np.int64)
+    max_edges, max_len = context.max_edges if edge is None else 1, context.max_label_token_len
+    if context.dynamic_shapes:
+        max_edges, max_len = min(max_edges, edge_counts.max(initial=1)), token_counts.max(initial=1)
+    dtype = np.uint16 if len(vocab) <= np.iinfo(np.uint16).max + 1 else np.uint32
+    return RaggedGraphs(_to_offsets(graph_counts), _to_offsets(edge_counts), _to_offsets(token_counts),
+                        np.concatenate(token_ids).astype(dtype) if token_ids else np.zeros(0, dtype=dtype),
+                        (len(questions), max_negative_graphs, int(max_edges), 2 if variant is None else 1,
+                         int(max_len)),
+                        edge=None if edge is None else 0, variant=None if variant is None else 0)
+
+
+def _get_max_negative_graphs(questions, max_negative_graphs=None, context=None):
+    if max_negative_graphs is not None:
+        return max_negative_graphs
+    return min(max(len(s.graphs) for s in questions), get_encoding_context(context).max_negative_graphs)
+
+
+def _to_offsets(counts):
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+    return offsets
+
+
+def encode_batch_questions(questions: List[Sentence], vocab, variant=None, context=None):
+    """
+    Encode the tokens of the questions in two variants: 0 replaces the entities with ENTITY_TOKEN and 1 keeps
+    the entity tokens.
+
+    :param questions: a list of sentence objects
+    :param vocab: word to index mapping
+    :param variant: encode only the given variant, the output is the same as out[:, variant]
+    :param context: an EncodingContext with the shape limits
+    :return: a numpy array of shape (questions, 2, max_label_token_len)
+    """
+    vocab = get_vocabulary(vocab)
+    context = get_encoding_context(context)
+    variants = [0, 1] if variant is None else [variant]
+    rows = [[_question_token_ids(s, v, vocab, context) for v in variants] for s in questions]
+    max_len = context.max_label_token_len
+    if context.dynamic_shapes:
+        max_len = max([len(ids) for question_rows in rows for ids in question_rows] + [1])
+    out = np.zeros((len(questions), len(variants), max_len), dtype=np.int32)
+    for i, question_rows in enumerate(rows):
+        for j, ids in enumerate(question_rows):
+            out[i, j, :len(ids)] = ids
+    return np.ascontiguousarray(out[:, 0]) if variant is not None else out
+
+
+def _question_token_ids(s: Sentence, variant, vocab, context):
+    """
+    The token ids of one variant of the question without the padding, cut at the maximum label length. The ids are
+    cached, the question is encoded again for every chunk of its candidate graphs during the search.
+    """
+    def encode():
+        tokens = _get_sentence_tokens(s, replace_entities=variant == 0, mark_boundaries=True)
+        return vocab.to_ids(tokens, context.max_label_token_len)
+    if question_cache is None:
+        return encode()
+    question_cache.use_vocabulary(vocab)
+    key = variant, tuple(s.tokens), tuple((e['type'], tuple(e['token_ids'])) for e in s.entities), \
+        vocab.check_version(), context.max_label_token_len
+    ids = question_cache.get(key)
+    if ids is None:
+        ids = encode()
+        question_cache.put(key, ids)
+    return ids
+
+
+def encode_structural_features(questions: List[Sentence], max_negative_graphs=None, context=None):
+    max_negative_graphs = _get_max_negative_graphs(questions, max_negative_graphs, context)
     out = np.zeros((len(questions), max_negative_graphs, 7), dtype=np.int32)
     for i, s in enumerate(questions):  # Iterate over lists of graphs for questions
         tokens = {t.lower() for t in s.tokens}
@@ -174,6 +965,34 @@ def _get_edge_str_representation(edge: Edge, entity2label, entity2type,
     return property_label
 
 
+def _get_edge_ids(edge: Edge, entity2label, entity2type, vocab,
+                  replace_entities=True,
+                  mark_boundaries=False,
+                  no_entity=False):
+    """
+    Same as vocab.to_ids(_get_edge_str_representation(...)), but the property labels are taken from the precomputed
+    property table.
+
+    >>> vocab = _utils.Vocabulary({_utils.all_zeroes: 0, _utils.unknown_el: 1, "capital": 2, "point": 3, "time": 4, "<s>": 5, "<f>": 6})
+    >>> _get_edge_ids(Edge(leftentityid=graph_queries.QUESTION_VAR, rightentityid="MAX", relationid="P36", qualifierrelationid="P585"), {}, {}, vocab, no_entity=True, mark_boundaries=True).tolist()
+    [5, 2, 3, 1, 4, 6]
+    """
+    table = get_property_table()
+    spans = []
+    relation_ids = table.label_ids(edge.relationid, vocab)
+    spans.append(relation_ids if relation_ids is not None else vocab.to_ids([""]))
+    qualifier_ids = table.label_ids(edge.qualifierrelationid, vocab)
+    if qualifier_ids is not None:
+        spans.append(qualifier_ids)
+    entity_kbids = [n for n in edge.nodes() if n and n != graph_queries.QUESTION_VAR]
+    if any(entity_kbids) and not no_entity:
+        spans.append(vocab.to_ids(_entity_kbid2token(entity_kbids[0], entity2label, entity2type, replace_entities,
+                                                     mark_boundaries=False)))
+    if mark_boundaries:
+        spans = [vocab.to_ids(SENT_TOKENS[0:1])] + spans + [vocab.to_ids(SENT_TOKENS[1:2])]
+    return np.concatenate(spans)
+
+
 def _entity_kbid2token(entity_kbid, entity2label, entity2type, replace_entities, mark_boundaries=False, resolve_m=True):
     if entity_kbid in {"MIN", "MAX"}:
         tokens = [SPECIAL_TOKENS[entity_kbid]]
@@ -194,72 +1013,375 @@ def _entity_kbid2token(entity_kbid, entity2label, entity2type, replace_entities,
     return tokens
 
 
-def encode_batch_graph_structure(questions: List[Sentence], vocab):
-    max_negative_graphs = min(max(len(s.graphs) for s in questions), MAX_NEGATIVE_GRAPHS)
-
-    out_nodes = np.zeros((len(questions), max_negative_graphs, MAX_EDGES, MAX_LABEL_TOKEN_LEN//2), dtype=np.int32)
-    out_edges = np.zeros((len(questions), max_negative_graphs, MAX_EDGES, MAX_LABEL_TOKEN_LEN//2), dtype=np.int32)
+def encode_batch_graph_structure(questions: List[Sentence], vocab, max_negative_graphs=None, context=None):
+    """
+    Encode the candidate graphs as node and edge labels and adjacency lists for GNNModel. Row 0 is padding,
+    row 1 is the question variable. A_edges refers to the outgoing edge i as i and to the incoming edge i as
+    rows + i, where rows is the number of rows of the edges array.
 
-    out_A_nodes = np.zeros((len(questions), max_negative_graphs, MAX_EDGES, MAX_EDGES_PER_ENTITY), dtype=np.uint8)
-    out_A_edges = np.zeros((len(questions), max_negative_graphs, MAX_EDGES, MAX_EDGES_PER_ENTITY), dtype=np.uint8)
+    :param questions: a list of sentence objects
+    :param vocab: word to index mapping
+    :param max_negative_graphs: the number of graphs per question, by default the largest number of graphs
+                                up to the limit of the context
+    :param context: an EncodingContext with the shape limits
+    :return: a tuple of numpy arrays nodes, edges, A_nodes, A_edges of shape
+             (questions, graphs, max_edges, max_label_token_len // 2) and (questions, graphs, max_edges,
+             max_edges_per_entity)
+    """
+    vocab = get_vocabulary(vocab)
+    context = get_encoding_context(context)
+    max_negative_graphs = _get_max_negative_graphs(questions, max_negative_graphs, context)
 
-    for i, s in enumerate(questions):  # Iterate over lists of graphs for questions
+    rows = []
+    for s in questions:  # Iterate over lists of graphs for questions
         entity2label = {k: l for e in s.entities for k, l in e['linkings']}
         entity2type = {k: e['type'] for e in s.entities for k, l in e['linkings']}
+        # Iterate over graph alternatives for a question
+        rows.append([_encode_with_cache("structure", _encode_graph_structure, g.graph, entity2label, entity2type,
+                                        vocab, context) for g in s.graphs[:max_negative_graphs]])
 
-        for gi, g in enumerate(s.graphs[:max_negative_graphs]):  # Iterate over graph alternatives for a question
-            edges = [e for e in g.graph.edges
-                     if e.relationid not in graph_queries.sparql_class_relation] \
-                         + [e for e in g.graph.edges if e.relationid in graph_queries.sparql_class_relation]
-
-            # edges = edges[:(MAX_EDGES - 2)]
-            nodes = {n for e in edges for n in e.nodes() if n} - {graph_queries.QUESTION_VAR}
-            nodes = list(nodes)[:(MAX_EDGES - 2)]  # The first row in the matrix is 0 padding and the second is the Qvar
-            node2id = {n: ni for ni, n in enumerate(nodes, start=2)}
-
-            for n, ni in node2id.items():
-                entity_tokens = _entity_kbid2token(n, entity2label, entity2type,
-                                                   replace_entities=False,
-                                                   mark_boundaries=False, resolve_m=False)
-                if entity_tokens:
-                    word_ids = [vocab[w.lower()] for w in entity_tokens][:MAX_LABEL_TOKEN_LEN//2]
-                    out_nodes[i, gi, ni, :len(word_ids)] = word_ids
-                else:
-                    out_nodes[i, gi, ni, 0] = vocab[ENTITY_TOKEN.lower()]
-            node2id[graph_queries.QUESTION_VAR] = 1
-            out_nodes[i, gi, 1] = 1
-
-            temp_edges = defaultdict(list)
-            temp_nodes = defaultdict(list)
-            for ei, e in enumerate(edges, start=1):
-                property_tokens = _get_edge_str_representation(e, entity2label, entity2type,
-                                                               mark_boundaries=False,
-                                                               no_entity=True)
-                if property_tokens:
-                    word_ids = [vocab[w.lower()] for w in property_tokens][:MAX_LABEL_TOKEN_LEN//2]
-                    out_edges[i, gi, ei, :len(word_ids)] = word_ids
-
-                if e.leftentityid in node2id:
-                    if e.rightentityid in node2id:
-                        temp_edges[node2id[e.leftentityid]].append(ei)
-                        temp_nodes[node2id[e.leftentityid]].append(node2id[e.rightentityid])
-                        temp_edges[node2id[e.rightentityid]].append(ei + MAX_EDGES)
-                        temp_nodes[node2id[e.rightentityid]].append(node2id[e.leftentityid])
-                    if e.qualifierentityid in node2id:
-                        temp_edges[node2id[e.leftentityid]].append(ei)
-                        temp_nodes[node2id[e.leftentityid]].append(node2id[e.qualifierentityid])
-                        temp_edges[node2id[e.qualifierentityid]].append(ei + MAX_EDGES)
-                        temp_nodes[node2id[e.qualifierentityid]].append(node2id[e.leftentityid])
-                if e.rightentityid in node2id and e.qualifierentityid in node2id:
-                    temp_edges[node2id[e.rightentityid]].append(ei)
-                    temp_nodes[node2id[e.rightentityid]].append(node2id[e.qualifierentityid])
-                    temp_edges[node2id[e.qualifierentityid]].append(ei + MAX_EDGES)
-                    temp_nodes[node2id[e.qualifierentityid]].append(node2id[e.rightentityid])
-
-            for nodeid, nodeids in temp_nodes.items():
-                nodeids = nodeids[:MAX_EDGES_PER_ENTITY]
-                out_A_nodes[i, gi, nodeid, :len(nodeids)] = nodeids
-            for nodeid, edgeids in temp_edges.items():
-                edgeids = edgeids[:MAX_EDGES_PER_ENTITY]
-                out_A_edges[i, gi, nodeid, :len(edgeids)] = edgeids
+    size, width, neighbours = context.max_edges, context.max_label_token_len // 2, context.max_edges_per_entity
+    if context.dynamic_shapes:
+        extents = np.asarray([_graph_structure_extent(r) for q_rows in rows for r in q_rows] or [(2, 1, 1)])
+        size, width, neighbours = extents.max(axis=0).tolist()
+    out_nodes = np.zeros((len(questions), max_negative_graphs, size, width), dtype=np.int32)
+    out_edges = np.zeros((len(questions), max_negative_graphs, size, width), dtype=np.int32)
+
+    out_A_nodes = np.zeros((len(questions), max_negative_graphs, size, neighbours), dtype=np.uint8)
+    out_A_edges = np.zeros((len(questions), max_negative_graphs, size, neighbours), dtype=np.uint8)
+
+    for i, q_rows in enumerate(rows):
+        for gi, r in enumerate(q_rows):
+            out_nodes[i, gi], out_edges[i, gi], out_A_nodes[i, gi], out_A_edges[i, gi] = \
+                _resize_graph_structure(r, size, width, neighbours)
     return out_nodes, out_edges, out_A_nodes, out_A_edges
+
+
+def _graph_structure_extent(structure):
+    """
+    :param structure: nodes, edges, A_nodes and A_edges of one graph
+    :return: the number of used rows (at least the padding row and the question variable), the longest label and
+             the largest number of neighbours
+    """
+    nodes, edges, A_nodes, A_edges = structure
+    rows = nodes.shape[0]
+    used = np.flatnonzero((nodes != 0).any(axis=-1) | (edges != 0).any(axis=-1) | (A_nodes != 0).any(axis=-1))
+    # Edges without a label are still referenced by the adjacency lists
+    referenced = np.concatenate([A_nodes.reshape(-1), A_edges.reshape(-1) % rows]).astype(np.int64)
+    size = max(used.max(initial=0), referenced.max(initial=0)) + 1
+    # The row of the question variable is filled over the whole width, so the width is kept
+    labels = np.count_nonzero(np.concatenate([nodes, edges]), axis=-1)
+    return max(size, 2), max(labels.max(initial=0), 1), max(np.count_nonzero(A_nodes, axis=-1).max(initial=0), 1)
+
+
+def _resize_graph_structure(structure, size, width, neighbours):
+    """
+    Pad or cut the graph structure to the given number of rows, label width and number of neighbours.
+    The rows, the tokens and the neighbours that are cut must be empty. The ids of the incoming edges in A_edges
+    depend on the number of rows and are shifted.
+
+    :param structure: nodes, edges, A_nodes and A_edges, the rows are the second last axis
+    :return: the resized nodes, edges, A_nodes and A_edges
+    >>> nodes, edges = np.zeros((3, 1), dtype=np.int32), np.ones((3, 1), dtype=np.int32)
+    >>> A_nodes = np.asarray([[0], [2], [1]], dtype=np.uint8)
+    >>> A_edges = np.asarray([[0], [1], [4]], dtype=np.uint8)
+    >>> _resize_graph_structure((nodes, edges, A_nodes, A_edges), 5, 2, 1)[3].tolist()
+    [[0], [1], [6], [0], [0]]
+    """
+    nodes, edges, A_nodes, A_edges = structure
+    rows = nodes.shape[-2]
+
+    def resize(m, columns):
+        m = m[..., :size, :columns]
+        return np.pad(m, [(0, 0)] * (m.ndim - 2) + [(0, size - m.shape[-2]), (0, columns - m.shape[-1])],
+                      'constant')
+
+    A_edges = resize(A_edges, neighbours)
+    if size != rows:
+        A_edges = np.where(A_edges >= rows, A_edges.astype(np.int64) + size - rows, A_edges).astype(np.uint8)
+    return resize(nodes, width), resize(edges, width), resize(A_nodes, neighbours), A_edges
+
+
+def _concatenate_graph_structures(parts):
+    """
+    Concatenate the graph structures of several batches, see encode_batch_graph_structure.
+
+    :param parts: a list of (nodes, edges, A_nodes, A_edges) tuples
+    :return: a tuple of nodes, edges, A_nodes, A_edges padded to the largest shape
+    """
+    graphs = max(p[0].shape[1] for p in parts)
+    size, width = max(p[0].shape[2] for p in parts), max(p[0].shape[3] for p in parts)
+    neighbours = max(p[2].shape[3] for p in parts)
+    resized = [_resize_graph_structure(p, size, width, neighbours) for p in parts]
+    return tuple(np.concatenate([np.pad(r[i], [(0, 0), (0, graphs - r[i].shape[1]), (0, 0), (0, 0)], 'constant')
+                                 for r in resized]) for i in range(4))
+
+
+def _encode_graph_structure(g: SemanticGraph, entity2label, entity2type, vocab, context):
+    max_edges, max_len = context.max_edges, context.max_label_token_len // 2
+    out_nodes = np.zeros((max_edges, max_len), dtype=np.int32)
+    out_edges = np.zeros((max_edges, max_len), dtype=np.int32)
+    out_A_nodes = np.zeros((max_edges, context.max_edges_per_entity), dtype=np.uint8)
+    out_A_edges = np.zeros((max_edges, context.max_edges_per_entity), dtype=np.uint8)
+
+    # The first row in the matrix is 0 padding and the second is the Qvar
+    node_labels, edge_labels, adjacency = _graph_structure_lists(g, entity2label, entity2type, vocab, context,
+                                                                 max_nodes=max_edges - 1)
+    for ni, word_ids in enumerate(node_labels, start=1):
+        out_nodes[ni, :len(word_ids)] = word_ids
+    for ei, word_ids in enumerate(edge_labels, start=1):
+        out_edges[ei, :len(word_ids)] = word_ids
+    for ni, neighbours in adjacency.items():
+        out_A_nodes[ni + 1, :len(neighbours)] = [n + 1 for n, _, _ in neighbours]
+        out_A_edges[ni + 1, :len(neighbours)] = [ei + 1 + (max_edges if incoming else 0)
+                                                 for _, ei, incoming in neighbours]
+    return out_nodes, out_edges, out_A_nodes, out_A_edges
+
+
+def _graph_structure_lists(g: SemanticGraph, entity2label, entity2type, vocab, context, max_nodes=None):
+    """
+    :param max_nodes: the maximum number of nodes including the question variable, all nodes if not given
+    :return: the token ids of the node labels, the token ids of the edge labels and the adjacency lists of the nodes,
+             a dictionary of node -> list of (neighbour, edge, incoming) tuples. The node 0 is the question variable,
+             the nodes and the edges are numbered from 0.
+    """
+    max_len = context.max_label_token_len // 2
+    edges = [e for e in g.edges
+             if e.relationid not in graph_queries.sparql_class_relation] \
+        + [e for e in g.edges if e.relationid in graph_queries.sparql_class_relation]
+
+    nodes = {n for e in edges for n in e.nodes() if n} - {graph_queries.QUESTION_VAR}
+    nodes = list(nodes)[:max_nodes - 1] if max_nodes is not None else list(nodes)
+    node2id = {n: ni for ni, n in enumerate(nodes, start=1)}
+
+    node_labels = [np.ones(max_len, dtype=np.int32)]
+    for n in nodes:
+        entity_tokens = _entity_kbid2token(n, entity2label, entity2type,
+                                           replace_entities=False,
+                                           mark_boundaries=False, resolve_m=False)
+        if entity_tokens:
+            node_labels.append(vocab.to_ids(entity_tokens, max_len))
+        else:
+            node_labels.append(np.asarray([vocab[ENTITY_TOKEN]], dtype=np.int32))
+    node2id[graph_queries.QUESTION_VAR] = 0
+
+    edge_labels = []
+    adjacency = defaultdict(list)
+    for ei, e in enumerate(edges):
+        edge_labels.append(_get_edge_ids(e, entity2label, entity2type, vocab,
+                                         mark_boundaries=False,
+                                         no_entity=True)[:max_len])
+        if e.leftentityid in node2id:
+            if e.rightentityid in node2id:
+                adjacency[node2id[e.leftentityid]].append((node2id[e.rightentityid], ei, False))
+                adjacency[node2id[e.rightentityid]].append((node2id[e.leftentityid], ei, True))
+            if e.qualifierentityid in node2id:
+                adjacency[node2id[e.leftentityid]].append((node2id[e.qualifierentityid], ei, False))
+                adjacency[node2id[e.qualifierentityid]].append((node2id[e.leftentityid], ei, True))
+        if e.rightentityid in node2id and e.qualifierentityid in node2id:
+            adjacency[node2id[e.rightentityid]].append((node2id[e.qualifierentityid], ei, False))
+            adjacency[node2id[e.qualifierentityid]].append((node2id[e.rightentityid], ei, True))
+    adjacency = {ni: neighbours[:context.max_edges_per_entity] for ni, neighbours in adjacency.items()}
+    return node_labels, edge_labels, adjacency
+
+
+class PackedGraphs:
+
+    def __init__(self, graph_offsets, node_offsets, edge_offsets, message_offsets,
+                 nodes, edges, messages, node_mask, edge_mask, graphs):
+        """
+        The candidate graphs of GNNModel packed as one disjoint union of graphs without padding, in the CSR format:
+        graph_offsets[i]:graph_offsets[i + 1] are the graphs of the question i and node_offsets[g]:node_offsets[g + 1],
+        edge_offsets[g]:edge_offsets[g + 1] and message_offsets[g]:message_offsets[g + 1] are the rows of the graph g.
+        The first node of every graph is the question variable. Every message is a (node, neighbour, edge, incoming)
+        row, the nodes and the edges are numbered within the graph. The number of nodes and edges is not limited.
+        Use encode_batch_graphs_packed to create it and arrays to get the input of GNNModel.forward_packed.
+
+        :param graph_offsets: a numpy array of question offsets into the graphs
+        :param node_offsets: a numpy array of graph offsets into the nodes
+        :param edge_offsets: a numpy array of graph offsets into the edges
+        :param message_offsets: a numpy array of graph offsets into the messages
+        :param nodes: a numpy array of the token ids of the node labels, shape (nodes, max_label_token_len // 2)
+        :param edges: a numpy array of the token ids of the edge labels, shape (edges, max_label_token_len // 2)
+        :param messages: a numpy array of shape (messages, 4)
+        :param node_mask: a numpy array of uint8, the nodes with neighbours
+        :param edge_mask: a numpy array of uint8, the edges that are used
+        :param graphs: the number of candidate graphs per question in the predictions
+        """
+        self.graph_offsets = graph_offsets
+        self.node_offsets = node_offsets
+        self.edge_offsets = edge_offsets
+        self.message_offsets = message_offsets
+        self.nodes = nodes
+        self.edges = edges
+        self.messages = messages
+        self.node_mask = node_mask
+        self.edge_mask = edge_mask
+        self.graphs = graphs
+
+    _ARRAYS = ["graph_offsets", "node_offsets", "edge_offsets", "message_offsets",
+               "nodes", "edges", "messages", "node_mask", "edge_mask"]
+
+    def __len__(self):
+        return len(self.graph_offsets) - 1
+
+    @property
+    def shape(self):
+        return len(self), self.graphs
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in self._ARRAYS)
+
+    @staticmethod
+    def from_graphs(graph_counts, encoded_graphs, graphs, width):
+        """
+        :param graph_counts: the number of graphs of each question
+        :param encoded_graphs: a list with the nodes, edges, messages, node mask and edge mask of every graph
+        :param graphs: the number of candidate graphs per question in the predictions
+        :param width: the number of token ids per label
+        :return: a PackedGraphs object
+        """
+        columns = list(zip(*encoded_graphs)) or [[np.zeros((0, width), dtype=np.int32)],
+                                                 [np.zeros((0, width), dtype=np.int32)],
+                                                 [np.zeros((0, 4), dtype=np.int32)],
+                                                 [np.zeros(0, dtype=np.uint8)], [np.zeros(0, dtype=np.uint8)]]
+        nodes, edges, messages, node_mask, edge_mask = [np.concatenate(c) for c in columns]
+        return PackedGraphs(_to_offsets(graph_counts),
+                            *[_to_offsets([len(m) for m in c]) for c in columns[:3]],
+                            nodes, edges, messages, node_mask, edge_mask, graphs)
+
+    @staticmethod
+    def load(path_prefix, mmap_mode='r'):
+        """
+        Load the arrays saved with PackedGraphs.save, by default they are memory-mapped.
+        """
+        return PackedGraphs(*[np.load(path_prefix + f".{name}.npy", mmap_mode=mmap_mode)
+                              for name in PackedGraphs._ARRAYS],
+                            graphs=int(np.load(path_prefix + ".graphs.npy")))
+
+    def save(self, path_prefix):
+        for name in self._ARRAYS:
+            np.save(path_prefix + f".{name}.npy", getattr(self, name))
+        np.save(path_prefix + ".graphs.npy", np.asarray(self.graphs))
+
+    @staticmethod
+    def concatenate(parts):
+        """
+        :param parts: a list of PackedGraphs objects
+        :return: a PackedGraphs object with the questions of all parts
+        """
+        offsets = []
+        for name in ["graph_offsets", "node_offsets", "edge_offsets", "message_offsets"]:
+            shifts = np.cumsum([0] + [getattr(p, name)[-1] for p in parts[:-1]])
+            offsets.append(np.concatenate([getattr(p, name)[:-1] + shift for p, shift in zip(parts, shifts)] +
+                                          [[getattr(parts[-1], name)[-1] + shifts[-1]]]).astype(np.int64))
+        return PackedGraphs(*offsets, *[np.concatenate([getattr(p, name) for p in parts])
+                                        for name in PackedGraphs._ARRAYS[4:]],
+                            graphs=max(p.graphs for p in parts))
+
+    def __getitem__(self, indices):
+        """
+        :param indices: question indices or a slice
+        :return: a PackedGraphs object with the graphs of the selected questions
+        """
+        indices = np.arange(len(self))[indices]
+        graph_ids, _, graph_counts = _expand_ranges(self.graph_offsets[indices], self.graph_offsets[indices + 1])
+        return self._take_graphs(graph_ids, graph_counts)
+
+    def reorder(self, graph_orders):
+        """
+        :param graph_orders: a list with a permutation of the graphs of each question
+        :return: a PackedGraphs object with the graphs of each question in the given order
+        """
+        return self._take_graphs(_reordered_graph_ids(self.graph_offsets, graph_orders), self.graph_counts())
+
+    def _take_graphs(self, graph_ids, graph_counts):
+        selected = []
+        for name in ["node_offsets", "edge_offsets", "message_offsets"]:
+            offsets = getattr(self, name)
+            selected.append(_expand_ranges(offsets[graph_ids], offsets[graph_ids + 1]))
+        (node_ids, _, node_counts), (edge_ids, _, edge_counts), (message_ids, _, message_counts) = selected
+        return PackedGraphs(_to_offsets(graph_counts), _to_offsets(node_counts), _to_offsets(edge_counts),
+                            _to_offsets(message_counts), self.nodes[node_ids], self.edges[edge_ids],
+                            self.messages[message_ids], self.node_mask[node_ids], self.edge_mask[edge_ids],
+                            self.graphs)
+
+    def graph_counts(self):
+        return np.diff(self.graph_offsets)
+
+    def with_graphs(self, graphs):
+        """
+        :param graphs: the number of candidate graphs per question, not smaller than the number of graphs of
+                       any question
+        :return: a PackedGraphs object that shares the data
+        """
+        return PackedGraphs(*[getattr(self, name) for name in self._ARRAYS], graphs=graphs)
+
+    def arrays(self):
+        """
+        :return: a tuple of numpy arrays, the input of GNNModel.forward_packed: the node labels, the edge labels,
+                 the messages as (node, neighbour, edge) rows numbered across all graphs, the incoming edges follow
+                 the outgoing edges, the node mask, the edge mask, the question variable node of each graph and
+                 the graph of each prediction, shape (questions, graphs), -1 for padding
+        """
+        message_counts = np.diff(self.message_offsets)
+        node_shifts = np.repeat(self.node_offsets[:-1], message_counts)
+        edge_shifts = np.repeat(self.edge_offsets[:-1], message_counts)
+        messages = np.stack([self.messages[:, 0] + node_shifts, self.messages[:, 1] + node_shifts,
+                             self.messages[:, 2] + edge_shifts + self.messages[:, 3] * len(self.edges)], axis=1)
+        graph_counts = self.graph_counts()
+        graph_ids = np.full((len(self), self.graphs), -1, dtype=np.int64)
+        graph_ids[np.repeat(np.arange(len(self)), graph_counts),
+                  np.arange(self.graph_offsets[-1]) - np.repeat(self.graph_offsets[:-1], graph_counts)] = \
+            np.arange(self.graph_offsets[-1])
+        return np.ascontiguousarray(self.nodes), np.ascontiguousarray(self.edges), messages.astype(np.int64), \
+            np.ascontiguousarray(self.node_mask), np.ascontiguousarray(self.edge_mask), \
+            self.node_offsets[:-1].astype(np.int64), graph_ids
+
+
+def encode_batch_graphs_packed(questions: List[Sentence], vocab, max_negative_graphs=None, context=None):
+    """
+    Same as encode_batch_graph_structure, but the graphs are packed into one disjoint union without padding and
+    without the limit on the number of nodes of the context.
+
+    :param questions: a list of sentence objects
+    :param vocab: word to index mapping
+    :param max_negative_graphs: the number of graphs per question, by default the largest number of graphs
+                                up to the limit of the context
+    :param context: an EncodingContext with the shape limits
+    :return: a PackedGraphs object
+    """
+    vocab = get_vocabulary(vocab)
+    context = get_encoding_context(context)
+    max_negative_graphs = _get_max_negative_graphs(questions, max_negative_graphs, context)
+    graph_counts, encoded_graphs = [], []
+    for s in questions:
+        entity2label = {k: l for e in s.entities for k, l in e['linkings']}
+        entity2type = {k: e['type'] for e in s.entities for k, l in e['linkings']}
+        graphs = s.graphs[:max_negative_graphs]
+        graph_counts.append(len(graphs))
+        encoded_graphs.extend(_encode_with_cache("packed", _encode_graph_packed, g.graph, entity2label, entity2type,
+                                                 vocab, context) for g in graphs)
+    return PackedGraphs.from_graphs(graph_counts, encoded_graphs, max_negative_graphs,
+                                    context.max_label_token_len // 2)
+
+
+def _encode_graph_packed(g: SemanticGraph, entity2label, entity2type, vocab, context):
+    node_labels, edge_labels, adjacency = _graph_structure_lists(g, entity2label, entity2type, vocab, context)
+    max_len = context.max_label_token_len // 2
+    nodes = np.zeros((len(node_labels), max_len), dtype=np.int32)
+    for ni, word_ids in enumerate(node_labels):
+        nodes[ni, :len(word_ids)] = word_ids
+    edges = np.zeros((len(edge_labels), max_len), dtype=np.int32)
+    for ei, word_ids in enumerate(edge_labels):
+        edges[ei, :len(word_ids)] = word_ids
+    messages = np.asarray([(ni, n, ei, incoming) for ni in sorted(adjacency) for n, ei, incoming in adjacency[ni]],
+                          dtype=np.int32).reshape(-1, 4)
+    node_mask = np.asarray([ni in adjacency for ni in range(len(nodes))], dtype=np.uint8)
+    # The padded input masks the edge in the row i with the adjacency list of the node in the row i, the packed
+    # input keeps the same masks, so that both give the same scores
+    edge_mask = np.zeros(len(edges), dtype=np.uint8)
+    rows = min(len(nodes), len(edges))
+    edge_mask[:rows] = node_mask[:rows]
+    return nodes, edges, messages, node_mask, edge_mask
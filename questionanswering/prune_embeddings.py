@@ -0,0 +1,53 @@
+import json
+
+import click
+
+from wikidata import scheme
+
+from questionanswering import _utils
+from questionanswering.construction.sentence import sentence_object_hook, Sentence
+from questionanswering.models import vectorization as V
+
+
+@click.command()
+@click.argument('path_to_embeddings')
+@click.argument('save_to')
+@click.argument('path_to_datasets', nargs=-1)
+@click.option('--whitelist', default=None, help="A file with additional words to keep, one per line")
+@click.option('--tagger', default=None, help="The tagger backend of the evaluation, corenlp or lightweight")
+@click.option('--corenlp', default=None, help="The URL of the CoreNLP server")
+def prune(path_to_embeddings, save_to, path_to_datasets, whitelist, tagger, corenlp):
+    """
+    Reduce the word embeddings to the words that appear in the given data sets, in the property labels
+    and in the whitelist. The result is saved in the binary format, use SAVE_TO.npy as the embeddings path.
+    The data sets can be either generated silver graphs or data sets of raw questions. Raw questions are tokenized
+    with the same tagger as in the evaluation, set it to match the tagging section of the evaluation config.
+    """
+    _utils.TAGGER_BACKEND = tagger or _utils.TAGGER_BACKEND
+    _utils.CORENLP_URL = corenlp or _utils.CORENLP_URL
+    tokens = set()
+    for path_to_dataset in path_to_datasets:
+        with open(path_to_dataset) as f:
+            dataset = json.load(f, object_hook=sentence_object_hook)
+        tokens.update(V.get_vocabulary_tokens([s for s in dataset if isinstance(s, Sentence)]))
+        # Raw questions are tagged only at the evaluation time, they are tokenized here the same way
+        raw_questions = [q_obj for q_obj in dataset if isinstance(q_obj, dict)]
+        questions = [q_obj.get('utterance', q_obj.get('question', "")) for q_obj in raw_questions]
+        for tagged in _utils.get_tagged_from_server_batch(questions, caseless=[q.islower() for q in questions]):
+            tokens.update(t['originalText'] for t in tagged)
+        for q_obj in raw_questions:
+            tokens.update(t for e in q_obj.get('entities', []) for _, l in e.get('linkings', []) if l
+                          for t in _utils.split_pattern.split(l))
+        print(f"Tokens after {path_to_dataset}: {len(tokens)}")
+    tokens.update(t for p_meta in scheme.property2label.values() for t in _utils.split_pattern.split(p_meta['label']))
+    if whitelist:
+        tokens.update(_utils.load_blacklist(whitelist))
+    print(f"Tokens to keep: {len(tokens)}")
+
+    embeddings, word2idx = _utils.prune_word_embeddings(*_utils.load_word_embeddings(path_to_embeddings), tokens)
+    _utils.save_word_embeddings(embeddings, sorted((w for w in word2idx if word2idx[w] > 1), key=word2idx.get), save_to)
+    print(f"Saved the embeddings of size {embeddings.shape} to {save_to}")
+
+
+if __name__ == "__main__":
+    prune()
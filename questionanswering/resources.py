@@ -0,0 +1,138 @@
+# A registry of lazily loaded resources and modules with the cost of loading each of them
+import importlib
+import logging
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.ERROR)
+
+_loaders = {}
+_loaded = {}
+_lock = threading.RLock()
+
+# Resource or module name -> time in seconds that it took to load
+load_times = OrderedDict()
+
+
+def register(name, loader):
+    """
+    Register a resource that is loaded on the first access.
+
+    :param name: a unique name of the resource
+    :param loader: a function without arguments that loads the resource
+    >>> register("test.resource", lambda: {"P31"})
+    >>> get("test.resource")
+    {'P31'}
+    >>> "test.resource" in load_times
+    True
+    """
+    _loaders[name] = loader
+
+
+def get(name):
+    """
+    Get the resource, the resource is loaded on the first access.
+
+    :param name: the name of a registered resource
+    :return: the loaded resource
+    """
+    if name not in _loaded:
+        with _lock:
+            if name not in _loaded:
+                start = time.perf_counter()
+                _loaded[name] = _loaders[name]()
+                load_times[name] = time.perf_counter() - start
+                logger.debug("Loaded {} in {:.3f}s".format(name, load_times[name]))
+    return _loaded[name]
+
+
+def module_getattr(module_name, attribute2resource):
+    """
+    Create a module level __getattr__ (PEP 562) that loads the resources of the module on the first access,
+    so that importing the module doesn't load them.
+
+    :param module_name: __name__ of the module
+    :param attribute2resource: a dictionary that maps module attributes to resource names
+    :return: a __getattr__ function
+    """
+    def __getattr__(attribute):
+        if attribute in attribute2resource:
+            return get(attribute2resource[attribute])
+        raise AttributeError("module '{}' has no attribute '{}'".format(module_name, attribute))
+    return __getattr__
+
+
+class LazyModule:
+
+    def __init__(self, module_name):
+        """
+        A proxy that imports the module on the first attribute access.
+
+        :param module_name: the full name of the module
+        >>> tagset = LazyModule("html.entities")
+        >>> "html.entities" in load_times
+        False
+        >>> tagset.name2codepoint['amp']
+        38
+        >>> "html.entities" in load_times
+        True
+        """
+        self.__dict__['_module_name'] = module_name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_module']
+        if module is None:
+            with _lock:
+                module_name = self.__dict__['_module_name']
+                start = time.perf_counter()
+                module = importlib.import_module(module_name)
+                if module_name not in load_times:
+                    load_times[module_name] = time.perf_counter() - start
+                self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+    def __setattr__(self, attribute, value):
+        setattr(self._load(), attribute, value)
+
+
+def lazy_import(module_name):
+    """
+    :param module_name: the full name of the module
+    :return: the module if it is already imported, otherwise a LazyModule
+    """
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    return LazyModule(module_name)
+
+
+def report(load_all=False):
+    """
+    Report the time spent loading the resources and modules so far.
+
+    :param load_all: load all registered resources first
+    :return: a list of (name, seconds) tuples sorted by the time
+    """
+    if load_all:
+        for name in list(_loaders):
+            get(name)
+    return sorted(load_times.items(), key=lambda x: x[1], reverse=True)
+
+
+if __name__ == "__main__":
+    # Usage: python -m questionanswering.resources [module ...]
+    # Reports the import time of the given modules and the load time of all resources that they register.
+    from questionanswering import resources as registry
+    for module_name in sys.argv[1:] or ["questionanswering.models.vectorization",
+                                        "questionanswering.grounding.staged_generation"]:
+        start = time.perf_counter()
+        importlib.import_module(module_name)
+        print("import {}: {:.3f}s".format(module_name, time.perf_counter() - start))
+    for name, seconds in registry.report(load_all=True):
+        print("load {}: {:.3f}s".format(name, seconds))
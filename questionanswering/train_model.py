@@ -15,7 +15,7 @@ import fackel
 from questionanswering import config_utils, _utils
 from questionanswering import models
 from questionanswering.models import vectorization as V
-from questionanswering.models import losses
+from questionanswering.models import losses, batching, encoding_cache
 
 
 from questionanswering.construction.sentence import sentence_object_hook, Sentence
@@ -45,39 +45,59 @@ def train(config_file_path, seed, gpuid, model_description, experiment_tag):
     # Load data
     if not isinstance(config['training']["path_to_dataset"], list):
         config['training']["path_to_dataset"] = [config['training']["path_to_dataset"]]
-    training_dataset = []
-    for path_to_train in config['training']["path_to_dataset"]:
-        with open(path_to_train) as f:
-            training_dataset += json.load(f,  object_hook=sentence_object_hook)
-    logger.info(f"Train: {len(training_dataset)}")
-    train_size_available = len(training_dataset)
     dataset_name = config['training']["path_to_dataset"][0].split("/")[-1].split(".")[0]
-
     if "path_to_validation" not in config['training']:
         config['training']["path_to_validation"] = config['training']["path_to_dataset"][-1]
         logger.info(f"No validation set, using part of the training data.")
-    with open(config['training']["path_to_validation"]) as f:
-        val_dataset = json.load(f,  object_hook=sentence_object_hook)
-    logger.info(f"Validation: {len(val_dataset)}")
-    val_size_available = len(val_dataset)
 
     wordembeddings, word2idx = V.extend_embeddings_with_special_tokens(
-        *_utils.load_word_embeddings(_utils.RESOURCES_FOLDER + "../../resources/embeddings/glove/glove.6B.100d.txt")
+        *_utils.load_word_embeddings(config.get('global', {}).get(
+            "word.embeddings", _utils.RESOURCES_FOLDER + "../../resources/embeddings/glove/glove.6B.100d.txt"))
     )
     logger.info(f"Loaded word embeddings: {wordembeddings.shape}")
 
     model_type = config['training']["model_type"]
     logger.info(f"Model type: {model_type}")
+    config_global = config.get('global', {})
+    path_to_encoding_cache = config_global.get("encoding.cache")
+    encoding_workers = config_global.get("encoding.workers", 0)
+    dynamic_shapes = config_global.get("encoding.dynamic_shapes", False)
+    training_context = V.EncodingContext(max_negative_graphs=config['training'].get("max_negative_graphs", 50),
+                                         dynamic_shapes=dynamic_shapes)
+    validation_context = V.EncodingContext(
+        max_negative_graphs=config['training'].get("max_negative_graphs_validation", 100),
+        dynamic_shapes=dynamic_shapes)
+    # GNNModel gets the candidate graphs packed into one disjoint union per mini-batch
+    packed_graphs = config_global.get("encoding.packed_graphs", False)
 
-    V.MAX_NEGATIVE_GRAPHS = 50
-    training_dataset = [s for s in training_dataset if any(scores[2] > losses.MIN_TARGET_VALUE for g, scores in s.graphs)]
-    training_samples, training_targets = pack_data(training_dataset, word2idx, model_type)
-    logger.info(f"Data encoded: {[m.shape for m in training_samples]}")
+    training_stream = None
+    if config_global.get("encoding.streaming", False):
+        # The training questions are encoded per mini-batch during the training
+        training_dataset = load_dataset(config['training']["path_to_dataset"])
+        train_size_available = len(training_dataset)
+        training_dataset = select_questions(training_dataset)
+        training_stream = batching.EncodingStream(training_dataset, word2idx, model_type,
+                                                  batch_size=config['training'].get('batch_size', 64),
+                                                  context=training_context,
+                                                  workers=encoding_workers,
+                                                  prefetch=config_global.get("encoding.prefetch", 4),
+                                                  seed=np.random.randint(2**31 - 1),
+                                                  bucketing=config_global.get("encoding.bucketing", False))
+        logger.info(f"Train: {train_size_available}")
+        logger.info(f"Data is encoded per mini-batch with {encoding_workers} workers")
+    else:
+        # The training questions are only needed to encode them
+        _, train_size_available, training_samples, training_targets = load_and_pack(
+            config['training']["path_to_dataset"], word2idx, model_type, path_to_encoding_cache, keep_dataset=False,
+            workers=encoding_workers, context=training_context, packed=packed_graphs)
+        logger.info(f"Train: {train_size_available}")
+        logger.info(f"Data encoded: {[m.shape for m in training_samples]}")
 
-    V.MAX_NEGATIVE_GRAPHS = 100
-    val_dataset = [s for s in val_dataset if any(scores[2] > losses.MIN_TARGET_VALUE for g, scores in s.graphs)]
+    val_dataset, val_size_available, val_samples, val_targets = load_and_pack(
+        [config['training']["path_to_validation"]], word2idx, model_type, path_to_encoding_cache,
+        workers=encoding_workers, context=validation_context, packed=packed_graphs)
+    logger.info(f"Validation: {val_size_available}")
     print(f"Val F1 upper bound: {np.average([q.graphs[0].scores[2] for q in val_dataset])}")
-    val_samples, val_targets = pack_data(val_dataset, word2idx, model_type)
     logger.info(f"Val data encoded: {[m.shape for m in val_samples]}")
 
     encoder = models.ConvWordsEncoder(
@@ -87,8 +107,13 @@ def train(config_file_path, seed, gpuid, model_description, experiment_tag):
     )
     encoder.load_word_embeddings_from_numpy(wordembeddings)
     net = getattr(models, model_type)(encoder, **config['model'])
+    # The candidate graphs are kept without padding or encoded on the fly and are padded per mini-batch
+    # With bucketing the mini-batches hold questions of a similar size and are trimmed to their real maximum
+    padded_inputs = batching.PaddedInputs(net, trim=config_global.get("encoding.bucketing", False))
 
     def metrics(targets, predictions, validation=False):
+        if not validation:
+            targets = padded_inputs.batch_targets(targets)
         _, predicted_targets = torch.topk(predictions, 1, dim=-1)
         _, targets = torch.topk(targets, 1, dim=-1)
         predicted_targets = predicted_targets.squeeze(1)
@@ -116,7 +141,7 @@ def train(config_file_path, seed, gpuid, model_description, experiment_tag):
             os.makedirs(config['training']['save_to_dir'])
     container = fackel.TorchContainer(
         torch_model=net,
-        criterion=losses.VariableMarginLoss(),
+        criterion=padded_inputs.wrap_criterion(losses.VariableMarginLoss()),
         # criterion=nn.MultiMarginLoss(margin=0.5, size_average=False),
         metrics=metrics,
         optimizer_params={
@@ -133,16 +158,30 @@ def train(config_file_path, seed, gpuid, model_description, experiment_tag):
     if results_logger:
         results_logger.info("Model save to: {}".format(container._save_model_to))
 
-    log_history = container.train(
-        training_samples, training_targets,
-        dev=val_samples, dev_targets=val_targets
-    )
+    with padded_inputs:
+        # The targets of a stream are looked up by the sample ids of each mini-batch
+        if training_stream:
+            training_ids = padded_inputs.add_stream(training_stream)
+            training_targets, = training_ids
+        elif config_global.get("encoding.bucketing", False):
+            training_ids = padded_inputs.add_buckets(training_samples, training_targets,
+                                                     batch_size=config['training'].get('batch_size', 64),
+                                                     seed=np.random.randint(2**31 - 1))
+            training_targets, = training_ids
+        else:
+            training_ids = padded_inputs.add(training_samples)
+        log_history = container.train(
+            training_ids,
+            training_targets,
+            dev=padded_inputs.add(val_samples), dev_targets=val_targets
+        )
 
     for q in val_dataset:
         random.shuffle(q.graphs)
     if container._model_checkpoint:
         container.reload_from_saved()
-    val_samples, val_targets = pack_data(val_dataset, word2idx, model_type)
+    val_samples, val_targets = pack_data(val_dataset, word2idx, model_type, workers=encoding_workers,
+                                         context=validation_context)
     predictions = container.predict_batchwise(*val_samples)
     results = metrics(*container._torchify_data(True, val_targets), predictions, validation=True)
     _, predictions = torch.topk(predictions, 1, dim=-1)
@@ -161,7 +200,7 @@ def train(config_file_path, seed, gpuid, model_description, experiment_tag):
                                         model_description,
                                         str(seed),
                                         dataset_name,
-                                        f"{len(training_dataset)}/{train_size_available}",
+                                        f"{len(training_targets)}/{train_size_available}",
                                         f"{len(val_dataset)}/{val_size_available}",
                                         str(len(log_history)),
                                         str(results['acc']),
@@ -174,18 +213,104 @@ def train(config_file_path, seed, gpuid, model_description, experiment_tag):
     print(container._save_model_to)
 
 
+def load_and_pack(paths,
+                  word2idx,
+                  model_type,
+                  path_to_encoding_cache=None,
+                  keep_dataset=True,
+                  workers=0,
+                  context=None,
+                  packed=False):
+    """
+    Load the data set files, select the questions that have a good enough graph and encode them for the model.
+    If the cache directory is given, the encoded data is taken from the cache when the files, the vocabulary and
+    the encoding parameters are the same, otherwise it is saved to the cache. The candidate graphs are encoded in
+    the order of the data set files and shuffled in the encoded data with the seeded random state of the run,
+    so that the cached data does not depend on the seed.
+
+    :param paths: a list of data set files
+    :param word2idx: word to index mapping
+    :param model_type: the class name of the model
+    :param path_to_encoding_cache: the cache directory
+    :param keep_dataset: if False, the data set files are not read when the encoded data is in the cache
+    :param workers: the number of worker processes to encode the questions
+    :param context: a vectorization.EncodingContext with the shape limits
+    :param packed: encode the GNNModel graphs as vectorization.PackedGraphs
+    :return: a tuple of the selected questions (None if they were not read), the number of questions in the files,
+             the model inputs and the targets
+    """
+    key, cached = None, None
+    if path_to_encoding_cache:
+        key = encoding_cache.fingerprint(paths, word2idx, context=context, model_type=model_type, ragged=True,
+                                         packed=packed, min_target_value=losses.MIN_TARGET_VALUE)
+        cached = encoding_cache.load(path_to_encoding_cache, key)
+    if cached is not None:
+        samples, targets, graph_orders, metadata = cached
+        size_available = metadata['available']
+        dataset = None
+        if keep_dataset:
+            dataset = select_questions(load_dataset(paths))
+            # Restore the order of the graphs that the encoded data has
+            for q, graph_order in zip(dataset, graph_orders):
+                q.graphs = [q.graphs[gi] for gi in graph_order]
+    else:
+        dataset = load_dataset(paths)
+        size_available = len(dataset)
+        dataset = select_questions(dataset)
+        graph_orders = []
+        samples, targets = pack_data(dataset, word2idx, model_type, ragged=True, graph_orders=graph_orders,
+                                     workers=workers, context=context, packed=packed, shuffle=False)
+        if key is not None:
+            encoding_cache.save(path_to_encoding_cache, key, samples, targets, graph_orders, available=size_available)
+
+    shuffled_orders = []
+    for qi, graph_order in enumerate(graph_orders):
+        shuffled_order = list(range(len(graph_order)))
+        random.shuffle(shuffled_order)
+        shuffled_orders.append(shuffled_order)
+        if dataset is not None:
+            dataset[qi].graphs = [dataset[qi].graphs[gi] for gi in shuffled_order]
+    samples = V.reorder_graphs(samples, model_type, shuffled_orders)
+    targets = V.reorder_padded(targets, shuffled_orders)
+    return dataset, size_available, samples, targets
+
+
+def load_dataset(paths):
+    dataset = []
+    for path in paths:
+        with open(path) as f:
+            dataset += json.load(f, object_hook=sentence_object_hook)
+    return dataset
+
+
+def select_questions(dataset: List[Sentence]):
+    return [s for s in dataset if any(scores[2] > losses.MIN_TARGET_VALUE for g, scores in s.graphs)]
+
+
 def pack_data(selected_questions: List[Sentence],
               word2idx,
-              model_type):
-    max_negative_graphs = min(max(len(s.graphs) for s in selected_questions), V.MAX_NEGATIVE_GRAPHS)
+              model_type,
+              ragged=False,
+              graph_orders=None,
+              workers=0,
+              context=None,
+              packed=False,
+              shuffle=True):
+    max_negative_graphs = V._get_max_negative_graphs(selected_questions, context=context)
     targets = np.zeros((len(selected_questions), max_negative_graphs))
     for qi, q in enumerate(selected_questions):
-        q.graphs = q.graphs[:max_negative_graphs]
-        random.shuffle(q.graphs)
+        # Shuffling the indices gives the same permutation as shuffling the graphs
+        graph_order = list(range(min(len(q.graphs), max_negative_graphs)))
+        if shuffle:
+            random.shuffle(graph_order)
+        q.graphs = [q.graphs[gi] for gi in graph_order]
+        if graph_orders is not None:
+            graph_orders.append(graph_order)
         for gi, g in enumerate(q.graphs):
             targets[qi, gi] = g.scores[2]
 
-    samples = V.encode_for_model(selected_questions, model_type, word2idx)
+    samples = V.encode_for_model(selected_questions, model_type, word2idx, ragged=ragged, workers=workers,
+                                 context=context, packed=packed)
     return samples, targets
 
 
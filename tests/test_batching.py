@@ -0,0 +1,141 @@
+import pytest
+
+import numpy as np
+import torch
+from torch.autograd import Variable
+
+from questionanswering import _utils
+from questionanswering.construction.graph import SemanticGraph, Edge, WithScore
+from questionanswering.construction.sentence import Sentence
+from questionanswering.grounding import graph_queries
+from questionanswering.models import batching
+from questionanswering.models import vectorization as V
+from questionanswering.models.gnn import GNNModel
+from questionanswering.models.lexical_baselines import OneEdgeModel, STAGGModel, PooledEdgesModel
+
+
+class SumModel(torch.nn.Module):
+
+    def forward(self, questions_m, graphs_m):
+        return questions_m.sum(-1, keepdim=True) + graphs_m.sum(-1)
+
+
+class Ragged:
+
+    def __init__(self, dense):
+        self.dense = dense
+
+    def __len__(self):
+        return len(self.dense)
+
+    def pad(self, indices, trim=False):
+        return self.dense[indices]
+
+
+def test_padded_inputs():
+    net = SumModel()
+    questions = np.arange(12).reshape(4, 3)
+    graphs = np.arange(24).reshape(4, 2, 3)
+    with batching.PaddedInputs(net) as padded_inputs:
+        sample_ids, = padded_inputs.add((questions, Ragged(graphs)))
+        val_ids, = padded_inputs.add((questions[:2], graphs[:2]))
+        predictions = net(Variable(torch.from_numpy(sample_ids[[2, 0]])))
+        val_predictions = net(Variable(torch.from_numpy(val_ids[[1]])))
+    expected = net(Variable(torch.from_numpy(questions[[2, 0]])), Variable(torch.from_numpy(graphs[[2, 0]])))
+    assert torch.equal(predictions, expected)
+    assert torch.equal(val_predictions, net(Variable(torch.from_numpy(questions[[1]])),
+                                            Variable(torch.from_numpy(graphs[[1]]))))
+    assert 'forward' not in net.__dict__
+
+
+# Questions of different lengths and the position of the entity
+QUESTION_TEXTS = [("who played obama ?", 2), ("who was the actor that played obama in the movie ?", 6),
+                  ("obama ?", 0)]
+
+
+def get_questions():
+    questions = []
+    for i in range(10):
+        input_text, entity_position = QUESTION_TEXTS[i % len(QUESTION_TEXTS)]
+        s = Sentence(input_text=input_text,
+                     tagged=[{'originalText': k, 'pos': 'O', 'ner': 'O'} for k in input_text.split()],
+                     entities=[{'linkings': [['Q76', 'Barack Obama']], 'token_ids': [entity_position], 'type': 'NNP'}])
+        s.graphs = [WithScore(SemanticGraph([Edge(leftentityid=graph_queries.QUESTION_VAR, rightentityid="Q76",
+                                                  relationid=p)]), (0.0, 0.0, 1.0 if gi == 0 else 0.0))
+                    for gi, p in enumerate(["P175", "P26", "P31", "P585", "P36"][:i % 5 + 1])]
+        questions.append(s)
+    return questions
+
+
+def test_encoding_stream():
+    word2idx = {_utils.all_zeroes: 0, _utils.unknown_el: 1, "performer": 2, "obama": 3}
+    questions = get_questions()
+    context = V.EncodingContext(max_negative_graphs=3)
+    stream = batching.EncodingStream(questions, word2idx, "PooledEdgesModel", batch_size=4, context=context,
+                                     workers=0)
+    parallel_stream = batching.EncodingStream(questions, word2idx, "PooledEdgesModel", batch_size=4,
+                                              context=context, workers=2)
+    for size in [4, 4, 2, 6, 8]:
+        samples, targets = stream.next_batch(size)
+        parallel_samples, parallel_targets = parallel_stream.next_batch(size)
+        assert targets.shape == (size, 3) and samples[1].shape[:2] == (size, 3)
+        # The graph with the positive score is always kept
+        assert np.all(targets.max(axis=1) == 1.0)
+        assert np.array_equal(targets, parallel_targets)
+        assert all(np.array_equal(m, parallel_m) for m, parallel_m in zip(samples, parallel_samples))
+    assert stream.epoch == 2
+    parallel_stream.close()
+
+
+@pytest.mark.parametrize("model_class", [OneEdgeModel, STAGGModel, PooledEdgesModel])
+def test_bucketing(model_class):
+    word2idx = {_utils.all_zeroes: 0, _utils.unknown_el: 1, "performer": 2, "obama": 3, "who": 4, "played": 5}
+    questions = get_questions()
+    samples = V.encode_for_model(questions, model_class.__name__, word2idx, ragged=True)
+    dense = [m.pad() if isinstance(m, V.RaggedGraphs) else m for m in samples]
+    torch.manual_seed(1)
+    # Without dropout the training mode, in which the graphs are trimmed, gives the same predictions every time
+    net = model_class(hp_vocab_size=len(word2idx), hp_dropout=0.0)
+    with batching.PaddedInputs(net) as padded_inputs:
+        sizes = padded_inputs.sample_sizes(samples)
+        assert sizes[:, 0].tolist() == [i % 5 + 1 for i in range(10)]
+        assert np.array_equal(sizes, padded_inputs.sample_sizes(dense))
+        sample_ids, = padded_inputs.add_buckets(samples, np.ones((10, 5)), batch_size=2, seed=1)
+        order = batching.BucketSampler(sizes, batch_size=2, seed=1).epoch_order(0)
+        for i in range(0, 10, 2):
+            predictions = net(Variable(torch.from_numpy(sample_ids[i:i + 2])))
+            graphs = sizes[order[i], 0]
+            # Questions with the same number of graphs end up in the same mini-batch
+            assert predictions.size() == (2, graphs) and sizes[order[i + 1], 0] == graphs
+            # The trimmed mini-batch gives the same predictions as the padded one
+            expected = model_class.forward(net, *[Variable(torch.from_numpy(m[order[i:i + 2]])) for m in dense])
+            assert np.allclose(predictions.data.numpy(), expected[:, :graphs].data.numpy(), atol=1e-6)
+            targets = padded_inputs.batch_targets(Variable(torch.from_numpy(sample_ids[i:i + 2])))
+            assert targets.size() == (2, graphs) and torch.equal(targets.data, torch.ones(2, graphs))
+        # The evaluation keeps the number of graphs of the data set
+        net.eval()
+        val_ids, = padded_inputs.add(samples)
+        assert net(Variable(torch.from_numpy(val_ids[:3]))).size() == (3, 5)
+
+
+
+def test_packed_graphs():
+    word2idx = {_utils.all_zeroes: 0, _utils.unknown_el: 1, "performer": 2, "obama": 3}
+    questions = get_questions()
+    dense = V.encode_for_model(questions, "GNNModel", word2idx)
+    packed = V.encode_for_model(questions, "GNNModel", word2idx, packed=True)
+    torch.manual_seed(1)
+    net = GNNModel(hp_vocab_size=len(word2idx))
+    net.eval()
+    expected = net(*[Variable(torch.from_numpy(m)) for m in dense])
+    indices = np.array([4, 1, 2])
+    for trim in [False, True]:
+        with batching.PaddedInputs(net, trim=trim) as padded_inputs:
+            sample_ids, = padded_inputs.add(packed)
+            predictions = net(Variable(torch.from_numpy(sample_ids[indices])))
+        assert predictions.size() == expected[indices].size()
+        assert np.allclose(predictions.data.numpy(), expected[indices].data.numpy(), atol=1e-6)
+
+
+if __name__ == '__main__':
+    pytest.main(['-v', __file__])
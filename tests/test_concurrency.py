@@ -0,0 +1,78 @@
+import pytest
+
+import threading
+import time
+
+from questionanswering.grounding.concurrency import AIMDLimiter
+from questionanswering.grounding.hedging import Hedger
+
+
+def test_limit_adapts():
+    limiter = AIMDLimiter(initial_limit=2, max_limit=4)
+    for _ in range(20):
+        with limiter.slot("q"):
+            pass
+    assert limiter.limit == 4
+    with limiter.slot("q") as outcome:
+        outcome['failed'] = True
+    assert limiter.limit < 4
+
+
+def test_fair_queue():
+    limiter = AIMDLimiter(initial_limit=1, max_limit=1)
+    served = []
+
+    def run(key, n):
+        with limiter.scope(key):
+            for _ in range(n):
+                with limiter.slot():
+                    served.append(key)
+                    time.sleep(0.005)
+
+    threads = [threading.Thread(target=run, args=("hard", 30))] + \
+              [threading.Thread(target=run, args=(f"easy{i}", 2)) for i in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert limiter.in_flight == 0
+    # The easy questions are finished long before the hard one
+    assert max(i for i, k in enumerate(served) if k != "hard") < 10
+
+
+def test_hedging():
+    hedger = Hedger(initial_delay=0.05, max_hedge_ratio=0.5, max_workers=4)
+    calls = []
+
+    def slow_request():
+        calls.append(time.monotonic())
+        time.sleep(0.2 if len(calls) % 2 else 0.0)
+        return [{}]
+
+    start = time.monotonic()
+    assert hedger.run(slow_request) == [{}]
+    # The duplicate is sent after the delay and returns first
+    assert len(calls) == 2 and calls[1] - start >= 0.05 and time.monotonic() - start < 0.15
+    # The token bucket is empty, the next slow request is not duplicated
+    calls.clear()
+    assert hedger.run(slow_request) == [{}]
+    assert len(calls) == 1 and hedger.hedges == 1
+    calls.clear()
+    assert hedger.run(slow_request) == [{}]
+    assert len(calls) == 2 and hedger.hedges == 2
+    time.sleep(0.2)
+
+
+def test_hedging_observes_failures():
+    hedger = Hedger(initial_delay=1.0, min_observations=1)
+
+    def failing_request():
+        time.sleep(0.1)
+        return None
+
+    assert hedger.run(failing_request, timeout=0.05) is None
+    assert hedger.failures == 1 and hedger.hedge_delay() == 0.05
+
+
+if __name__ == '__main__':
+    pytest.main(['-v', __file__])
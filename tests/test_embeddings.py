@@ -0,0 +1,60 @@
+import pytest
+
+import threading
+
+import numpy as np
+
+from questionanswering import _utils
+
+
+def test_binary_embeddings(tmpdir):
+    path = str(tmpdir.join("glove.test.txt"))
+    with open(path, "w") as f:
+        f.write("the 0.1 0.2 0.3\nof -0.1 0.5 0.0\nqueen 1.0 2.0 3.0\n")
+    text_embeddings, text_word2idx = _utils._load_word_embeddings_from_text(path)
+    embeddings, word2idx = _utils.load_word_embeddings(path)
+    assert tmpdir.join("glove.test.npy").exists() and tmpdir.join("glove.test.vocab").exists()
+    # The second load reads the binary files
+    embeddings, word2idx = _utils.load_word_embeddings(path)
+    assert isinstance(embeddings, np.memmap)
+    assert np.allclose(embeddings, text_embeddings)
+    assert dict(word2idx) == dict(text_word2idx)
+    assert word2idx['queen'] == 4 and word2idx['king'] == 1
+    assert np.allclose(embeddings[0], 0.0)
+    assert np.allclose(embeddings[1], [1.0/3, 2.7/3, 3.3/3])
+
+
+def test_pruned_embeddings(tmpdir):
+    path = str(tmpdir.join("glove.test.txt"))
+    with open(path, "w") as f:
+        f.write("the 0.1 0.2 0.3\nof -0.1 0.5 0.0\nqueen 1.0 2.0 3.0\n0 0.0 0.0 1.0\n")
+    embeddings, word2idx = _utils.load_word_embeddings(path)
+    tokens = ["Queen", "1984", "(the)", "Zanzibar"]
+    pruned_embeddings, pruned_word2idx = _utils.prune_word_embeddings(embeddings, word2idx, tokens)
+    assert pruned_embeddings.shape == (5, 3)
+    _utils.save_word_embeddings(pruned_embeddings, ["the", "queen", "0"], str(tmpdir.join("pruned")))
+    pruned_embeddings, pruned_word2idx = _utils.load_word_embeddings(str(tmpdir.join("pruned.npy")))
+    for t in tokens:
+        assert np.allclose(embeddings[_utils.get_idx(t, word2idx)],
+                           pruned_embeddings[_utils.get_idx(t, pruned_word2idx)])
+    assert pruned_word2idx["of"] == 1
+
+
+def test_concurrent_conversion(tmpdir):
+    path = str(tmpdir.join("glove.test.txt"))
+    with open(path, "w") as f:
+        f.write("the 0.1 0.2 0.3\nof -0.1 0.5 0.0\nqueen 1.0 2.0 3.0\n")
+    text_embeddings, _ = _utils._load_word_embeddings_from_text(path)
+    threads = [threading.Thread(target=_utils.convert_word_embeddings, args=(path, str(tmpdir.join("glove.test"))))
+               for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(f.basename for f in tmpdir.listdir()) == ["glove.test.npy", "glove.test.txt", "glove.test.vocab"]
+    embeddings, word2idx = _utils.load_word_embeddings(path)
+    assert np.allclose(embeddings, text_embeddings) and word2idx['queen'] == 4
+
+
+if __name__ == '__main__':
+    pytest.main(['-v', __file__])
@@ -0,0 +1,52 @@
+import pytest
+
+from questionanswering import _utils
+from questionanswering.entity_index import EntityIndex
+
+
+@pytest.fixture
+def index_path(tmpdir):
+    tmpdir.join("entities.map").write("Q64\tberlin\tBerlin\nQ1022\tberlin\tBerlin, New Hampshire\n"
+                                      "Q70\tbern\tBern\nQ76\tbarack obama\tBarack Obama\nQ1\tünïcode\tx\n")
+    tmpdir.join("entities.freq").write("Q64\t500\nQ1022\t3\nQ76\t7070\n")
+    EntityIndex.build(str(tmpdir.join("entities.map")), str(tmpdir.join("index")), str(tmpdir.join("entities.freq")))
+    return str(tmpdir.join("index"))
+
+
+def test_lookup(index_path):
+    entity_map = _utils.load_entity_map(index_path)
+    assert entity_map["berlin"] == [('Q64', 'Berlin'), ('Q1022', 'Berlin, New Hampshire')]
+    assert entity_map["ünïcode"] == [('Q1', 'x')]
+    assert entity_map["paris"] == []
+    assert entity_map.get_with_freqs("barack obama") == [('Q76', 'Barack Obama', 7070)]
+
+
+def test_prefix(index_path):
+    entity_map = _utils.load_entity_map(index_path)
+    assert [l for l, _ in entity_map.prefix("ber")] == ["berlin", "bern"]
+    assert [l for l, _ in entity_map.prefix("ber", limit=1)] == ["berlin"]
+    assert entity_map.prefix("x") == []
+
+
+def test_freqs(index_path):
+    entity_freqs = _utils.load_entity_freq_map(index_path)
+    assert entity_freqs['Q76'] == 7070
+    assert entity_freqs.get('Q70') is None and entity_freqs.get('Q70', 0) == 0
+    assert 'Q70' not in entity_freqs and 'Q2' not in entity_freqs
+    with pytest.raises(KeyError):
+        entity_freqs['Q2']
+
+
+def test_freqs_as_dict(index_path, tmpdir):
+    entity_freqs = _utils.load_entity_freq_map(index_path)
+    expected = _utils.load_entity_freq_map(str(tmpdir.join("entities.freq")))
+    assert len(entity_freqs) == len(expected)
+    # The entities of the frequency map, the entities only in the entity map and an unknown entity
+    for entity_id in ["Q64", "Q1022", "Q76", "Q70", "Q1", "Q2"]:
+        assert (entity_id in entity_freqs) == (entity_id in expected)
+        assert entity_freqs.get(entity_id) == expected.get(entity_id)
+        assert entity_freqs.get(entity_id, -5) == expected.get(entity_id, -5)
+
+
+if __name__ == '__main__':
+    pytest.main(['-v', __file__])
@@ -0,0 +1,66 @@
+import pytest
+
+import numpy as np
+import torch
+from torch.autograd import Variable
+
+from questionanswering import _utils
+from questionanswering.construction.graph import SemanticGraph, Edge, WithScore
+from questionanswering.construction.sentence import Sentence
+from questionanswering.grounding import graph_queries
+from questionanswering.models import vectorization as V
+from questionanswering.models.gnn import GNNModel
+from questionanswering.models.lexical_baselines import OneEdgeModel, STAGGModel, PooledEdgesModel
+from questionanswering.models.scoring import GraphScorer
+
+word2idx = {_utils.all_zeroes: 0, _utils.unknown_el: 1}
+for w in "who played obama performer spouse instance of <e> <s> <f>".split():
+    word2idx[w] = len(word2idx)
+
+
+def get_question():
+    s = Sentence(input_text="who played obama ?",
+                 tagged=[{'originalText': k, 'pos': 'O', 'ner': 'O'} for k in "who played obama ?".split()],
+                 entities=[{'linkings': [['Q76', 'Barack Obama']], 'token_ids': [2], 'type': 'NNP'}])
+    graphs = [SemanticGraph([Edge(leftentityid=graph_queries.QUESTION_VAR, rightentityid="Q76", relationid=p)])
+              for p in ["P175", "P26", "P31", "P585", "P36"]]
+    return s, graphs
+
+
+@pytest.mark.parametrize("model_class, packed", [(OneEdgeModel, False), (STAGGModel, False),
+                                                 (PooledEdgesModel, False), (GNNModel, False), (GNNModel, True)])
+def test_graph_scorer(model_class, packed):
+    s, graphs = get_question()
+    s.graphs = [WithScore(g, (0.0, 0.0, 0.0)) for g in graphs]
+    torch.manual_seed(1)
+    net = model_class(hp_vocab_size=len(word2idx))
+    net.eval()
+    expected = net(*[Variable(torch.from_numpy(m)) for m in V.encode_for_model([s], model_class.__name__, word2idx)])
+    # Three chunks of graphs, the question is encoded once
+    scorer = GraphScorer(net, word2idx, context=V.EncodingContext(max_negative_graphs=2), packed=packed, batch_size=2)
+    net.train()
+    for _ in range(2):
+        scores = scorer.score(s, graphs)
+        assert scores.shape == (len(graphs),)
+        assert np.allclose(scores, expected.view(-1).data.numpy()[:len(graphs)], atol=1e-6)
+    assert net.training
+    assert scorer.question_vectors.misses == 1 and scorer.question_vectors.hits == 1
+    assert len(scorer.score(s, [])) == 0
+
+
+
+@pytest.mark.parametrize("model_class", [OneEdgeModel, STAGGModel, PooledEdgesModel, GNNModel])
+def test_dynamic_shapes(model_class):
+    s, graphs = get_question()
+    graphs.append(SemanticGraph([Edge(leftentityid=graph_queries.QUESTION_VAR, rightentityid="Q76", relationid="P175"),
+                                 Edge(leftentityid=graph_queries.QUESTION_VAR, rightentityid="Q76", relationid="P26")]))
+    torch.manual_seed(1)
+    net = model_class(hp_vocab_size=len(word2idx))
+    # A model trained on the data encoded with dynamic shapes scores the same with the limits of the module
+    static = GraphScorer(net, word2idx).score(s, graphs)
+    dynamic = GraphScorer(net, word2idx, context=V.EncodingContext(dynamic_shapes=True)).score(s, graphs)
+    assert np.allclose(dynamic, static, atol=1e-6)
+
+
+if __name__ == '__main__':
+    pytest.main(['-v', __file__])
@@ -0,0 +1,77 @@
+import pytest
+
+import time
+
+import numpy as np
+
+from questionanswering import models
+from questionanswering.construction import sentence
+from questionanswering.grounding import staged_generation, graph_queries
+
+# The queries of the first level of the search are answered at once, the following ones take SLOW_QUERY_TIME
+FIRST_LEVEL_QUERIES = 18
+SLOW_QUERY_TIME = 2.0
+
+
+class EdgeCountScorer(models.GraphScorer):
+
+    def __init__(self):
+        """
+        Prefers the larger graphs, so that the search keeps expanding until the budget is exhausted.
+        """
+        pass
+
+    def score(self, s, graphs):
+        return np.asarray([0.1 * len(g.edges) + 0.001 * i for i, g in enumerate(graphs)])
+
+
+def slow_query_wikidata(timeouts, slow):
+    def query_wikidata(query, hedged=False, timeout=None, **kwargs):
+        timeouts.append(timeout)
+        if slow and len(timeouts) > FIRST_LEVEL_QUERIES:
+            if timeout is not None and timeout < SLOW_QUERY_TIME:
+                time.sleep(timeout)
+                return None
+            time.sleep(SLOW_QUERY_TIME)
+        return [{f"r{i}v": "P31v" for i in range(4)}]
+    return query_wikidata
+
+
+def get_sentence():
+    return sentence.Sentence(input_text="who played obama ?",
+                             tagged=[{'originalText': k, 'pos': 'O', 'ner': 'O'} for k in "who played obama ?".split()],
+                             entities=[{'linkings': [['Q76', 'Barack Obama']], 'token_ids': [2], 'type': 'NNP'}])
+
+
+@pytest.fixture
+def search_setup(monkeypatch):
+    monkeypatch.setattr(graph_queries, "FREQ_THRESHOLD", 0)
+    monkeypatch.setattr(graph_queries, "LONG_LEG_RELATIONS", {"P131"}, raising=False)
+    monkeypatch.setitem(graph_queries.scheme.property2label, "P31",
+                        {"label": "instance of", "freq": 1000, "type": "wikibase-item", "altlabel": []})
+    return monkeypatch
+
+
+def test_anytime_search(search_setup):
+    timeouts = []
+    search_setup.setattr(graph_queries, "query_wikidata", slow_query_wikidata(timeouts, slow=False))
+    complete = staged_generation.generate_with_model(get_sentence(), EdgeCountScorer())
+    assert len(timeouts) > FIRST_LEVEL_QUERIES and all(t is None or t == graph_queries.VERIFY_TIMEOUT
+                                                       for t in timeouts)
+
+    time_limit = 0.5
+    timeouts = []
+    search_setup.setattr(graph_queries, "query_wikidata", slow_query_wikidata(timeouts, slow=True))
+    budget = staged_generation.SearchBudget(time_limit=time_limit)
+    generated = staged_generation.generate_with_model(get_sentence(), EdgeCountScorer(), budget=budget)
+    # The slow query is cut at the time limit
+    assert budget.cut_short and time_limit <= budget.elapsed() < time_limit + 0.2
+    # The best graphs found so far are returned
+    assert 0 < len(generated) < len(complete)
+    assert [g.scores[2] for g in generated] == sorted([g.scores[2] for g in generated], reverse=True)
+    # Every query was limited by the remaining time
+    assert all(t is not None and t <= time_limit for t in timeouts)
+
+
+if __name__ == '__main__':
+    pytest.main(['-v', __file__])
@@ -0,0 +1,53 @@
+import pytest
+
+from questionanswering import _utils
+from questionanswering.construction.sentence import Sentence
+
+
+@pytest.fixture
+def lightweight_backend():
+    backend = _utils.TAGGER_BACKEND
+    _utils.TAGGER_BACKEND = "lightweight"
+    yield
+    _utils.TAGGER_BACKEND = backend
+
+
+def test_token_schema(lightweight_backend):
+    tagged = _utils.get_tagged_from_server("Who played Luke Skywalker in the movie released in 1977?")
+    assert all(set(t.keys()) == _utils.TAGGED_TOKEN_FIELDS for t in tagged)
+    assert [t['index'] for t in tagged] == list(range(1, len(tagged) + 1))
+    assert tagged[3]['originalText'] == "Skywalker"
+    assert tagged[3]['characterOffsetBegin'] == 16 and tagged[3]['characterOffsetEnd'] == 25
+
+
+def test_year_entities(lightweight_backend):
+    tagged = _utils.get_tagged_from_server_batch(["who was the president of the united states in 2012?",
+                                                  "what team won 3 games in 1999"], caseless=True)
+    s = Sentence(input_text="who was the president of the united states in 2012?", tagged=tagged[0])
+    assert {'type': 'YEAR', 'linkings': [('2012', '2012')], 'token_ids': [9]} in s.entities
+    s = Sentence(input_text="what team won 3 games in 1999", tagged=tagged[1])
+    assert [e['linkings'] for e in s.entities if e['type'] == 'YEAR'] == [[('1999', '1999')]]
+
+
+def test_lemmas(lightweight_backend):
+    assert _utils._lemmatize_tokens(['House', 'Of', 'Representatives']) == ['House', 'Of', 'Representative']
+    assert _utils._lemmatize_tokens(['star', 'wars']) == ['star', 'war']
+
+
+
+@pytest.mark.parametrize("question, expected", [
+    ("what movies did tom hanks play in?", {'movies': ('NNS', 'movie')}),
+    ("who are the children of michael jackson?", {'children': ('NNS', 'child')}),
+    ("what people were born in july 1990?", {'people': ('NNS', 'person'), 'born': ('VBN', 'bear'),
+                                             'july': ('NNP', 'july')}),
+    ("who played the women in sex and the city?", {'played': ('VBD', 'play'), 'women': ('NNS', 'woman')}),
+    ("what tv series did matt smith star in?", {'series': ('NN', 'series')}),
+    ("where does the royal family of italy live?", {'family': ('NN', 'family'), 'italy': ('NNP', 'italy')}),
+])
+def test_irregular_nouns(lightweight_backend, question, expected):
+    tagged = _utils.get_tagged_from_server(question, caseless=True)
+    assert {t['originalText']: (t['pos'], t['lemma']) for t in tagged if t['originalText'] in expected} == expected
+
+
+if __name__ == '__main__':
+    pytest.main(['-v', __file__])
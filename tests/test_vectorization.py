@@ -0,0 +1,184 @@
+import pytest
+
+import numpy as np
+
+from questionanswering import _utils
+from questionanswering.construction.graph import SemanticGraph, Edge, WithScore
+from questionanswering.construction.sentence import Sentence
+from questionanswering.grounding import graph_queries
+from questionanswering.models import vectorization as V
+from questionanswering.models import encoding_cache
+
+
+word2idx = {_utils.all_zeroes: 0, _utils.unknown_el: 1}
+for w in "who played the queen performer point in time barack obama human <e> <s> <f> <max>".split():
+    word2idx[w] = len(word2idx)
+
+
+def get_questions():
+    s = Sentence(input_text="who played obama ?",
+                 tagged=[{'originalText': k, 'pos': 'O', 'ner': 'O'} for k in "who played obama ?".split()],
+                 entities=[{'linkings': [['Q76', 'Barack Obama']], 'token_ids': [2], 'type': 'NNP'}])
+    s.graphs = [WithScore(SemanticGraph([Edge(leftentityid=graph_queries.QUESTION_VAR, rightentityid="Q76",
+                                              relationid="P175")]), (0.0, 0.0, 0.0)),
+                WithScore(SemanticGraph([Edge(leftentityid=graph_queries.QUESTION_VAR, rightentityid="Q76",
+                                              relationid="P175"),
+                                         Edge(leftentityid=graph_queries.QUESTION_VAR, rightentityid="MAX",
+                                              relationid="P585")]), (0.0, 0.0, 0.0))]
+    return [s]
+
+
+def test_graph_cache():
+    questions = get_questions()
+    V.graph_cache = None
+    graphs = V.encode_batch_graphs(questions, word2idx)
+    structure = V.encode_batch_graph_structure(questions, word2idx)
+    V.graph_cache = V.GraphEncodingCache()
+    for _ in range(2):
+        assert np.array_equal(V.encode_batch_graphs(questions, word2idx), graphs)
+        for cached, expected in zip(V.encode_batch_graph_structure(questions, word2idx), structure):
+            assert np.array_equal(cached, expected)
+    assert V.graph_cache.misses == 4 and V.graph_cache.hits == 4
+    # A different entity label is a different graph
+    questions[0].entities[0]['linkings'] = [['Q76', 'Obama']]
+    assert not np.array_equal(V.encode_batch_graphs(questions, word2idx), graphs)
+
+
+def test_question_cache():
+    questions = get_questions()
+    V.question_cache = None
+    expected = V.encode_batch_questions(questions, word2idx)
+    V.question_cache = V.GraphEncodingCache(V.QUESTION_CACHE_SIZE)
+    for _ in range(2):
+        assert np.array_equal(V.encode_batch_questions(questions, word2idx), expected)
+    assert V.question_cache.misses == 2 and V.question_cache.hits == 2
+    assert np.array_equal(V.encode_batch_questions(questions, word2idx, variant=1), expected[:, 1])
+    # Only the candidate graphs are encoded, in chunks of the maximum number of graphs
+    graphs, = V.encode_candidate_graphs(questions[0], [g.graph for g in questions[0].graphs] * 2, "PooledEdgesModel",
+                                        word2idx, V.EncodingContext(max_negative_graphs=3))
+    assert graphs.shape[:2] == (2, 3) and np.array_equal(graphs[1, 0], graphs[0, 1]) and not graphs[1, 1:].any()
+
+
+def test_ragged_graphs():
+    questions = get_questions()
+    graphs = V.encode_batch_graphs(questions, word2idx)
+    ragged = V.encode_batch_graphs_ragged(questions, word2idx)
+    assert ragged.token_ids.dtype == np.uint16
+    assert ragged.shape == graphs.shape
+    assert np.array_equal(ragged.pad(), graphs)
+    assert np.array_equal(ragged.select(edge=0, variant=1).pad([0]), graphs[:, :, 0, 1])
+    # Trimmed to the two graphs, the two edges of the second graph and the longest label
+    trimmed = ragged.select(variant=1).pad([0], trim=True)
+    assert trimmed.shape[:3] == (1, 2, 2) and np.any(trimmed[..., -1])
+    assert np.array_equal(trimmed, graphs[:, :, :2, 1, :trimmed.shape[-1]])
+    assert not np.any(graphs[:, :, :, 1, trimmed.shape[-1]:])
+
+
+def test_selected_variants():
+    questions = get_questions()
+    graphs = V.encode_batch_graphs(questions, word2idx)
+    assert np.array_equal(V.encode_batch_graphs(questions, word2idx, edge=0, variant=1), graphs[:, :, 0, 1])
+    assert np.array_equal(V.encode_batch_graphs(questions, word2idx, variant=0), graphs[..., 0, :])
+    ragged = V.encode_batch_graphs_ragged(questions, word2idx, variant=1)
+    assert ragged.shape == graphs[..., 1, :].shape and np.array_equal(ragged.pad(), graphs[..., 1, :])
+    assert ragged.nbytes < V.encode_batch_graphs_ragged(questions, word2idx).nbytes
+    assert np.array_equal(V.encode_batch_questions(questions, word2idx, variant=1),
+                          V.encode_batch_questions(questions, word2idx)[:, 1])
+
+
+def test_encode_parallel():
+    questions = get_questions() + get_questions() + get_questions()
+    questions[1].graphs = questions[1].graphs[:1]
+    encoders = [V.encode_batch_questions, V.encode_batch_graph_structure, V.encode_structural_features,
+                V.encode_batch_graphs_ragged]
+    serial = V.encode_parallel(encoders, questions, word2idx, workers=0)
+    parallel = V.encode_parallel(encoders, questions, word2idx, workers=2, shard_size=1)
+    assert np.array_equal(parallel[0], serial[0]) and np.array_equal(parallel[2], serial[2])
+    for m, expected in zip(parallel[1], serial[1]):
+        assert m.dtype == expected.dtype and np.array_equal(m, expected)
+    assert parallel[3].shape == serial[3].shape and np.array_equal(parallel[3].pad(), serial[3].pad())
+
+
+def test_dynamic_shapes():
+    questions = get_questions()
+    context = V.EncodingContext(dynamic_shapes=True)
+    graphs = V.encode_batch_graphs(questions, word2idx)
+    dynamic = V.encode_batch_graphs(questions, word2idx, context=context)
+    assert dynamic.shape[2] == 2 and dynamic.shape[-1] < V.MAX_LABEL_TOKEN_LEN
+    assert np.array_equal(dynamic, graphs[..., :2, :, :dynamic.shape[-1]]) and graphs.sum() == dynamic.sum()
+    assert V.encode_batch_graphs_ragged(questions, word2idx, context=context).shape == dynamic.shape
+    # The 4 tokens of the question and the boundary tokens
+    assert V.encode_batch_questions(questions, word2idx, context=context).shape[-1] == 6
+    structure = V.encode_batch_graph_structure(questions, word2idx)
+    dynamic = V.encode_batch_graph_structure(questions, word2idx, context=context)
+    assert dynamic[0].shape[2] == 4 and dynamic[2].shape[3] == 2
+    # The incoming edges refer to the rows of the smaller arrays
+    assert dynamic[3].max() < 2 * 4 and structure[3].max() >= V.MAX_EDGES
+    for m, expected in zip(V._resize_graph_structure(dynamic, V.MAX_EDGES, V.MAX_LABEL_TOKEN_LEN // 2,
+                                                     V.MAX_EDGES_PER_ENTITY), structure):
+        assert m.dtype == expected.dtype and np.array_equal(m, expected)
+    # Larger graphs are cut at the limits
+    assert V.encode_batch_graphs(questions, word2idx, context=V.EncodingContext(max_edges=1)).shape[2] == 1
+
+
+def test_packed_graphs():
+    questions = get_questions() + get_questions()
+    nodes, edges, A_nodes, A_edges = V.encode_batch_graph_structure(questions, word2idx)
+    packed = V.encode_batch_graphs_packed(questions, word2idx)
+    assert len(packed) == 2 and packed.shape == (2, 2) and packed.nbytes < sum(m.nbytes for m in (nodes, edges))
+    packed_nodes, packed_edges, messages, node_mask, edge_mask, roots, graph_ids = packed.arrays()
+    # The question variable, Obama and MAX are the nodes, the rows of the padded input without the padding row
+    assert packed_nodes.shape[0] == 2 + 3 + 2 + 3 and roots.tolist() == [0, 2, 5, 7]
+    assert np.array_equal(packed_nodes[7:], nodes[1, 1, 1:4]) and np.array_equal(packed_edges[4:], edges[1, 1, 1:3])
+    assert graph_ids.tolist() == [[0, 1], [2, 3]]
+    # The messages of the question variable of the last graph refer to the nodes and edges across all graphs
+    root_messages = messages[messages[:, 0] == 7]
+    assert sorted(root_messages[:, 1].tolist()) == [8, 9] and sorted(root_messages[:, 2].tolist()) == [4, 5]
+    assert np.array_equal(node_mask[7:], (A_nodes[1, 1, 1:4] != 0).any(axis=-1))
+    assert all(np.array_equal(m, expected) for m, expected in
+               zip(packed[[1]].arrays(), V.encode_batch_graphs_packed(questions[1:], word2idx).arrays()))
+    assert all(np.array_equal(m, expected) for m, expected in
+               zip(V.PackedGraphs.concatenate([packed[:1], packed[1:]]).arrays(), packed.arrays()))
+    # The number of edges is not limited
+    questions[0].graphs[0].graph.edges += [Edge(leftentityid=graph_queries.QUESTION_VAR, rightentityid="Q76",
+                                                relationid="P175")] * V.MAX_EDGES
+    assert V.encode_batch_graphs_packed(questions[:1], word2idx).edge_offsets[1] == V.MAX_EDGES + 1
+
+
+@pytest.mark.parametrize("model_type, ragged, packed", [("OneEdgeModel", True, False), ("STAGGModel", True, False),
+                                                        ("PooledEdgesModel", False, False), ("GNNModel", False, False),
+                                                        ("GNNModel", False, True)])
+def test_reorder_graphs(model_type, ragged, packed):
+    questions = get_questions() + get_questions()
+    questions[0].graphs = questions[0].graphs[:1]
+    graph_orders = [[0], [1, 0]]
+    inputs = V.encode_for_model(questions, model_type, word2idx, ragged=ragged, packed=packed)
+    for q, graph_order in zip(questions, graph_orders):
+        q.graphs = [q.graphs[gi] for gi in graph_order]
+    expected = V.encode_for_model(questions, model_type, word2idx, ragged=ragged, packed=packed)
+    for m, e in zip(V.reorder_graphs(inputs, model_type, graph_orders), expected):
+        if isinstance(m, V.PackedGraphs):
+            m, e = m.arrays(), e.arrays()
+        elif isinstance(m, V.RaggedGraphs):
+            m, e = [m.pad()], [e.pad()]
+        else:
+            m, e = [m], [e]
+        assert all(np.array_equal(a, b) for a, b in zip(m, e))
+
+
+def test_encoding_cache(tmpdir):
+    questions = get_questions()
+    samples = V.encode_for_model(questions, "PooledEdgesModel", word2idx, ragged=True)
+    targets = np.ones((1, 2))
+    key = encoding_cache.fingerprint([], word2idx, model_type="PooledEdgesModel")
+    assert encoding_cache.load(str(tmpdir), key) is None
+    encoding_cache.save(str(tmpdir), key, samples, targets, [[1, 0]], available=3)
+    cached_samples, cached_targets, graph_orders, metadata = encoding_cache.load(str(tmpdir), key)
+    assert np.array_equal(cached_samples[0], samples[0])
+    assert np.array_equal(cached_samples[1].pad(), samples[1].pad())
+    assert np.array_equal(cached_targets, targets)
+    assert graph_orders == [[1, 0]] and metadata == {"available": 3}
+
+
+if __name__ == '__main__':
+    pytest.main(['-v', __file__])